@@ -1,11 +1,29 @@
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
 from dotenv import load_dotenv
+from functools import partial
 import logging
+import multiprocessing
 import os
 
-from config import endpoints, card, user, store, order, product, date_times, DataType
+from sqlalchemy import inspect
+
+from analytics import SalesSummaries
+from config import order, date_times, data_types, dimensions, DataType, STAGING_DIR
 from data_cleaning import DataCleaning
 from data_extraction import DataExtractor
 from database_utils import DatabaseConnector
+from integrity import ORPHAN_ACTIONS, ReferentialIntegrity
+from pipeline import (EXTRACT, LOAD, STAGES, RunContext, count_rows, reset_worker,
+                      run_cleaning, run_pipeline)
+from profiling import PROFILE_STAGE_ENV, run_report
+from quarantine import quarantine
+from scheduler import Task, run_tasks, timed
+from staging import Staging
+from surrogate_keys import SurrogateKeys, join_keys
+from validation import StreamValidator
 
 logging.basicConfig(
     filename='pipeline.log',
@@ -25,168 +43,298 @@ def setup_database(filename):
     return db_conn, engine
 
 
-def process_date_times_data(target_db, target_engine, data_type: DataType):
-    """Extract -> Clean -> Load Product data"""
-    print(f"Processing {data_type.name} Data")
+def process_date_times_delta(context: RunContext, data_type: DataType):
+    """Extract -> Clean -> Upsert the new or changed Date_Times rows"""
+    print(f"Processing {data_type.name} Data incrementally")
+    data_extractor, target_db, target_engine = (context.data_extractor, context.target_db,
+                                                context.target_engine)
+    location = data_type.source.location
+    etag = data_extractor.get_s3_etag(location)
+    if etag == target_db.read_watermark(target_engine, location):
+        print(f"{data_type.name} unchanged since the last load")
+        return
 
     # Extract
-    data_extractor = DataExtractor()
-    df_extracted = data_extractor.extract_from_s3(
-        s3_address=endpoints.date_times)
-    print(f"{data_type.name} rows extracted: {len(df_extracted.index)}")
-    assert len(df_extracted.index) == data_type.extracted_count
+    with timed(f"{data_type.name} extract"):
+        df_extracted = data_extractor.extract_from_s3(s3_address=location)
+        row_hashes = data_extractor.hash_rows(df_extracted)
+        df_changed = data_extractor.select_changed_rows(
+            df_extracted, row_hashes, target_db.read_row_hashes(target_engine, location))
+    print(f"{data_type.name} rows new or changed: {len(df_changed.index)}")
 
     # Clean
-    data_cleaner = DataCleaning(column_entries=data_type.column_entries)
-    df_cleaned = df_extracted.copy()
-    df_cleaned = data_cleaner.clean_date_times_data(df=df_cleaned)
+    with timed(f"{data_type.name} clean"):
+        df_cleaned = run_cleaning(context.cleaning_pool, replace(data_type, max_rejected_fraction=None),
+                                  df_changed) if not df_changed.empty else df_changed
     print(f"{data_type.name} rows after cleaning: {len(df_cleaned.index)}")
-    assert len(df_cleaned.index) == data_type.clean_count
+    # The unchanged rows passed cleaning in an earlier load, so the rejected rows of the delta are checked
+    # against the rows of the whole table rather than failing the run over a bad row or two
+    validator = StreamValidator(data_type.table_name, max_rejected_fraction=data_type.max_rejected_fraction)
+    validator.rows_in = len(df_extracted.index)
+    validator.count_out(len(df_extracted.index) - len(df_changed.index) + len(df_cleaned.index))
+    validator.check()
 
     # Load
-    target_db.upload_to_db(target_engine,
-                           df=df_cleaned,
-                           table_name=data_type.table_name)
-
-
-def process_order_data(source_engine, target_db, target_engine,
-                       data_type: DataType):
-    """Extract -> Clean -> Load Order data"""
-    print(f"Processing {data_type.name} Data")
-
-    # Extract
-    data_extractor = DataExtractor()
-    with source_engine.execution_options(
+    with timed(f"{data_type.name} upsert"):
+        with target_engine.begin() as conn:
+            if not df_cleaned.empty:
+                target_db.upsert_to_db(conn,
+                                       df=df_cleaned,
+                                       table_name=data_type.table_name,
+                                       key_columns=[data_type.primary_key],
+                                       sql_dtypes=data_type.schema.sql_dtypes)
+            target_db.write_watermark(conn, location, etag)
+            target_db.write_row_hashes(conn, location, row_hashes)
+
+
+def process_order_delta(context: RunContext, data_type: DataType):
+    """Extract -> Clean -> Upsert the Order rows added since the last load, streamed in chunks"""
+    print(f"Processing {data_type.name} Data incrementally")
+    target_db, target_engine = context.target_db, context.target_engine
+    counts = Counter()
+    location = data_type.source.location
+    watermark = target_db.read_watermark(target_engine, location)
+
+    with context.source_engine.execution_options(
             isolation_level='AUTOCOMMIT').connect() as conn:
-        df_extracted = data_extractor.read_rds_table(conn, 'orders_table')
-    print(f"{data_type.name} rows extracted: {len(df_extracted.index)}")
-    assert len(df_extracted.index) == data_type.extracted_count
-
-    # Clean
-    data_cleaner = DataCleaning(column_entries=data_type.column_entries)
-    df_cleaned = df_extracted.copy()
-    df_cleaned = data_cleaner.clean_order_data(df=df_cleaned)
-    print(f"{data_type.name} rows after cleaning: {len(df_cleaned.index)}")
-    assert len(df_cleaned.index) == data_type.clean_count
-
-    # Load
-    target_db.upload_to_db(target_engine,
-                           df=df_cleaned,
-                           table_name=data_type.table_name)
-
-
-def process_product_data(target_db, target_engine, data_type: DataType):
-    """Extract -> Clean -> Load Product data"""
-    print(f"Processing {data_type.name} Data")
-
-    # Extract
-    data_extractor = DataExtractor()
-    df_extracted = data_extractor.extract_from_s3(
-        s3_address=endpoints.products)
-    print(f"{data_type.name} rows extracted: {len(df_extracted.index)}")
-    assert len(df_extracted.index) == data_type.extracted_count
-
-    # Clean
-    data_cleaner = DataCleaning(column_entries=data_type.column_entries)
-    df_cleaned = df_extracted.copy()
-    df_cleaned = data_cleaner.clean_product_data(df=df_cleaned)
-    print(f"{data_type.name} rows after cleaning: {len(df_cleaned.index)}")
-    assert len(df_cleaned.index) == data_type.clean_count
-
-    # Load
-    target_db.upload_to_db(target_engine,
-                           df=df_cleaned,
-                           table_name=data_type.table_name)
-
-
-def process_store_data(target_db, target_engine, data_type: DataType):
-    """Extract -> Clean -> Load Store data"""
-    print(f"Processing {data_type.name} Data")
-    headers = {
-        "Content-Type": "application/json",
-        "X-API-KEY": os.getenv('x-api-key')
+        chunks = context.data_extractor.read_rds_table_in_chunks(
+            conn,
+            location,
+            after_index=int(watermark) if watermark is not None else -1)
+        chunks = count_rows(chunks, counts, 'extracted')
+        # The new orders are too few to hold to the rejected fraction of the whole table
+        chunks = DataCleaning.clean_chunks(
+            chunks, partial(run_cleaning, context.cleaning_pool, replace(data_type, max_rejected_fraction=None)))
+        chunks = count_rows(chunks, counts, 'cleaned')
+        with timed(f"{data_type.name} extract, clean and upsert"):
+            target_db.upsert_chunks_to_db(target_engine,
+                                          chunks=chunks,
+                                          table_name=data_type.table_name,
+                                          key_columns=[data_type.primary_key],
+                                          watermark_source=location,
+                                          sql_dtypes=data_type.schema.sql_dtypes)
+
+    print(f"{data_type.name} rows new: {counts['extracted']}")
+    print(f"{data_type.name} rows after cleaning: {counts['cleaned']}")
+
+
+def create_keys(target_db, target_engine, surrogate_keys: bool):
+    """
+    Build the primary keys of the dimension tables, then the foreign keys and join indexes of orders_table.
+    With surrogate keys the dimension tables are keyed by them and their natural keys are kept unique
+    """
+    keys = {
+        data_type.table_name: data_type.surrogate_key if surrogate_keys else data_type.primary_key
+        for data_type in dimensions
     }
-
-    # Extract
-    data_extractor = DataExtractor()
-    num_stores = data_extractor.list_number_of_stores(
-        url=endpoints.number_of_stores, headers=headers)
-    df_extracted = data_extractor.retrieve_stores_data(
-        url=endpoints.store_details, headers=headers, number_stores=num_stores)
-    print(f"{data_type.name} rows extracted: {len(df_extracted.index)}")
-    assert len(df_extracted.index) == data_type.extracted_count
-
-    # Clean
-    data_cleaner = DataCleaning(column_entries=data_type.column_entries)
-    df_cleaned = df_extracted.copy()
-    df_cleaned = data_cleaner.clean_store_data(df=df_cleaned)
-    print(f"{data_type.name} rows after cleaning: {len(df_cleaned.index)}")
-    assert len(df_cleaned.index) == data_type.clean_count
-
-    # Load
-    target_db.upload_to_db(target_engine,
-                           df=df_cleaned,
-                           table_name=data_type.table_name)
-
-
-def process_card_data(target_db, target_engine, data_type: DataType):
-    """Extract from a pdf file -> Clean -> Load Card data"""
-    print(f"Processing {data_type.name} Data")
-
-    # Extract
-    data_extractor = DataExtractor()
-    df_extracted = data_extractor.retrieve_pdf_data(
-        pdf_path=endpoints.card_data)
-    print(f"{data_type.name} rows extracted: {len(df_extracted.index)}")
-    assert len(df_extracted.index) == data_type.extracted_count
-
-    # Clean
-    data_cleaner = DataCleaning(column_entries=data_type.column_entries)
-    df_cleaned = df_extracted.copy()
-    df_cleaned = data_cleaner.clean_card_data(df=df_cleaned)
-    print(f"{data_type.name} rows after cleaning: {len(df_cleaned.index)}")
-    assert len(df_cleaned.index) == data_type.clean_count
-
-    # Load
-    target_db.upload_to_db(target_engine,
-                           df=df_cleaned,
-                           table_name=data_type.table_name)
-
-
-def process_user_data(source_db, source_engine, target_db, target_engine,
-                      data_type: DataType):
-    """Extract from a postgres Database -> Clean -> Load User data"""
-    print(f"Processing {data_type.name} Data")
-
-    data_extractor = DataExtractor()
-    with source_engine.execution_options(
-            isolation_level='AUTOCOMMIT').connect() as conn:
-        source_db.list_db_tables(source_engine)
-        df_extracted = data_extractor.read_rds_table(conn, 'legacy_users')
-    print(f"{data_type.name} rows extracted: {len(df_extracted.index)}")
-    assert len(df_extracted.index) == data_type.extracted_count
-
-    data_cleaner = DataCleaning(column_entries=data_type.column_entries)
-    df_cleaned = df_extracted.copy()
-    df_cleaned = data_cleaner.clean_user_data(df=df_cleaned)
-    print(f"{data_type.name} rows after cleaning: {len(df_cleaned.index)}")
-    assert len(df_cleaned.index) == data_type.clean_count
-
-    target_db.upload_to_db(target_engine,
-                           df=df_cleaned,
-                           table_name=data_type.table_name)
+    timings = target_db.finalise_load(
+        target_engine,
+        primary_keys=keys,
+        table_name=order.table_name,
+        foreign_keys={column: table_name for table_name, column in keys.items()},
+        unique_keys={data_type.table_name: data_type.primary_key
+                     for data_type in dimensions} if surrogate_keys else None)
+    for name, seconds in timings.items():
+        print(f"{name:>40}: {seconds:.2f}s")
+
+
+def summarise_sales(target_engine, incremental: bool):
+    """Build the summary tables the reports are served from, an incremental load only merges new orders"""
+    if incremental:
+        SalesSummaries.refresh(target_engine)
+    else:
+        SalesSummaries.build(target_engine)
+
+
+def check_natural_keys(target_engine):
+    """An incremental load upserts rows by their natural keys, so exit if the tables were loaded with surrogate keys"""
+    if not inspect(target_engine).has_table(order.table_name):
+        return
+    keys = join_keys(target_engine)
+    if any(keys[data_type.table_name] == data_type.surrogate_key for data_type in dimensions):
+        raise SystemExit(f"{order.table_name} was loaded with --surrogate-keys, which an incremental load "
+                         "doesn't assign. Run a full load")
+
+
+def write_quarantine(staging: Staging or None, target_engine):
+    """Write the rows rejected during the run in one batch, to the staging directory when staging"""
+    try:
+        if staging is not None:
+            quarantine.write_to_staging(staging)
+        else:
+            quarantine.write_to_db(target_engine)
+    except Exception:
+        # Don't hide an error which stopped the run
+        logger.exception("Failed to write the rejected rows")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Extract, clean and load the retail sales data')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=6,
+                        help='number of pipelines to run at the same time')
+    parser.add_argument(
+        '--clean-processes',
+        type=int,
+        default=os.cpu_count(),
+        help='number of processes for cleaning, 0 cleans in the pipeline thread')
+    parser.add_argument(
+        '--create-keys',
+        action='store_true',
+        help='build the primary keys, foreign keys and join indexes once all data has been loaded')
+    parser.add_argument(
+        '--orphans',
+        choices=ORPHAN_ACTIONS,
+        help='check the foreign keys of orders against the cleaned dimension tables before loading them, and '
+        'report, quarantine or load stub dimension rows for orders whose key is missing')
+    parser.add_argument(
+        '--surrogate-keys',
+        action='store_true',
+        help='number the rows of the dimension tables with integer surrogate keys, which orders_table '
+        'references in place of their natural keys')
+    parser.add_argument(
+        '--stream-s3',
+        action='store_true',
+        help='parse the products and date times in chunks as they are read from s3, '
+        'rather than downloading them to the cache first')
+    parser.add_argument(
+        '--profile-stage',
+        help='dump a cProfile of a stage to profiles/, '
+        'e.g. DataCleaning.clean_user_data')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='only load orders and date times added or changed since the last run, '
+        'upserting them into the existing tables')
+    parser.add_argument(
+        '--stage',
+        choices=STAGES,
+        help='run only this stage, reading its input from and writing its output to '
+        'the staging directory')
+    parser.add_argument(
+        '--staging-dir',
+        help=f'stage the raw and cleaned data as parquet, defaults to {STAGING_DIR} '
+        'when --stage is set')
+    parser.add_argument(
+        '--run-id',
+        help='run id to stage under, defaults to a new run when extracting '
+        'and the latest staged run otherwise')
+    args = parser.parse_args()
+    if args.incremental and args.create_keys:
+        parser.error('--create-keys only applies to a full load')
+    if args.incremental and (args.stage or args.staging_dir):
+        parser.error('--stage and --staging-dir only apply to a full load')
+    if args.create_keys and args.stage not in (None, LOAD):
+        parser.error('--create-keys needs the load stage')
+    if args.incremental and args.surrogate_keys:
+        parser.error('--surrogate-keys only applies to a full load')
+    if args.surrogate_keys and args.stage not in (None, LOAD):
+        parser.error('--surrogate-keys needs the load stage')
+    if args.incremental and args.orphans:
+        parser.error('--orphans only applies to a full load')
+    if args.orphans and args.stage not in (None, LOAD):
+        parser.error('--orphans needs the load stage')
+    return args
+
+
+def setup_staging(args) -> Staging or None:
+    """Returns the staging area for the run, or None if staging is not enabled"""
+    if args.stage is None and args.staging_dir is None:
+        return None
+    staging_dir = args.staging_dir or STAGING_DIR
+    run_id = args.run_id
+    if run_id is None:
+        if args.stage in (None, EXTRACT):
+            run_id = Staging.new_run_id()
+        else:
+            run_id = Staging.latest_run_id(staging_dir)
+    if run_id is None:
+        raise SystemExit(f"Nothing staged in {staging_dir}, run the extract stage first")
+    print(f"Staging run {run_id} in {staging_dir}")
+    return Staging(staging_dir, run_id)
 
 
 if __name__ == '__main__':
+    args = parse_args()
+    if args.profile_stage:
+        # An environment variable so worker processes see it too
+        os.environ[PROFILE_STAGE_ENV] = args.profile_stage
     logger.info(
         '****************************** Starting pipeline ******************************'
     )
-    src_db, src_engine = setup_database(filename='config/db_creds.yaml')
+    _, src_engine = setup_database(filename='config/db_creds.yaml')
     tgt_db, tgt_engine = setup_database(filename='config/db_creds_target.yaml')
 
-    process_user_data(src_db, src_engine, tgt_db, tgt_engine, data_type=user)
-    process_card_data(tgt_db, tgt_engine, data_type=card)
-    process_store_data(tgt_db, tgt_engine, data_type=store)
-    process_product_data(tgt_db, tgt_engine, data_type=product)
-    process_order_data(src_engine, tgt_db, tgt_engine, data_type=order)
-    process_date_times_data(tgt_db, tgt_engine, data_type=date_times)
+    stages = STAGES if args.stage is None else (args.stage,)
+    staging = setup_staging(args)
+    # Workers start on the first submit, while the pipeline threads run, which isn't safe to fork
+    pool = ProcessPoolExecutor(
+        max_workers=args.clean_processes,
+        mp_context=multiprocessing.get_context('forkserver'),
+        initializer=reset_worker) if args.clean_processes else None
+    context = RunContext(source_engine=src_engine,
+                         target_engine=tgt_engine,
+                         target_db=tgt_db,
+                         data_extractor=DataExtractor(stream_s3=args.stream_s3),
+                         cleaning_pool=pool,
+                         stages=stages,
+                         staging=staging,
+                         integrity=ReferentialIntegrity(on_orphans=args.orphans) if args.orphans else None,
+                         surrogate_keys=SurrogateKeys() if args.surrogate_keys else None)
+    if args.incremental:
+        check_natural_keys(tgt_engine)
+        # Orders reference dim_date_times, so upsert new dates first
+        pipelines = [
+            Task('date_times', partial(process_date_times_delta, context, date_times)),
+            Task('order', partial(process_order_delta, context, order), depends_on=['date_times']),
+        ]
+    else:
+        pipelines = [
+            Task(data_type.name.lower(), partial(run_pipeline, data_type, context))
+            for data_type in data_types
+        ]
+        if args.orphans or args.surrogate_keys:
+            # Orders are checked against and mapped to the keys of the dimensions, so load the dimensions first
+            pipelines[data_types.index(order)].depends_on = [
+                dimension.name.lower() for dimension in dimensions
+            ]
+    tasks = list(pipelines)
+    if args.create_keys:
+        tasks.append(
+            Task('create_keys',
+                 partial(create_keys, tgt_db, tgt_engine, args.surrogate_keys),
+                 depends_on=[pipeline.name for pipeline in pipelines]))
+
+    if LOAD in stages:
+        tasks.append(
+            Task('summaries',
+                 partial(summarise_sales, tgt_engine, args.incremental),
+                 depends_on=[pipeline.name for pipeline in pipelines]))
+
+    timings = {}
+    try:
+        with timed('pipeline'):
+            timings = run_tasks(tasks, max_workers=args.workers)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        # Before the run report, which records whether the rejected rows were written
+        write_quarantine(staging, tgt_engine)
+        run_report.write('run_report.json', task_timings=timings)
+
+    for name, seconds in timings.items():
+        print(f"{name:>12}: {seconds:.2f}s")
+
+    # Rows rejected by each validation rule, orders whose foreign key is missing from its dimension, and
+    # rejected rows which failed to be quarantined
+    for stats in run_report.stats():
+        if stats.stage.startswith(('rejected ', 'orphans ', 'quarantine ')) and stats.rows_in > stats.rows_out:
+            print(f"{stats.stage:>48}: {stats.rows_in - stats.rows_out}")
+
+    # Memory of the cleaned tables before and after applying their schema
+    for stats in run_report.stats():
+        if stats.bytes_in:
+            print(f"{stats.stage:>28}: {stats.bytes_in / 2**20:.1f}MiB -> "
+                  f"{stats.bytes_out / 2**20:.1f}MiB")
@@ -0,0 +1,321 @@
+import argparse
+import logging
+from typing import Dict
+
+import pandas as pd
+from sqlalchemy import inspect, text
+
+from config import SALES_SUMMARY_TABLE, STORE_SUMMARY_TABLE, STAGING_DIR
+from database_utils import DatabaseConnector
+from profiling import profile_methods
+from staging import Staging, CLEANED
+from surrogate_keys import join_keys, key_positions
+
+logger = logging.getLogger(__name__)
+
+# Grain of the sales summary, every order report in sql_queries.sql groups by a subset of these
+SALES_KEYS = ['year', 'month', 'store_type', 'country_code']
+
+# Orders joined to the dimensions the reports use, aggregated to the sales summary grain. The joins are on
+# the natural keys, or on the surrogate keys when orders_table was loaded with them, see join_keys.
+# The inner joins match the reports as long as the foreign keys of orders_table hold
+SALES_SUMMARY_SELECT = """
+SELECT dt.year, dt.month, store.store_type, store.country_code,
+       SUM(ord.product_quantity * prod.product_price) AS total_sales,
+       COUNT(*) AS number_of_sales,
+       SUM(ord.product_quantity) AS product_quantity,
+       MIN(dt.date) AS first_sale,
+       MAX(dt.date) AS last_sale
+FROM orders_table ord
+INNER JOIN dim_products prod ON ord.{dim_products} = prod.{dim_products}
+INNER JOIN dim_store_details store ON ord.{dim_store_details} = store.{dim_store_details}
+INNER JOIN dim_date_times dt ON ord.{dim_date_times} = dt.{dim_date_times}
+WHERE ord."index" > :after_index AND ord."index" <= :to_index
+GROUP BY """ + ', '.join(SALES_KEYS) + '\n'
+
+STORE_SUMMARY_SELECT = """
+SELECT country_code, locality,
+       COUNT(*) AS number_stores,
+       COUNT(longitude) AS number_stores_located,
+       SUM(staff_numbers) AS staff_numbers
+FROM dim_store_details
+GROUP BY country_code, locality
+"""
+
+
+@profile_methods
+class SalesSummaries:
+    """
+    This class maintains the pre-aggregated tables the sql_queries.sql reports are served from, so a
+    report reads a few thousand summary rows rather than joining the whole orders_table. Orders are
+    summarised up to a high-watermark on orders_table's index, so orders added by an incremental load are
+    merged into the summary without re-reading the rest.
+    """
+
+    @staticmethod
+    def _max_order_index(connection) -> int:
+        """Returns the largest index of orders_table, the high-watermark of the orders summarised"""
+        return connection.exec_driver_sql('SELECT MAX("index") FROM orders_table').scalar()
+
+    @staticmethod
+    def _sales_summary_select(connection) -> str:
+        """Returns SALES_SUMMARY_SELECT joining orders_table to the dimensions on the keys it was loaded with"""
+        return SALES_SUMMARY_SELECT.format(**join_keys(connection))
+
+    @staticmethod
+    def _rebuild_store_summary(connection):
+        """Replace the store summary, dim_store_details has a few hundred rows so it is always rebuilt"""
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{STORE_SUMMARY_TABLE}"')
+        connection.exec_driver_sql(f'CREATE TABLE "{STORE_SUMMARY_TABLE}" AS {STORE_SUMMARY_SELECT}')
+
+    @staticmethod
+    def build(engine):
+        """This function replaces the summary tables with a summary of every order loaded"""
+        logger.info(f"Build {SALES_SUMMARY_TABLE} and {STORE_SUMMARY_TABLE}")
+        with engine.begin() as conn:
+            to_index = SalesSummaries._max_order_index(conn)
+            conn.exec_driver_sql(f'DROP TABLE IF EXISTS "{SALES_SUMMARY_TABLE}"')
+            conn.execute(text(f'CREATE TABLE "{SALES_SUMMARY_TABLE}" AS '
+                              f'{SalesSummaries._sales_summary_select(conn)}'), {
+                'after_index': -1,
+                'to_index': -1 if to_index is None else to_index
+            })
+            # The key the incremental refresh merges on
+            conn.exec_driver_sql(
+                f'CREATE UNIQUE INDEX "{SALES_SUMMARY_TABLE}_key" ON "{SALES_SUMMARY_TABLE}" '
+                f"({', '.join(SALES_KEYS)})")
+            SalesSummaries._rebuild_store_summary(conn)
+            DatabaseConnector.write_watermark(conn, SALES_SUMMARY_TABLE, to_index)
+
+    @staticmethod
+    def refresh(engine) -> int or None:
+        """
+        This function merges the orders loaded since the summary was last built or refreshed into the
+        sales summary, and rebuilds the store summary. Changes to dimension rows of orders already
+        summarised need a build. Returns the number of orders merged, or None if the summary didn't exist
+        and was built.
+        """
+        after_index = DatabaseConnector.read_watermark(engine, SALES_SUMMARY_TABLE)
+        if after_index is None or not inspect(engine).has_table(SALES_SUMMARY_TABLE):
+            SalesSummaries.build(engine)
+            return None
+        after_index = int(after_index)
+
+        logger.info(f"Refresh {SALES_SUMMARY_TABLE} with orders after {after_index}")
+        least, greatest = ('LEAST', 'GREATEST') if engine.dialect.name == 'postgresql' else ('MIN', 'MAX')
+        merge = ', '.join([
+            *[f"{column} = {SALES_SUMMARY_TABLE}.{column} + EXCLUDED.{column}"
+              for column in ['total_sales', 'number_of_sales', 'product_quantity']],
+            f"first_sale = {least}({SALES_SUMMARY_TABLE}.first_sale, EXCLUDED.first_sale)",
+            f"last_sale = {greatest}({SALES_SUMMARY_TABLE}.last_sale, EXCLUDED.last_sale)",
+        ])
+        with engine.begin() as conn:
+            to_index = SalesSummaries._max_order_index(conn)
+            number_orders = conn.execute(
+                text('SELECT COUNT(*) FROM orders_table WHERE "index" > :after_index'),
+                {'after_index': after_index}).scalar()
+            if number_orders:
+                conn.execute(
+                    text(f'INSERT INTO "{SALES_SUMMARY_TABLE}" ({", ".join(SALES_KEYS)}, total_sales, '
+                         f'number_of_sales, product_quantity, first_sale, last_sale) '
+                         f'{SalesSummaries._sales_summary_select(conn)} '
+                         f'ON CONFLICT ({", ".join(SALES_KEYS)}) DO UPDATE SET {merge}'),
+                    {'after_index': after_index, 'to_index': to_index})
+            SalesSummaries._rebuild_store_summary(conn)
+            DatabaseConnector.write_watermark(conn, SALES_SUMMARY_TABLE, to_index)
+        logger.info(f"Merged {number_orders} orders into {SALES_SUMMARY_TABLE}")
+        return number_orders
+
+
+@profile_methods
+class SalesReports:
+    """
+    This class answers the business questions of sql_queries.sql from the summary tables. Each report
+    returns the columns of its query, with sales rounded to 2 decimal places.
+
+    Attributes:
+        engine: SQL alchemy engine of the target database
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def _sales(self) -> pd.DataFrame:
+        return pd.read_sql_table(SALES_SUMMARY_TABLE, self.engine, parse_dates=['first_sale', 'last_sale'])
+
+    def _stores(self) -> pd.DataFrame:
+        return pd.read_sql_table(STORE_SUMMARY_TABLE, self.engine)
+
+    @staticmethod
+    def _total_sales(df: pd.DataFrame, by: list) -> pd.DataFrame:
+        """Returns total sales grouped by the columns, largest first"""
+        df = df.groupby(by, as_index=False, observed=True)['total_sales'].sum()
+        df['total_sales'] = df['total_sales'].round(2)
+        return df.sort_values('total_sales', ascending=False, kind='stable', ignore_index=True)
+
+    def stores_by_country(self) -> pd.DataFrame:
+        """Task 1. How many stores does the business have & in which countries"""
+        df = self._stores().groupby('country_code', as_index=False)['number_stores_located'].sum()
+        df = df.rename(columns={'country_code': 'country', 'number_stores_located': 'total_no_stores'})
+        return df.sort_values('total_no_stores', ascending=False, kind='stable', ignore_index=True)
+
+    def stores_by_locality(self, limit: int = 7) -> pd.DataFrame:
+        """Task 2. Which locations currently have the most stores"""
+        df = self._stores().groupby('locality', as_index=False,
+                                    dropna=False)['number_stores'].sum()
+        df = df.rename(columns={'number_stores': 'total_no_stores'})
+        return df.sort_values(['total_no_stores', 'locality'], ascending=[False, True],
+                              ignore_index=True).head(limit)
+
+    def sales_by_month(self, limit: int = 6) -> pd.DataFrame:
+        """Task 3. Which months produce the highest sales"""
+        return self._total_sales(self._sales(), ['month'])[['total_sales', 'month']].head(limit)
+
+    def online_sales(self) -> pd.DataFrame:
+        """Task 4. How many sales are coming from online"""
+        df = self._sales()
+        df['location'] = df['store_type'].eq('Web Portal').map({True: 'Web', False: 'Offline'})
+        df = df.groupby('location', as_index=False)[['number_of_sales', 'product_quantity']].sum()
+        df = df.rename(columns={'product_quantity': 'product_quantity_count'})
+        return df.sort_values('number_of_sales', ignore_index=True)[
+            ['number_of_sales', 'product_quantity_count', 'location']]
+
+    def sales_by_store_type(self) -> pd.DataFrame:
+        """Task 5. What percentage of sales come through each type of store"""
+        df = self._sales()
+        all_sales = df['total_sales'].sum()
+        df = df.groupby('store_type', as_index=False)['total_sales'].sum()
+        df['percentage_total(%)'] = (df['total_sales'] / all_sales * 100).round(2)
+        df['total_sales'] = df['total_sales'].round(2)
+        return df.sort_values('total_sales', ascending=False, kind='stable', ignore_index=True)
+
+    def sales_by_year_and_month(self, limit: int = 10) -> pd.DataFrame:
+        """Task 6. Which month in each year produced the most sales"""
+        return self._total_sales(self._sales(),
+                                 ['year', 'month'])[['total_sales', 'year', 'month']].head(limit)
+
+    def staff_by_country(self) -> pd.DataFrame:
+        """Task 7. What is our staff headcount"""
+        df = self._stores().groupby('country_code', as_index=False)['staff_numbers'].sum()
+        df = df.rename(columns={'staff_numbers': 'total_staff_numbers'})
+        return df.sort_values('total_staff_numbers', ascending=False, kind='stable',
+                              ignore_index=True)[['total_staff_numbers', 'country_code']]
+
+    def sales_by_store_type_in(self, country_code: str = 'DE') -> pd.DataFrame:
+        """Task 8. Which store type in a country, Germany by default, is selling the most"""
+        df = self._sales()
+        df = self._total_sales(df[df['country_code'] == country_code], ['store_type', 'country_code'])
+        return df.sort_values('total_sales', kind='stable', ignore_index=True)[
+            ['total_sales', 'store_type', 'country_code']]
+
+    def time_between_sales(self) -> pd.DataFrame:
+        """
+        Task 9. How quickly is the company making sales. The average time between consecutive sales in a
+        year is the time from its first to its last sale over the number of sales less one.
+        """
+        df = self._sales().groupby('year', as_index=False).agg(first_sale=('first_sale', 'min'),
+                                                               last_sale=('last_sale', 'max'),
+                                                               number_of_sales=('number_of_sales', 'sum'))
+        intervals = df['number_of_sales'] - 1
+        df['actual_time_taken'] = (df['last_sale'] - df['first_sale']) / intervals.where(intervals > 0)
+        return df.sort_values('actual_time_taken', ascending=False, kind='stable',
+                              ignore_index=True)[['year', 'actual_time_taken']]
+
+    def all_reports(self) -> Dict[str, pd.DataFrame]:
+        """Returns every report by name"""
+        return {
+            name: getattr(self, name)()
+            for name in [
+                'stores_by_country', 'stores_by_locality', 'sales_by_month', 'online_sales',
+                'sales_by_store_type', 'sales_by_year_and_month', 'staff_by_country',
+                'sales_by_store_type_in', 'time_between_sales'
+            ]
+        }
+
+
+@profile_methods
+class FrameReports(SalesReports):
+    """
+    This class answers the business questions of sql_queries.sql from the cleaned dataframes, without a
+    database. orders are joined to the dimensions once, by the row positions of their keys rather than
+    merging on the key strings, and the reports are computed from that join.
+
+    Attributes:
+        orders: orders joined to the dimension columns the reports use
+        stores: cleaned store details
+    """
+
+    def __init__(self, orders: pd.DataFrame, products: pd.DataFrame, stores: pd.DataFrame,
+                 date_times: pd.DataFrame):
+        self.orders = self.join_orders(orders, products, stores, date_times)
+        self.stores = stores
+
+    @classmethod
+    def from_staging(cls, staging: Staging) -> 'FrameReports':
+        """Returns the reports of the cleaned dataframes of a staged run"""
+        return cls(*[
+            staging.read(table_name, CLEANED)
+            for table_name in ['orders_table', 'dim_products', 'dim_store_details', 'dim_date_times']
+        ])
+
+    @staticmethod
+    def join_orders(orders: pd.DataFrame, products: pd.DataFrame, stores: pd.DataFrame,
+                    date_times: pd.DataFrame) -> pd.DataFrame:
+        """Returns the sales of each order with its store and date, orders missing a dimension row are dropped"""
+        product_rows = key_positions(orders['product_code'], products['product_code'])
+        store_rows = key_positions(orders['store_code'], stores['store_code'])
+        date_rows = key_positions(orders['date_uuid'], date_times['date_uuid'])
+        matched = (product_rows >= 0) & (store_rows >= 0) & (date_rows >= 0)
+        logger.info(f"Joined {matched.sum()} of {len(orders.index)} orders to the dimensions")
+        product_rows, store_rows, date_rows = product_rows[matched], store_rows[matched], date_rows[matched]
+
+        product_quantity = orders['product_quantity'].to_numpy()[matched]
+        return pd.DataFrame({
+            'year': date_times['year'].take(date_rows).array,
+            'month': date_times['month'].take(date_rows).array,
+            'store_type': stores['store_type'].take(store_rows).array,
+            'country_code': stores['country_code'].take(store_rows).array,
+            'date': date_times['date'].take(date_rows).array,
+            'product_quantity': product_quantity,
+            'sales': product_quantity * products['product_price'].to_numpy()[product_rows],
+        })
+
+    def _sales(self) -> pd.DataFrame:
+        df = self.orders.groupby(SALES_KEYS, observed=True).agg(
+            total_sales=('sales', 'sum'),
+            number_of_sales=('sales', 'size'),
+            product_quantity=('product_quantity', 'sum'),
+            first_sale=('date', 'min'),
+            last_sale=('date', 'max')).reset_index()
+        # Group only by the values present, as the summary table does
+        df[SALES_KEYS] = df[SALES_KEYS].astype(object)
+        return df
+
+    def _stores(self) -> pd.DataFrame:
+        df = self.stores.groupby(['country_code', 'locality'], observed=True, dropna=False).agg(
+            number_stores=('store_code', 'size'),
+            number_stores_located=('longitude', 'count'),
+            staff_numbers=('staff_numbers', 'sum')).reset_index()
+        df[['country_code', 'locality']] = df[['country_code', 'locality']].astype(object)
+        return df
+
+    def time_between_sales(self) -> pd.DataFrame:
+        """Task 9. How quickly is the company making sales, the mean gap between sales sorted by date"""
+        df = self.orders[['year', 'date']].sort_values(['year', 'date'], ignore_index=True)
+        df['actual_time_taken'] = df.groupby('year', observed=True)['date'].diff()
+        df = df.groupby('year', observed=True, as_index=False)['actual_time_taken'].mean()
+        df['year'] = df['year'].astype(object)
+        return df.sort_values('actual_time_taken', ascending=False, kind='stable', ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print the sql_queries.sql reports of the cleaned data of a staged run')
+    parser.add_argument('--staging-dir', default=STAGING_DIR)
+    parser.add_argument('--run-id', help='defaults to the latest staged run')
+    args = parser.parse_args()
+    run_id = args.run_id or Staging.latest_run_id(args.staging_dir)
+    if run_id is None:
+        raise SystemExit(f"Nothing staged in {args.staging_dir}, run the clean stage first")
+    for name, report in FrameReports.from_staging(Staging(args.staging_dir, run_id)).all_reports().items():
+        print(f"{name}\n{report.to_string(index=False)}\n")
@@ -0,0 +1,90 @@
+"""
+Benchmark DataCleaning._clean_address against the previous row wise DataFrame.apply
+implementation on synthetic user and store addresses.
+
+Run from the repo root:
+    python -m benchmarks.bench_clean_address [--sizes 15000 150000 1500000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_cleaning import DataCleaning
+
+
+def legacy_update_address(row: pd.Series):
+    address = row['address']
+    columns = ['address', 'address_2', 'address_3', 'address_4']
+    if 'store_code' in row:
+        locality_removed = address.split(',')[:-1]
+        address = "".join(locality_removed)
+    address_lines = address.split('\n')
+    for line, column in zip(address_lines, columns):
+        row[column] = line
+    return row
+
+
+def legacy_clean_address(df: pd.DataFrame) -> pd.DataFrame:
+    """The row wise _clean_address this benchmark compares against"""
+    df['address_2'] = None
+    df['address_3'] = None
+    df['address_4'] = None
+    return df.apply(legacy_update_address, axis=1)
+
+
+def make_addresses(number_rows: int, stores: bool) -> pd.DataFrame:
+    """Returns a dataframe of 2 to 4 line addresses, store addresses end with ', locality'"""
+    rng = np.random.default_rng(0)
+    number_lines = rng.integers(2, 5, number_rows)
+    addresses = [
+        '\n'.join(f"Line {line} of {n}" for line in range(lines))
+        for n, lines in enumerate(number_lines)
+    ]
+    df = pd.DataFrame({
+        'index': np.arange(number_rows, dtype=np.int32),
+        'join_date': pd.date_range('2000-01-01', periods=number_rows, freq='h'),
+        'address': addresses,
+    })
+    if stores:
+        df['address'] = df['address'] + ', Locality'
+        df['store_code'] = 'HI-9B97EE4E'
+        df['lat'] = np.nan
+    return df.set_index('index')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[15000, 150000, 1500000])
+    parser.add_argument('--apply-max-rows',
+                        type=int,
+                        default=150000,
+                        help='skip the apply path above this size, it grows faster than linearly')
+    args = parser.parse_args()
+
+    print(f"{'rows':>9} {'type':>6} {'apply':>8} {'vector':>8} {'speedup':>8}")
+    for number_rows in args.sizes:
+        for stores in (False, True):
+            df = make_addresses(number_rows, stores)
+
+            start = time.perf_counter()
+            df_vectorized = DataCleaning._clean_address(df.copy())
+            vectorized_seconds = time.perf_counter() - start
+            row_type = 'store' if stores else 'user'
+
+            if number_rows > args.apply_max_rows:
+                print(f"{number_rows:>9} {row_type:>6} {'-':>8} {vectorized_seconds:>7.2f}s")
+                continue
+
+            start = time.perf_counter()
+            df_legacy = legacy_clean_address(df.copy())
+            legacy_seconds = time.perf_counter() - start
+
+            pd.testing.assert_frame_equal(df_legacy, df_vectorized)
+            print(f"{number_rows:>9} {row_type:>6} {legacy_seconds:>7.2f}s "
+                  f"{vectorized_seconds:>7.2f}s {legacy_seconds / vectorized_seconds:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main()
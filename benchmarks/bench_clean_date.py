@@ -0,0 +1,89 @@
+"""
+Benchmark DataCleaning._clean_date against the previous row by row implementation on
+synthetic dates in the four formats seen in the source data.
+
+Run from the repo root:
+    python -m benchmarks.bench_clean_date [--rows 1000000]
+"""
+import argparse
+import time
+from time import strptime
+
+import numpy as np
+import pandas as pd
+
+from data_cleaning import DataCleaning
+
+MONTH_NAMES = [
+    'January', 'February', 'March', 'April', 'May', 'June', 'July', 'August',
+    'September', 'October', 'November', 'December'
+]
+MONTHS_WITH_LEADING_ZERO = [f"{month:02d}" for month in range(1, 13)]
+
+
+def legacy_standardize_dob(date: str) -> str:
+    date_split = date.split()
+    if date_split[0].isnumeric():
+        month = strptime(date_split[1], '%B').tm_mon
+        return f"{date_split[0]}-{month:02d}-{date_split[2]}"
+    month = strptime(date_split[0], '%B').tm_mon
+    return f"{date_split[1]}-{month:02d}-{date_split[2]}"
+
+
+def legacy_clean_date(df: pd.DataFrame, column_name: str) -> pd.DataFrame:
+    """The row by row _clean_date this benchmark compares against"""
+    df['month'] = df[column_name].str.slice(5, 7)
+    month_valid_mask = ~df['month'].isin(MONTHS_WITH_LEADING_ZERO)
+    df.loc[month_valid_mask, column_name] = df.loc[month_valid_mask, column_name].apply(
+        legacy_standardize_dob)
+    df = df.drop('month', axis=1)
+    df[column_name] = df[column_name].apply(lambda x: x.replace('/', '-'))
+    df[column_name] = pd.to_datetime(df[column_name])
+    return df
+
+
+def make_dates(number_rows: int) -> pd.DataFrame:
+    """Returns a dataframe of dates, mostly YYYY-MM-DD with the other formats mixed in"""
+    rng = np.random.default_rng(0)
+    years = rng.integers(1940, 2023, number_rows)
+    months = rng.integers(1, 13, number_rows)
+    days = rng.integers(10, 29, number_rows)
+    date_format = rng.choice(4, number_rows, p=[0.97, 0.01, 0.01, 0.01])
+
+    dates = []
+    for year, month, day, fmt in zip(years, months, days, date_format):
+        if fmt == 0:
+            dates.append(f"{year}-{month:02d}-{day:02d}")
+        elif fmt == 1:
+            dates.append(f"{year} {MONTH_NAMES[month - 1]} {day:02d}")
+        elif fmt == 2:
+            # The legacy path misreads 'May YYYY DD' when YYYY[2:] looks like a month, avoid May
+            month = 6 if month == 5 else month
+            dates.append(f"{MONTH_NAMES[month - 1]} {year} {day:02d}")
+        else:
+            dates.append(f"{year}/{month:02d}/{day:02d}")
+    return pd.DataFrame({'join_date': dates})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+    df = make_dates(args.rows)
+
+    start = time.perf_counter()
+    df_legacy = legacy_clean_date(df.copy(), 'join_date')
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_vectorized = DataCleaning()._clean_date(df.copy(), 'join_date')
+    vectorized_seconds = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(df_legacy, df_vectorized)
+    print(f"{args.rows} dates")
+    print(f"row by row: {legacy_seconds:.2f}s")
+    print(f"vectorized: {vectorized_seconds:.2f}s ({legacy_seconds / vectorized_seconds:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark DataCleaning._add_date_column, which assembles the date from the year, month and day as numbers
+and adds the timestamp as a timedelta, against the previous string concatenation parsed by pd.to_datetime.
+Time and peak memory are measured on synthetic date details, by default the size of the source and 10M rows.
+
+Run from the repo root:
+    python -m benchmarks.bench_date_column [--rows 120000 10000000]
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from data_cleaning import DataCleaning
+
+
+def legacy_add_date_column(df: pd.DataFrame) -> pd.DataFrame:
+    """The string concatenation _add_date_column this benchmark compares against"""
+    df['date'] = df['year'] + '-' + df['month'] + '-' + df['day'] + ' ' + df['timestamp']
+    df['date'] = pd.to_datetime(df['date'])
+    return df
+
+
+def make_date_parts(number_rows: int) -> pd.DataFrame:
+    """
+    Returns the year, month, day and timestamp columns of date details as strings, as they are extracted.
+    Repeated values share one string object, as they do when parsed by read_json_columns
+    """
+    rng = np.random.default_rng(0)
+    timestamps = np.array([f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+                           for seconds in range(86400)], dtype=object)
+    numbers = np.array([str(number) for number in range(2023)], dtype=object)
+    return pd.DataFrame({
+        'timestamp': timestamps[rng.integers(0, 86400, number_rows)],
+        'month': numbers[rng.integers(1, 13, number_rows)],
+        'year': numbers[rng.integers(1992, 2023, number_rows)],
+        'day': numbers[rng.integers(1, 29, number_rows)],
+    })
+
+
+def measure(function, df: pd.DataFrame):
+    """Returns the result, time and peak memory of function on a copy of df. Time is measured untraced"""
+    start = time.perf_counter()
+    result = function(df.copy())
+    seconds = time.perf_counter() - start
+    del result
+    df = df.copy()
+    tracemalloc.start()
+    result = function(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[120000, 10000000])
+    args = parser.parse_args()
+
+    for number_rows in args.rows:
+        df = make_date_parts(number_rows)
+        df_legacy, legacy_seconds, legacy_peak = measure(legacy_add_date_column, df)
+        df_numeric, numeric_seconds, numeric_peak = measure(DataCleaning._add_date_column, df)
+        pd.testing.assert_series_equal(df_legacy['date'], df_numeric['date'])
+        del df, df_legacy, df_numeric
+
+        print(f"{number_rows} dates")
+        print(f"    strings: {legacy_seconds:6.2f}s, peak {legacy_peak / 2**20:8.1f}MiB")
+        print(f"    numbers: {numeric_seconds:6.2f}s, peak {numeric_peak / 2**20:8.1f}MiB "
+              f"({legacy_seconds / numeric_seconds:.1f}x faster, {numeric_peak / legacy_peak:.0%} of the memory)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark ReferentialIntegrity.check, which looks up the foreign keys of orders in the keys of the cleaned
+dimension tables, on 10M synthetic orders by default. Users, cards, stores and products are the size of the
+source and each order has its own date, as in the source. The check is timed per foreign key column against
+Series.isin on the dimension keys, with the keys typed as orders were before their schema made the users and
+cards categorical. date_uuid is only timed, Series.isin on its shuffled strings takes minutes.
+
+Run from the repo root:
+    python -m benchmarks.bench_orphan_check [--orders 10000000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import dimensions
+from integrity import ReferentialIntegrity
+
+# Rows of each dimension table in the source, the dates are one per order
+DIMENSION_ROWS = {'dim_users': 15000, 'dim_card_details': 15000, 'dim_store_details': 450, 'dim_products': 1850}
+
+# dtypes of the orders foreign keys before the schema made the users and cards categorical
+PREVIOUS_DTYPES = {'user_uuid': 'string[pyarrow]', 'card_number': object}
+
+
+def make_keys(table_name: str, number_rows: int) -> np.ndarray:
+    """Returns the natural keys of a dimension table"""
+    if table_name == 'dim_card_details':
+        return np.array([f"{4 * 10**15 + n * 7919}" for n in range(number_rows)], dtype=object)
+    if table_name == 'dim_store_details':
+        return np.array([f"WEB-{n:08X}" for n in range(number_rows)], dtype=object)
+    if table_name == 'dim_products':
+        return np.array([f"A{n % 10}-{n:07d}h" for n in range(number_rows)], dtype=object)
+    return np.array([f"{n:08x}-5d6a-4117-874d-9cdb38ca1fa6" for n in range(number_rows)], dtype=object)
+
+
+def make_star(number_orders: int):
+    """Returns the keys of each dimension table, and cleaned orders with one orphan in every thousand keys"""
+    rng = np.random.default_rng(0)
+    rows = {**DIMENSION_ROWS, 'dim_date_times': number_orders}
+    dimension_keys, orders = {}, {}
+    for data_type in dimensions:
+        keys = make_keys(data_type.table_name, rows[data_type.table_name])
+        dimension_keys[data_type.table_name] = pd.Series(keys)
+        if data_type.table_name == 'dim_date_times':
+            # In no particular order, as orders don't follow the date times table
+            order_keys = pd.Series(keys[rng.permutation(len(keys))]).astype('string[pyarrow]')
+            order_keys.iloc[::1000] = 'ffffffff-5d6a-4117-874d-9cdb38ca1fa6'
+        else:
+            # The orphan is a key of a missing dimension row, one more than the rows loaded
+            keys = np.append(keys, make_keys(data_type.table_name, len(keys) + 1)[-1])
+            codes = rng.integers(0, len(keys) - 1, number_orders)
+            codes[::1000] = len(keys) - 1
+            order_keys = pd.Series(pd.Categorical.from_codes(codes, categories=keys))
+        orders[data_type.primary_key] = order_keys
+        del keys
+    return dimension_keys, pd.DataFrame(orders)
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=10000000)
+    args = parser.parse_args()
+
+    dimension_keys, orders = make_star(args.orders)
+    checker = ReferentialIntegrity()
+    for data_type in dimensions:
+        list(checker.check_chunks(data_type, [dimension_keys[data_type.table_name].to_frame(data_type.primary_key)]))
+    # Hash the dimension keys before timing the check
+    key_sets = {data_type.primary_key: checker._key_set(data_type.table_name) for data_type in dimensions}
+    for column, key_set in key_sets.items():
+        key_set.orphans(orders[column].iloc[:1])
+    _, seconds = measure(checker.check, orders)
+    print(f"{args.orders} orders checked in {seconds:.2f}s, orphans: {dict(checker.orphans)}")
+
+    for data_type in dimensions:
+        column = data_type.primary_key
+        orphans, seconds = measure(key_sets[column].orphans, orders[column])
+        if column == 'date_uuid':
+            # Each order has its own date, so there are no categories to look up once each
+            print(f"{column:>16} ({str(orders[column].dtype):>15}): {seconds:6.3f}s")
+            continue
+        previous = orders[column].astype(PREVIOUS_DTYPES.get(column, orders[column].dtype))
+        dimension_column = dimension_keys[data_type.table_name]
+        legacy_orphans, legacy_seconds = measure(lambda: ~previous.isin(dimension_column).to_numpy())
+        np.testing.assert_array_equal(orphans, legacy_orphans)
+        print(f"{column:>16} ({str(orders[column].dtype):>15}): {seconds:6.3f}s, "
+              f"Series.isin ({str(previous.dtype):>15}) {legacy_seconds:6.3f}s")
+
+if __name__ == '__main__':
+    main()
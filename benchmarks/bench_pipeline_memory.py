@@ -0,0 +1,113 @@
+"""
+Benchmark the peak memory of loading date times with the pipeline runner against the previous
+process_date_times_data, which copied the extracted dataframe before cleaning it and held on to it
+until the row hashes were written after the load. Both load into a temporary sqlite database.
+
+Run from the repo root:
+    python -m benchmarks.bench_pipeline_memory [--rows 1200000]
+"""
+import argparse
+from dataclasses import replace
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from config import date_times
+from data_cleaning import DataCleaning
+from data_extraction import DataExtractor
+from database_utils import DatabaseConnector
+from pipeline import RunContext, SourceReader, register_reader, run_pipeline
+
+
+def make_date_details(number_rows: int) -> pd.DataFrame:
+    """Returns raw date details as they are read from s3"""
+    rng = np.random.default_rng(0)
+    periods = np.array(['Morning', 'Midday', 'Evening', 'Late_Hours'], dtype=object)
+    return pd.DataFrame({
+        'timestamp': pd.Series(rng.integers(0, 86400, number_rows)).map(
+            lambda seconds: f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"),
+        'month': rng.integers(1, 13, number_rows).astype(str).astype(object),
+        'year': rng.integers(1992, 2023, number_rows).astype(str).astype(object),
+        'day': rng.integers(1, 29, number_rows).astype(str).astype(object),
+        'time_period': periods[rng.integers(0, 4, number_rows)],
+        'date_uuid': [f"{n:08x}-5d6a-4117-874d-9cdb38ca1fa6" for n in range(number_rows)],
+    })
+
+
+RAW_DATES = {}
+
+
+@register_reader('bench_frames')
+class FramesReader(SourceReader):
+    """Reads the synthetic dates, standing in for s3. It records row hashes as the s3 reader does"""
+
+    def __init__(self, data_type, context):
+        super().__init__(data_type, context)
+        self.row_hashes = []
+
+    def extract(self) -> Iterator[pd.DataFrame]:
+        yield RAW_DATES.pop('raw')
+
+    def watch_raw(self, chunks):
+        for chunk in chunks:
+            self.row_hashes.append(DataExtractor.hash_rows(chunk))
+            yield chunk
+
+    def record_load(self, connection):
+        DatabaseConnector.write_row_hashes(connection, 'bench', pd.concat(self.row_hashes))
+
+
+def legacy_process_date_times(engine, df_extracted: pd.DataFrame):
+    """The previous process_date_times_data, without the extract"""
+    df_cleaned = df_extracted.copy()
+    df_cleaned = DataCleaning(column_entries=date_times.column_entries,
+                              schema=date_times.schema,
+                              rules=date_times.rules).clean_date_times_data(df=df_cleaned)
+    DatabaseConnector.upload_to_db(engine, df=df_cleaned, table_name=date_times.table_name,
+                                   sql_dtypes=date_times.schema.sql_dtypes)
+    with engine.begin() as conn:
+        DatabaseConnector.write_row_hashes(conn, 'bench', DataExtractor.hash_rows(df_extracted))
+
+
+def measure(name: str, function, number_rows: int, work_dir: Path):
+    """Prints the time and the peak memory allocated above the raw dates"""
+    engine = create_engine(f"sqlite:///{work_dir / f'{name}.db'}")
+    raw = make_date_details(number_rows)
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    function(engine, raw)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>8}: {seconds:6.2f}s, peak {(peak - baseline) / 2**20:7.1f}MiB above the raw dates")
+    return peak - baseline
+
+
+def runner(engine, raw: pd.DataFrame):
+    # Hand the raw dates over to the reader, so only the pipeline holds them
+    RAW_DATES['raw'] = raw
+    del raw
+    data_type = replace(date_times, source=replace(date_times.source, kind='bench_frames'))
+    run_pipeline(data_type, RunContext(source_engine=None, target_engine=engine))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1200000, help='date times rows, ten times the source')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        legacy = measure('legacy', legacy_process_date_times, args.rows, Path(work_dir))
+        streamed = measure('runner', runner, args.rows, Path(work_dir))
+    print(f"peak memory {streamed / legacy:.0%} of the legacy path")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark DataCleaning.convert_product_weights against the previous row by row implementation
+on a synthetic product catalogue, by default 1000x the size of products.csv.
+
+Run from the repo root:
+    python -m benchmarks.bench_product_weights [--rows 1853000]
+"""
+import argparse
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import OZ_TO_KG, G_TO_KG, valid_categories
+from data_cleaning import DataCleaning
+
+
+def legacy_weight(weight: str):
+    if 'x' in weight:
+        number_items = weight.split(' ')
+        total_weight = int(number_items[0]) * int(number_items[-1].rstrip('g'))
+        return f"{total_weight / G_TO_KG}"
+    elif 'oz' in weight:
+        return f"{round(int(weight.rstrip('oz')) / OZ_TO_KG, 3)}"
+    elif 'kg' in weight:
+        return float(weight.replace('kg', ''))
+    return f"{float(re.sub(r'g|ml', '', weight)) / G_TO_KG}"
+
+
+def legacy_convert_product_weights(df: pd.DataFrame) -> pd.DataFrame:
+    """The row by row convert_product_weights this benchmark compares against"""
+    df_invalid_chars = df[df['weight'].str.endswith(' .')].copy()
+    df_invalid_chars['weight'] = df_invalid_chars['weight'].str.replace(' .', '')
+    df.update(df_invalid_chars)
+
+    df_rest = df.copy()
+    df_rest['weight'] = df_rest['weight'].apply(legacy_weight)
+    df.update(df_rest)
+
+    df['weight'] = df['weight'].astype('float')
+    return df
+
+
+def make_products(number_rows: int) -> pd.DataFrame:
+    """Returns a dataframe of product weights in each of the formats seen in products.csv"""
+    rng = np.random.default_rng(0)
+    quantity = rng.integers(1, 5000, number_rows)
+    decimal = rng.integers(1, 100, number_rows) / 100
+    formats = rng.choice(6, number_rows, p=[0.4, 0.3, 0.1, 0.1, 0.08, 0.02])
+
+    weights = []
+    for q, d, fmt in zip(quantity, decimal, formats):
+        if fmt == 0:
+            weights.append(f"{q}g")
+        elif fmt == 1:
+            weights.append(f"{q % 40 + d}kg")
+        elif fmt == 2:
+            weights.append(f"{q}ml")
+        elif fmt == 3:
+            weights.append(f"{q % 200}oz")
+        elif fmt == 4:
+            weights.append(f"{q % 12 + 1} x {q % 500}g")
+        else:
+            weights.append(f"{q}g .")
+    return pd.DataFrame({
+        'product_name': 'Product',
+        'weight': weights,
+        'category': rng.choice(valid_categories.entries, number_rows),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1853 * 1000)
+    args = parser.parse_args()
+    df = make_products(args.rows)
+
+    start = time.perf_counter()
+    df_legacy = legacy_convert_product_weights(df.copy())
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_vectorized = DataCleaning().convert_product_weights(df.copy())
+    vectorized_seconds = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(df_legacy, df_vectorized, check_exact=True)
+    print(f"{args.rows} products")
+    print(f"row by row: {legacy_seconds:.2f}s")
+    print(f"vectorized: {vectorized_seconds:.2f}s ({legacy_seconds / vectorized_seconds:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark the peak memory and time of parsing and cleaning a synthetic date_details.json, ten times the
+size of the source by default, read as the body of an s3 object: streamed with DataExtractor.stream_from_s3
+against downloading it and parsing the file whole with pd.read_json as extract_from_s3 does.
+
+Run from the repo root:
+    python -m benchmarks.bench_s3_stream [--rows 1200000]
+"""
+import argparse
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.bench_pipeline_memory import make_date_details
+from config import date_times
+from data_cleaning import DataCleaning
+from data_extraction import DataExtractor
+
+
+class FileS3:
+    """Stand-in for a boto3 s3 client, serving objects from a local directory"""
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def get_object(self, Bucket, Key):
+        return {'Body': open(self.root / Bucket / Key, 'rb')}
+
+
+def make_date_file(path: Path, number_rows: int):
+    """Writes synthetic date details as json, with the NULL and corrupted rows the source has"""
+    df = make_date_details(number_rows)
+    df.iloc[::1000] = 'NULL'
+    df.iloc[500::1000] = 'XSHGSJH'
+    df.to_json(path)
+
+
+def clean(df: pd.DataFrame) -> pd.DataFrame:
+    return DataCleaning(column_entries=date_times.column_entries,
+                        schema=date_times.schema,
+                        rules=date_times.rules).clean_date_times_data(df=df)
+
+
+def downloaded(root: Path, clean_rows: bool) -> int:
+    """Parse the downloaded file whole, as extract_from_s3 does"""
+    df = DataExtractor._read_extract(root / 'bucket' / 'date_details.json')
+    if clean_rows:
+        df = clean(df)
+    return len(df.index)
+
+
+def streamed(root: Path, clean_rows: bool) -> int:
+    """Parse the object body as it is read, cleaning each chunk"""
+    extractor = DataExtractor(s3_client=FileS3(root))
+    number_rows = 0
+    for chunk in extractor.stream_from_s3('s3://bucket/date_details.json'):
+        if clean_rows:
+            chunk = clean(chunk)
+        number_rows += len(chunk.index)
+    return number_rows
+
+
+def measure(name: str, function, *args):
+    """Times a run, then measures the peak memory of another since tracing slows it down"""
+    start = time.perf_counter()
+    number_rows = function(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>24}: {seconds:6.2f}s, peak {peak / 2**20:7.1f}MiB, {number_rows} rows")
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1200000, help='date times rows, ten times the source')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        root = Path(work_dir)
+        (root / 'bucket').mkdir()
+        path = root / 'bucket' / 'date_details.json'
+        make_date_file(path, args.rows)
+        print(f"date_details.json: {path.stat().st_size / 2**20:.1f}MiB, {args.rows} rows")
+
+        for clean_rows in (False, True):
+            stage = 'parse and clean' if clean_rows else 'parse'
+            legacy = measure(f"download, {stage}", downloaded, root, clean_rows)
+            stream = measure(f"stream, {stage}", streamed, root, clean_rows)
+            print(f"{'':>24}  peak memory {stream / legacy:.0%} of the download path")
+
+
+if __name__ == '__main__':
+    main()
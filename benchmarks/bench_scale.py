@@ -0,0 +1,94 @@
+"""
+Benchmark each DataCleaning clean_*_data method, and the full load of every source through the pipelines into
+sqlite, on synthetic sources at several scales of the size of the sources, with pytest-benchmark. The sources
+are read by a stand-in reader, the RDS tables in chunks of RDS_CHUNK_SIZE rows and the other sources whole, as
+their readers do. Scales are set by the BENCHMARK_SCALES environment variable, e.g. BENCHMARK_SCALES=1,10,100.
+
+Save a baseline, then compare later runs to it, which fails a benchmark whose mean is more than 20% slower:
+
+Run from the repo root:
+    python -m pytest benchmarks/bench_scale.py --benchmark-save=baseline
+    python -m pytest benchmarks/bench_scale.py --benchmark-compare --benchmark-compare-fail=mean:20%
+"""
+from dataclasses import replace
+import os
+from typing import Iterator
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+from config import RDS_CHUNK_SIZE, data_types
+from pipeline import RunContext, SourceReader, clean_dataframe, register_reader, run_pipeline, split_chunks
+from profiling import run_report
+from quarantine import quarantine
+from synthetic_data import make_sources
+
+SCALES = [float(scale) for scale in os.environ.get('BENCHMARK_SCALES', '0.1,1,10').split(',')]
+ROUNDS = 3
+
+# Raw sources of the scale being benchmarked by table name, read by the stand-in reader
+SOURCES = {}
+SOURCE_KINDS = {data_type.table_name: data_type.source.kind for data_type in data_types}
+
+
+@register_reader('synthetic')
+class SyntheticReader(SourceReader):
+    """Reads the synthetic sources, standing in for the RDS tables, pdf, store API and s3"""
+
+    def extract(self) -> Iterator[pd.DataFrame]:
+        df = SOURCES[self.source.location]
+        chunks = split_chunks([df], RDS_CHUNK_SIZE) if SOURCE_KINDS[self.source.location] == 'rds_table' else [df]
+        for chunk in chunks:
+            # Cleaning changes the chunks it is given
+            yield chunk.copy()
+
+
+@pytest.fixture(scope='module', params=SCALES, ids=lambda scale: f"scale {scale:g}")
+def sources(request):
+    SOURCES.update(make_sources(request.param))
+    yield SOURCES
+    SOURCES.clear()
+
+
+def reset_run():
+    """Empties the run report and quarantine, which collect the rejected rows of every round"""
+    run_report.reset()
+    quarantine.reset()
+
+
+@pytest.mark.parametrize('data_type', data_types, ids=lambda data_type: data_type.clean_function)
+def test_clean(benchmark, sources, data_type):
+    raw = sources[data_type.table_name]
+    benchmark.group = data_type.clean_function
+
+    def setup():
+        reset_run()
+        return (data_type, raw.copy()), {}
+
+    df = benchmark.pedantic(clean_dataframe, setup=setup, rounds=ROUNDS)
+    assert len(df.index) >= (1 - data_type.max_rejected_fraction) * len(raw.index)
+
+
+def test_full_load(benchmark, sources, tmp_path_factory):
+    """Every pipeline of a full load, one after another so the time is that of the work rather than the scheduler"""
+    benchmark.group = 'full load'
+    stand_ins = [
+        replace(data_type, source=replace(data_type.source, kind='synthetic', location=data_type.table_name))
+        for data_type in data_types
+    ]
+
+    def setup():
+        reset_run()
+        engine = create_engine(f"sqlite:///{tmp_path_factory.mktemp('full_load') / 'target.db'}")
+        return (RunContext(source_engine=None, target_engine=engine), ), {}
+
+    def full_load(context: RunContext):
+        for data_type in stand_ins:
+            run_pipeline(data_type, context)
+        return context
+
+    context = benchmark.pedantic(full_load, setup=setup, rounds=ROUNDS)
+    with context.target_engine.connect() as conn:
+        loaded = conn.exec_driver_sql("SELECT COUNT(*) FROM orders_table").scalar()
+    assert loaded == len(sources['orders_table'].index)
@@ -0,0 +1,64 @@
+"""
+Benchmark DataExtractor.retrieve_stores_data against a local stub store details API.
+Each stub response is delayed to simulate network latency.
+
+Run from the repo root:
+    python -m benchmarks.bench_store_requests
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+from data_extraction import DataExtractor
+
+NUMBER_STORES = 451
+LATENCY_SECONDS = 0.02
+CONCURRENCY_LEVELS = [1, 4, 8, 16, 32]
+
+
+class StubStoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(LATENCY_SECONDS)
+        store_number = int(self.path.rstrip('/').split('/')[-1])
+        body = json.dumps({
+            'index': store_number,
+            'store_code': f"ST-{store_number:04d}"
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubStoreHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/store_details/"
+    extractor = DataExtractor()
+
+    print(f"{NUMBER_STORES} stores, {LATENCY_SECONDS * 1000:.0f}ms latency")
+    print(f"{'workers':>8} {'seconds':>8} {'req/s':>8}")
+    for workers in CONCURRENCY_LEVELS:
+        start = time.perf_counter()
+        df = extractor.retrieve_stores_data(url=url,
+                                            headers={},
+                                            number_stores=NUMBER_STORES,
+                                            max_workers=workers)
+        elapsed = time.perf_counter() - start
+        assert len(df.index) == NUMBER_STORES
+        print(f"{workers:>8} {elapsed:>8.2f} {NUMBER_STORES / elapsed:>8.0f}")
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Benchmark loading the star schema with integer surrogate keys against its natural keys: the time to map the
+foreign keys of orders, the size of orders_table and its join indexes, and the time of the sql_queries.sql
+reports which join orders_table to the dimensions, and of the sales summary build, in sqlite. The dimensions
+are the size of the source, orders are ten times the source by default.
+
+Run from the repo root:
+    python -m benchmarks.bench_surrogate_keys [--orders 1200000]
+"""
+import argparse
+from pathlib import Path
+import tempfile
+import time
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from analytics import SalesSummaries
+from config import dimensions, order
+from database_utils import DatabaseConnector
+from surrogate_keys import SurrogateKeys, join_keys
+
+# The sql_queries.sql reports joining orders_table to the dimensions, in sqlite. Joins are filled in with
+# the key each dimension is joined on
+REPORTS = {
+    'sales_by_month': """
+        SELECT ROUND(SUM(ord.product_quantity * prod.product_price), 2) AS total_sales, dt.month
+        FROM orders_table ord
+        INNER JOIN dim_products prod ON ord.{dim_products} = prod.{dim_products}
+        INNER JOIN dim_date_times dt ON ord.{dim_date_times} = dt.{dim_date_times}
+        GROUP BY dt.month ORDER BY total_sales DESC LIMIT 6""",
+    'online_sales': """
+        SELECT COUNT(*) AS number_of_sales, SUM(ord.product_quantity) AS product_quantity_count,
+               CASE WHEN store.store_type = 'Web Portal' THEN 'Web' ELSE 'Offline' END AS location
+        FROM orders_table ord
+        INNER JOIN dim_products prod ON ord.{dim_products} = prod.{dim_products}
+        INNER JOIN dim_store_details store ON ord.{dim_store_details} = store.{dim_store_details}
+        GROUP BY location ORDER BY number_of_sales""",
+    'sales_by_store_type': """
+        WITH all_stores AS (
+            SELECT SUM(ord.product_quantity * prod.product_price) AS sales
+            FROM orders_table ord
+            INNER JOIN dim_products prod ON ord.{dim_products} = prod.{dim_products}
+            INNER JOIN dim_store_details store ON ord.{dim_store_details} = store.{dim_store_details}
+        ), sales_per_store AS (
+            SELECT store.store_type, ROUND(SUM(ord.product_quantity * prod.product_price), 2) AS total_sales
+            FROM orders_table ord
+            INNER JOIN dim_products prod ON ord.{dim_products} = prod.{dim_products}
+            INNER JOIN dim_store_details store ON ord.{dim_store_details} = store.{dim_store_details}
+            GROUP BY store.store_type
+        ) SELECT sales_per_store.store_type, sales_per_store.total_sales,
+                 ROUND(sales_per_store.total_sales / all_stores.sales * 100, 2) AS "percentage_total(%)"
+        FROM all_stores, sales_per_store ORDER BY sales_per_store.total_sales DESC""",
+    'sales_by_year_and_month': """
+        SELECT ROUND(SUM(ord.product_quantity * prod.product_price), 2) AS total_sales, dt.year, dt.month
+        FROM orders_table ord
+        INNER JOIN dim_products prod ON ord.{dim_products} = prod.{dim_products}
+        INNER JOIN dim_date_times dt ON ord.{dim_date_times} = dt.{dim_date_times}
+        GROUP BY dt.year, dt.month ORDER BY total_sales DESC LIMIT 10""",
+    'sales_by_store_type_in': """
+        SELECT ROUND(SUM(ord.product_quantity * prod.product_price), 2) AS total_sales, store_type, country_code
+        FROM orders_table ord
+        INNER JOIN dim_products prod ON ord.{dim_products} = prod.{dim_products}
+        INNER JOIN dim_store_details store ON ord.{dim_store_details} = store.{dim_store_details}
+        GROUP BY store_type, country_code HAVING country_code = 'DE' ORDER BY total_sales""",
+    'time_between_sales': """
+        WITH interval_table AS (
+            SELECT dt.year, julianday(LEAD(dt.date, 1) OVER (PARTITION BY dt.year ORDER BY dt.date))
+                            - julianday(dt.date) AS time_between_sales
+            FROM orders_table ord
+            INNER JOIN dim_date_times dt ON ord.{dim_date_times} = dt.{dim_date_times}
+        ) SELECT year, AVG(time_between_sales) AS actual_time_taken
+        FROM interval_table GROUP BY year ORDER BY actual_time_taken DESC""",
+}
+
+
+def uuids(rng, number_rows: int) -> np.ndarray:
+    return np.array([f"{n:08x}-{rng.integers(2**16):04x}-4117-874d-9cdb38ca1fa6" for n in range(number_rows)],
+                    dtype=object)
+
+
+def make_star(number_orders: int) -> Dict[str, pd.DataFrame]:
+    """Returns cleaned dimension tables the size of the source, and orders referencing them by natural keys"""
+    rng = np.random.default_rng(0)
+    number_dates = 120000
+    dates = pd.Timestamp('1992-01-01') + pd.to_timedelta(rng.integers(0, 31 * 365 * 86400, number_dates), 's')
+    frames = {
+        'dim_users': pd.DataFrame({'user_uuid': uuids(rng, 15000)}),
+        'dim_card_details': pd.DataFrame({
+            'card_number': rng.integers(10**15, 10**16, 15000).astype(str).astype(object)
+        }),
+        'dim_store_details': pd.DataFrame({
+            'store_code': [f"{code}-{n:08X}" for n, code in enumerate(rng.choice(['WEB', 'HI', 'MU'], 450))],
+            'store_type': rng.choice(['Web Portal', 'Local', 'Super Store', 'Outlet'], 450),
+            'country_code': rng.choice(['GB', 'DE', 'US'], 450),
+            'locality': rng.choice(['High Wycombe', 'Munich', 'New York'], 450),
+            'longitude': rng.uniform(-1, 12, 450),
+            'staff_numbers': rng.integers(10, 100, 450),
+        }),
+        'dim_products': pd.DataFrame({
+            'product_code': [f"A{n % 10}-{n:07d}h" for n in range(1850)],
+            'product_price': rng.uniform(1, 100, 1850).round(2),
+        }),
+        'dim_date_times': pd.DataFrame({
+            'date_uuid': uuids(rng, number_dates),
+            'year': dates.year.astype(str),
+            'month': dates.month.astype(str),
+            'date': dates,
+        }),
+    }
+    orders = {
+        data_type.primary_key: frames[data_type.table_name][data_type.primary_key].to_numpy()[
+            rng.integers(0, len(frames[data_type.table_name].index), number_orders)]
+        for data_type in dimensions
+    }
+    frames['orders_table'] = pd.DataFrame({
+        **orders, 'product_quantity': rng.integers(1, 14, number_orders).astype(np.int16)
+    }).astype({'store_code': 'category', 'product_code': 'category'})
+    return frames
+
+
+def load(engine, frames: Dict[str, pd.DataFrame], surrogate_keys: SurrogateKeys or None) -> float:
+    """Loads the star and builds its keys, returns the seconds taken to map the foreign keys of orders"""
+    seconds = 0
+    for data_type in [*dimensions, order]:
+        df, sql_dtypes = frames[data_type.table_name], data_type.schema.sql_dtypes
+        if surrogate_keys is not None:
+            start = time.perf_counter()
+            df, = surrogate_keys.map_chunks(data_type, [df])
+            if data_type is order:
+                seconds = time.perf_counter() - start
+            sql_dtypes = surrogate_keys.sql_dtypes(data_type)
+        sql_dtypes = {column: sql_dtype for column, sql_dtype in sql_dtypes.items() if column in df.columns}
+        DatabaseConnector.upload_to_db(engine, df=df, table_name=data_type.table_name, sql_dtypes=sql_dtypes)
+
+    keys = join_keys(engine)
+    DatabaseConnector.finalise_load(
+        engine,
+        primary_keys=keys,
+        table_name=order.table_name,
+        foreign_keys={column: table_name for table_name, column in keys.items()},
+        unique_keys={data_type.table_name: data_type.primary_key
+                     for data_type in dimensions} if surrogate_keys is not None else None)
+    return seconds
+
+
+def table_sizes(engine) -> Dict[str, int]:
+    """Returns the bytes of orders_table and of its join indexes"""
+    with engine.connect() as conn:
+        sizes = dict(conn.exec_driver_sql("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").all())
+    return {
+        'orders_table': sizes['orders_table'],
+        'join indexes': sum(size for name, size in sizes.items() if name.startswith('ix_orders_table_')),
+    }
+
+
+def time_query(engine, sql: str, repeat: int) -> float:
+    """Returns the best of repeat runs of a query"""
+    best = float('inf')
+    with engine.connect() as conn:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.exec_driver_sql(sql).all()
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_summary(engine) -> float:
+    start = time.perf_counter()
+    SalesSummaries.build(engine)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=1200000, help='orders rows, ten times the source')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each query, the best is reported')
+    args = parser.parse_args()
+
+    frames = make_star(args.orders)
+    with tempfile.TemporaryDirectory() as work_dir:
+        natural = create_engine(f"sqlite:///{Path(work_dir) / 'natural.db'}")
+        surrogate = create_engine(f"sqlite:///{Path(work_dir) / 'surrogate.db'}")
+        load(natural, frames, None)
+        mapping_seconds = load(surrogate, frames, SurrogateKeys())
+        print(f"{args.orders} orders, foreign keys mapped to surrogate keys in {mapping_seconds:.2f}s")
+
+        natural_sizes, surrogate_sizes = table_sizes(natural), table_sizes(surrogate)
+        for name, size in natural_sizes.items():
+            print(f"{name:>24}: {size / 2**20:8.1f}MiB -> {surrogate_sizes[name] / 2**20:8.1f}MiB "
+                  f"({surrogate_sizes[name] / size:.0%})")
+
+        total = {'natural': 0, 'surrogate': 0}
+        for name, sql in REPORTS.items():
+            natural_seconds = time_query(natural, sql.format(**join_keys(natural)), args.repeat)
+            surrogate_seconds = time_query(surrogate, sql.format(**join_keys(surrogate)), args.repeat)
+            # Both schemas give the same report
+            pd.testing.assert_frame_equal(pd.read_sql_query(sql.format(**join_keys(natural)), natural),
+                                          pd.read_sql_query(sql.format(**join_keys(surrogate)), surrogate))
+            total['natural'] += natural_seconds
+            total['surrogate'] += surrogate_seconds
+            print(f"{name:>24}: {natural_seconds:6.2f}s -> {surrogate_seconds:6.2f}s "
+                  f"({natural_seconds / surrogate_seconds:.1f}x faster)")
+        print(f"{'reports':>24}: {total['natural']:6.2f}s -> {total['surrogate']:6.2f}s "
+              f"({total['natural'] / total['surrogate']:.1f}x faster)")
+
+        natural_seconds, surrogate_seconds = time_summary(natural), time_summary(surrogate)
+        print(f"{'sales summary build':>24}: {natural_seconds:6.2f}s -> {surrogate_seconds:6.2f}s "
+              f"({natural_seconds / surrogate_seconds:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
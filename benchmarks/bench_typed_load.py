@@ -0,0 +1,184 @@
+"""
+Benchmark loading the six tables with their final types and primary keys up front against the
+previous sequence of loading loosely typed tables and then running the cast, update and primary key
+scripts in benchmarks/legacy_sql_scripts, each of which rewrites a whole table.
+
+Needs a Postgres database, by default the target database in config/db_creds_target.yaml. The
+tables are created in a bench_typed_load schema, which is dropped at the end.
+
+Run from the repo root:
+    python -m benchmarks.bench_typed_load [--url postgresql+psycopg2://...] [--orders 120123]
+"""
+import argparse
+from pathlib import Path
+import time
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from config import card, user, store, order, product, date_times, DataType
+from data_cleaning import DataCleaning
+from database_utils import DatabaseConnector
+
+SCHEMA = 'bench_typed_load'
+LEGACY_SCRIPTS = Path(__file__).parent / 'legacy_sql_scripts'
+
+
+def uuids(rng, number_rows: int) -> list:
+    return [
+        f"{a:08x}-{b:04x}-4{b % 4096:03x}-8{a % 4096:03x}-{a:08x}{b:04x}"
+        for a, b in zip(rng.integers(0, 2**32, number_rows), rng.integers(0, 2**16, number_rows))
+    ]
+
+
+def make_tables(number_orders: int) -> List[Tuple[DataType, pd.DataFrame]]:
+    """Returns dataframes shaped like the output of the previous cleaning, before the sql scripts ran"""
+    rng = np.random.default_rng(0)
+    number_users, number_stores, number_products = number_orders // 8, 441, 1846
+    dates = pd.Timestamp('1990-01-01') + pd.to_timedelta(rng.integers(0, 12000, number_orders), 'D')
+
+    users = pd.DataFrame({
+        'first_name': 'Sigfried',
+        'last_name': 'Noack',
+        'date_of_birth': dates[:number_users],
+        'company': 'Heydrich Junitz KG',
+        'email_address': 'rudi79@winkler.de',
+        'address': 'Zimmerstr. 1/0',
+        'country': 'Germany',
+        'country_code': rng.choice(['DE', 'GB', 'US'], number_users),
+        'phone_number': '+49(0) 047905356',
+        'join_date': dates[-number_users:],
+        'user_uuid': uuids(rng, number_users),
+    }).rename_axis('index')
+    cards = pd.DataFrame({
+        'card_number': rng.integers(10**15, 10**16, number_users).astype(str),
+        'expiry_date': '09/26',
+        'card_provider': 'VISA 16 digit',
+        'date_payment_confirmed': dates[:number_users],
+    })
+    stores = pd.DataFrame({
+        'address': 'Flat 72W\nSally isle',
+        'longitude': rng.uniform(-180, 180, number_stores).round(5).astype(str),
+        'lat': None,
+        'locality': 'High Wycombe',
+        'store_code': [f"HI-{n:08X}" for n in range(number_stores)],
+        'staff_numbers': rng.integers(1, 100, number_stores).astype(np.uint16),
+        'opening_date': dates[:number_stores],
+        'store_type': rng.choice(['Local', 'Super Store', 'Mall Kiosk', 'Outlet'], number_stores),
+        'latitude': rng.uniform(-90, 90, number_stores).round(5).astype(str),
+        'country_code': 'GB',
+        'continent': 'Europe',
+    }).rename_axis('index')
+    products = pd.DataFrame({
+        'product_name': 'Dog food',
+        'product_price': [f"£{price:.2f}" for price in rng.uniform(1, 500, number_products)],
+        'weight': rng.uniform(0.01, 200, number_products).round(3),
+        'category': 'pets',
+        'EAN': rng.integers(10**12, 10**13, number_products).astype(str),
+        'date_added': dates[:number_products],
+        'uuid': uuids(rng, number_products),
+        'removed': rng.choice(['Still_avaliable', 'Removed'], number_products),
+        'product_code': [f"A{n % 10}-{n:07d}S" for n in range(number_products)],
+    }).rename_axis('index')
+    date_uuids = uuids(rng, number_orders)
+    date_details = pd.DataFrame({
+        'timestamp': '22:00:06',
+        'month': dates.month.astype(str),
+        'year': dates.year.astype(str),
+        'day': dates.day.astype(str),
+        'time_period': 'Evening',
+        'date_uuid': date_uuids,
+        'date': dates,
+    })
+    orders = pd.DataFrame({
+        'date_uuid': date_uuids,
+        'user_uuid': rng.choice(users['user_uuid'], number_orders),
+        'card_number': rng.choice(cards['card_number'], number_orders),
+        'store_code': rng.choice(stores['store_code'], number_orders),
+        'product_code': rng.choice(products['product_code'], number_orders),
+        'product_quantity': rng.integers(1, 14, number_orders),
+    }).rename_axis('index')
+    return [
+        (user, users),
+        (card, cards),
+        (store, stores),
+        (product, products),
+        (date_times, date_details),
+        (order, orders),
+    ]
+
+
+def derive_columns(data_type: DataType, df: pd.DataFrame) -> pd.DataFrame:
+    """Derive the columns the sql scripts used to, as cleaning now does"""
+    if data_type is product:
+        df = DataCleaning._clean_product_price(df.copy())
+        df = DataCleaning._add_weight_class(df)
+        df = DataCleaning._set_still_available(df)
+    elif data_type is store:
+        df = DataCleaning._update_store_web_details(df.copy())
+        df = DataCleaning._cast_store_coordinates(df)
+    return df
+
+
+def reset_schema(engine):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.exec_driver_sql(f"CREATE SCHEMA {SCHEMA}")
+
+
+def load_then_alter(engine, tables: List[Tuple[DataType, pd.DataFrame]]):
+    """The previous load: loosely typed tables, then the scripts rewrite them"""
+    for data_type, df in tables:
+        DatabaseConnector.upload_to_db(engine, df=df, table_name=data_type.table_name)
+    for script in sorted(LEGACY_SCRIPTS.glob('*.sql'), key=lambda path: int(path.name.split('_')[0])):
+        DatabaseConnector.run_sql_script(engine, filename=str(script))
+
+
+def typed_load(engine, tables: List[Tuple[DataType, pd.DataFrame]]):
+    """The typed load: derive columns in pandas, create each table with its types and key, load once"""
+    for data_type, df in tables:
+        DatabaseConnector.upload_to_db(
+            engine,
+            df=derive_columns(data_type, df),
+            table_name=data_type.table_name,
+            sql_dtypes=data_type.schema.sql_dtypes,
+            primary_key=None if data_type is order else data_type.primary_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', help='SQLAlchemy Postgres database url')
+    parser.add_argument('--orders', type=int, default=120123)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.url:
+        url = args.url
+    else:
+        db_conn = DatabaseConnector()
+        url = db_conn.init_db_engine(db_conn.read_db_creds('config/db_creds_target.yaml')).url
+    engine = create_engine(url, connect_args={'options': f"-csearch_path={SCHEMA}"})
+    if engine.dialect.name != 'postgresql':
+        parser.error('the legacy scripts need a Postgres database')
+
+    tables = make_tables(args.orders)
+    print(f"Loading {sum(len(df.index) for _, df in tables)} rows, best of {args.repeat}")
+    print(f"{'load':>18} {'seconds':>8}")
+    try:
+        for name, load in {'load then ALTER': load_then_alter, 'typed DDL': typed_load}.items():
+            best = float('inf')
+            for _ in range(args.repeat):
+                reset_schema(engine)
+                start = time.perf_counter()
+                load(engine, tables)
+                best = min(best, time.perf_counter() - start)
+            print(f"{name:>18} {best:>8.2f}")
+    finally:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark DatabaseConnector.upload_to_db throughput (rows/sec) for COPY FROM STDIN against the
+to_sql INSERT fallback. Needs a Postgres database, by default the target database in
+config/db_creds_target.yaml. A sqlite url can be passed as a stand-in, which only runs the
+INSERT path.
+
+Run from the repo root:
+    python -m benchmarks.bench_upload [--url postgresql+psycopg2://...] [--rows 120123]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from database_utils import DatabaseConnector
+
+TABLE_NAME = 'bench_orders_table'
+
+
+def make_orders(number_rows: int) -> pd.DataFrame:
+    """Returns a dataframe shaped like the cleaned orders_table"""
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'index': np.arange(number_rows),
+        'date_uuid': [f"{n:08x}-1c8a-4d62-8c61-b8e4f4a2d7f3" for n in range(number_rows)],
+        'user_uuid': [f"{n:08x}-93b3-4ad2-9d36-0e4b0a6c9c3e" for n in range(number_rows)],
+        'card_number': rng.integers(10**15, 10**16, number_rows).astype(str),
+        'store_code': 'WEB-1388012W',
+        'product_code': 'A8-4686892S',
+        'product_quantity': rng.integers(1, 14, number_rows),
+    })
+    return df.set_index('index')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', help='SQLAlchemy database url')
+    parser.add_argument('--rows', type=int, default=120123)
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        db_conn = DatabaseConnector()
+        engine = db_conn.init_db_engine(
+            db_conn.read_db_creds('config/db_creds_target.yaml'))
+
+    df = make_orders(args.rows)
+    methods = {'to_sql INSERT': False}
+    if engine.dialect.name == 'postgresql':
+        methods['COPY FROM STDIN'] = True
+
+    print(f"Uploading {args.rows} rows to {engine.dialect.name}")
+    print(f"{'method':>16} {'seconds':>8} {'rows/s':>10}")
+    for name, bulk_copy in methods.items():
+        start = time.perf_counter()
+        DatabaseConnector.upload_to_db(engine, df=df, table_name=TABLE_NAME, bulk_copy=bulk_copy)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>16} {elapsed:>8.2f} {args.rows / elapsed:>10.0f}")
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {TABLE_NAME}"))
+
+
+if __name__ == '__main__':
+    main()
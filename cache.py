@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """
+    This class is a content addressed file cache on the local disk. Entries are named by a hash of
+    whatever identifies their contents (e.g. s3 bucket, key and ETag), so a changed source gets a
+    new entry. Once the cache is larger than max_bytes the least recently used entries are removed.
+
+    Attributes:
+        cache_dir: Directory the cached files are written to
+        max_bytes: Size the cache is trimmed to after each write
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Returns a hash of the parts which identify a cache entry"""
+        return hashlib.sha256('/'.join(str(part) for part in parts).encode()).hexdigest()
+
+    def path(self, key: str, suffix: str) -> Path:
+        """Returns the path of the cache entry, it may not exist yet"""
+        return self.cache_dir / f"{key}{suffix}"
+
+    def get(self, key: str, suffix: str) -> Path or None:
+        """Returns the path of the cache entry if it exists, marking it as recently used"""
+        path = self.path(key, suffix)
+        if not path.exists():
+            logger.debug(f"Cache miss {path}")
+            return None
+        logger.debug(f"Cache hit {path}")
+        os.utime(path)
+        return path
+
+    def put(self, key: str, suffix: str, write: Callable[[Path], None]) -> Path:
+        """
+        Calls write with a temporary path, then moves the written file into the cache.
+        Returns the path of the cache entry.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(key, suffix)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            write(tmp_path)
+            tmp_path.replace(path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        logger.debug(f"Cached {path}")
+        self.evict(keep=path)
+        return path
+
+    def remove(self, key: str, suffix: str):
+        """Remove the cache entry if it exists"""
+        self.path(key, suffix).unlink(missing_ok=True)
+
+    def evict(self, keep: Path = None):
+        """Remove the least recently used entries until the cache is no larger than max_bytes"""
+        entries = []
+        for path in self.cache_dir.iterdir():
+            if path.is_file() and not path.name.startswith('.'):
+                stat = path.stat()
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+            logger.info(f"Evicted {path} from cache")
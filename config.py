@@ -1,15 +1,69 @@
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.types import DATE, SMALLINT, TIMESTAMP, VARCHAR, Uuid
+
+from validation import AllowedValues, InRange, Matches, NotNull, Rule, Unique
 
 OZ_TO_KG = 35.274
 G_TO_KG = 1000
 M_TO_KG = .001
 
+# Store details API request settings
+STORE_API_MAX_WORKERS = 16
+REQUEST_TIMEOUT = 10
+REQUEST_RETRIES = 3
+REQUEST_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# Number of rows per chunk when streaming tables from the RDS database
+RDS_CHUNK_SIZE = 10000
+# Most rows loaded at once, larger cleaned chunks are loaded in slices so the rows being written stay small
+LOAD_CHUNK_SIZE = 20000
+
+# Local cache of extracted files, least recently used files are removed above CACHE_MAX_BYTES
+CACHE_DIR = '.cache'
+CACHE_MAX_BYTES = 1024**3
+# Cache s3 extracts as parquet so repeat runs skip parsing the csv/json
+CACHE_AS_PARQUET = False
+# Parse s3 csv/json extracts as they are read from s3 rather than downloading them to the cache first.
+# Bytes read from s3 at a time, and rows per chunk of the parsed extract
+STREAM_S3 = False
+S3_READ_BLOCK_SIZE = 2**20
+S3_CHUNK_SIZE = 200000
+
+# Staged stage outputs, partitioned by source and run id, see staging.py
+STAGING_DIR = 'staging'
+STAGING_COMPRESSION = 'zstd'
+
+# Target tables holding the high-watermark and row hashes of each source for incremental loads
+WATERMARK_TABLE = 'pipeline_watermarks'
+ROW_HASH_TABLE = 'pipeline_row_hashes'
+
+# Connections used at once to build the primary keys and indexes once a full load has finished
+FINALISE_MAX_WORKERS = 6
+
+# Pre-aggregated tables the sql_queries.sql reports are served from, see analytics.py
+SALES_SUMMARY_TABLE = 'sales_summary'
+STORE_SUMMARY_TABLE = 'store_summary'
+
+# Pdf pages are parsed in batches of PDF_PAGES_PER_BATCH across PDF_MAX_WORKERS processes
+PDF_PAGES_PER_BATCH = 50
+PDF_MAX_WORKERS = 4
+
 
 @dataclass
 class ColumnEntries:
     column_name: str
     entries: List
+    # Known typos and the entry they should be
+    corrections: Dict = None
+
+    def rule(self) -> AllowedValues:
+        """Returns the rule rejecting rows whose column_name is not one of the entries"""
+        return AllowedValues(self.column_name, values=self.entries, corrections=self.corrections)
 
 
 valid_months = ColumnEntries(
@@ -22,7 +76,8 @@ valid_categories = ColumnEntries(column_name='category',
                                      'food-and-drink', 'diy'
                                  ])
 valid_country_codes = ColumnEntries(column_name='country_code',
-                                    entries=['DE', 'GB', 'US'])
+                                    entries=['DE', 'GB', 'US'],
+                                    corrections={'GGB': 'GB'})
 valid_card_providers = ColumnEntries(
     column_name='card_provider',
     entries=[
@@ -52,47 +107,245 @@ endpoints = Endpoints(
     date_times='s3://data-handling-public/date_details.json')
 
 
+@dataclass
+class Schema:
+    """
+    Target dtypes of a table's cleaned columns, applied at the end of cleaning to cut memory.
+    Categorical dtypes with categories only accept those entries.
+    sql_dtypes are the column types the table is created with, other columns take the type to_sql infers.
+    """
+    table_name: str
+    dtypes: Dict
+    sql_dtypes: Dict = None
+
+
+def categories(column_entries: ColumnEntries) -> pd.CategoricalDtype:
+    """Returns a categorical dtype of the valid entries"""
+    return pd.CategoricalDtype(column_entries.entries)
+
+
+# Strings backed by pyarrow take a fraction of the memory of python strings, used for uuids and codes
+UUID_DTYPE = 'string[pyarrow]'
+# uuids are loaded from their string form
+UUID = Uuid(as_uuid=False)
+
+WEIGHT_CLASSES = ['Light', 'Mid_Sized', 'Heavy', 'Truck_Required']
+
+card_schema = Schema(table_name='dim_card_details',
+                     dtypes={
+                         'card_number': UUID_DTYPE,
+                         'expiry_date': 'category',
+                         'card_provider': categories(valid_card_providers),
+                     },
+                     sql_dtypes={
+                         'card_number': VARCHAR(19),
+                         'expiry_date': VARCHAR(5),
+                         'date_payment_confirmed': DATE,
+                     })
+
+user_schema = Schema(table_name='dim_users',
+                     dtypes={
+                         'country': 'category',
+                         'country_code': categories(valid_country_codes),
+                         'user_uuid': UUID_DTYPE,
+                     },
+                     sql_dtypes={
+                         'first_name': VARCHAR(255),
+                         'last_name': VARCHAR(255),
+                         'date_of_birth': DATE,
+                         'country_code': VARCHAR(2),
+                         'user_uuid': UUID,
+                         'join_date': DATE,
+                     })
+
+store_schema = Schema(table_name='dim_store_details',
+                      dtypes={
+                          'store_code': UUID_DTYPE,
+                          'staff_numbers': np.uint16,
+                          'store_type': 'category',
+                          'country_code': categories(valid_country_codes),
+                          'continent': pd.CategoricalDtype(['Europe', 'America']),
+                      },
+                      sql_dtypes={
+                          'locality': VARCHAR(255),
+                          'store_code': VARCHAR(12),
+                          'staff_numbers': SMALLINT,
+                          'opening_date': DATE,
+                          'store_type': VARCHAR(255),
+                          'country_code': VARCHAR(2),
+                          'continent': VARCHAR(255),
+                      })
+
+product_schema = Schema(table_name='dim_products',
+                        dtypes={
+                            'category': categories(valid_categories),
+                            'uuid': UUID_DTYPE,
+                            'product_code': UUID_DTYPE,
+                            'weight_class': pd.CategoricalDtype(WEIGHT_CLASSES),
+                        },
+                        sql_dtypes={
+                            'EAN': VARCHAR(19),
+                            'product_code': VARCHAR(11),
+                            'date_added': DATE,
+                            'uuid': UUID,
+                            'weight_class': VARCHAR(15),
+                        })
+
+# Orders repeat the few thousand users, cards, stores and products, so those keys are categorical, which is
+# also what the referential integrity check looks up. Each order has its own date
+order_schema = Schema(table_name='orders_table',
+                      dtypes={
+                          'date_uuid': UUID_DTYPE,
+                          'user_uuid': 'category',
+                          'card_number': 'category',
+                          'store_code': 'category',
+                          'product_code': 'category',
+                          'product_quantity': np.int16,
+                      },
+                      sql_dtypes={
+                          'date_uuid': UUID,
+                          'user_uuid': UUID,
+                          'card_number': VARCHAR(19),
+                          'store_code': VARCHAR(12),
+                          'product_code': VARCHAR(11),
+                      })
+
+date_times_schema = Schema(table_name='dim_date_times',
+                           dtypes={
+                               'month': categories(valid_months),
+                               'year': 'category',
+                               'day': 'category',
+                               'time_period': 'category',
+                               'date_uuid': UUID_DTYPE,
+                               'date': 'datetime64[ns]',
+                           },
+                           sql_dtypes={
+                               'month': VARCHAR(2),
+                               'year': VARCHAR(4),
+                               'day': VARCHAR(2),
+                               'time_period': VARCHAR(10),
+                               'date_uuid': UUID,
+                               'date': TIMESTAMP,
+                           })
+
+
+UUID_PATTERN = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+
+
+@dataclass
+class Source:
+    """
+    Where a DataType is extracted from. kind names the reader registered in pipeline.py which extracts it,
+    location is the table, url or file it reads. Incremental sources record what was loaded for the next
+    incremental run.
+    """
+    kind: str
+    location: str
+    incremental: bool = False
+
+
 @dataclass
 class DataType:
+    """
+    A source and the table it is loaded to, cleaned by the DataCleaning method named by clean_function.
+    Rows failing any of the rules are rejected during cleaning, if more than max_rejected_fraction of
+    the rows are rejected cleaning fails. Dimension tables loaded with surrogate keys number their rows
+    in the surrogate_key column, which orders_table references in place of the primary_key. source_rows is the
+    number of rows in the source, which synthetic sources are scaled from.
+    """
     name: str
-    extracted_count: int
-    clean_count: int
     table_name: str
     column_entries: ColumnEntries or None
+    primary_key: str = None
+    schema: Schema = None
+    rules: List[Rule] = None
+    max_rejected_fraction: float = 0.01
+    source: Source = None
+    clean_function: str = None
+    surrogate_key: str = None
+    source_rows: int = None
 
 
 card = DataType(name='Card',
-                extracted_count=15309,
-                clean_count=15284,
                 table_name='dim_card_details',
-                column_entries=valid_card_providers)
+                column_entries=valid_card_providers,
+                primary_key='card_number',
+                schema=card_schema,
+                rules=[valid_card_providers.rule(), Unique('card_number')],
+                source=Source(kind='pdf', location=endpoints.card_data),
+                clean_function='clean_card_data',
+                surrogate_key='card_key',
+                source_rows=15309)
 
 user = DataType(name='User',
-                extracted_count=15320,
-                clean_count=15284,
                 table_name='dim_users',
-                column_entries=valid_country_codes)
+                column_entries=valid_country_codes,
+                primary_key='user_uuid',
+                schema=user_schema,
+                rules=[
+                    valid_country_codes.rule(),
+                    Matches('user_uuid', pattern=UUID_PATTERN),
+                    Unique('user_uuid'),
+                ],
+                source=Source(kind='rds_table', location='legacy_users'),
+                clean_function='clean_user_data',
+                surrogate_key='user_key',
+                source_rows=15320)
 
 store = DataType(name='Store',
-                 extracted_count=451,
-                 clean_count=441,
                  table_name='dim_store_details',
-                 column_entries=valid_country_codes)
+                 column_entries=valid_country_codes,
+                 primary_key='store_code',
+                 schema=store_schema,
+                 rules=[
+                     valid_country_codes.rule(),
+                     NotNull('store_code'),
+                     Unique('store_code'),
+                 ],
+                 max_rejected_fraction=0.05,
+                 source=Source(kind='store_api', location=endpoints.store_details),
+                 clean_function='clean_store_data',
+                 surrogate_key='store_key',
+                 source_rows=451)
 
 product = DataType(name='Product',
-                   extracted_count=1853,
-                   clean_count=1846,
                    table_name='dim_products',
-                   column_entries=valid_categories)
+                   column_entries=valid_categories,
+                   primary_key='product_code',
+                   schema=product_schema,
+                   rules=[valid_categories.rule(), NotNull('product_code'), Unique('product_code')],
+                   source=Source(kind='s3', location=endpoints.products),
+                   clean_function='clean_product_data',
+                   surrogate_key='product_key',
+                   source_rows=1853)
 
 order = DataType(name='Order',
-                 extracted_count=120123,
-                 clean_count=120123,
                  table_name='orders_table',
-                 column_entries=None)
+                 column_entries=None,
+                 primary_key='index',
+                 schema=order_schema,
+                 rules=[],
+                 source=Source(kind='rds_table', location='orders_table', incremental=True),
+                 clean_function='clean_order_data',
+                 source_rows=120123)
 
 date_times = DataType(name='Date_Times',
-                      extracted_count=120161,
-                      clean_count=120123,
                       table_name='dim_date_times',
-                      column_entries=valid_months)
+                      column_entries=valid_months,
+                      primary_key='date_uuid',
+                      schema=date_times_schema,
+                      rules=[
+                          valid_months.rule(),
+                          InRange('day', minimum=1, maximum=31),
+                          Matches('date_uuid', pattern=UUID_PATTERN),
+                          Unique('date_uuid'),
+                      ],
+                      source=Source(kind='s3', location=endpoints.date_times, incremental=True),
+                      clean_function='clean_date_times_data',
+                      surrogate_key='date_key',
+                      source_rows=120161)
+
+# Every DataType of a full load, each is extracted, cleaned and loaded by its own pipeline
+data_types = [user, card, store, product, order, date_times]
+# Dimension tables orders_table references, on their primary keys or on their surrogate keys
+dimensions = [user, card, store, product, date_times]
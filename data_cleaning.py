@@ -2,32 +2,91 @@ import logging
 import numpy as np
 import pandas as pd
 import re
-from time import strptime
-from typing import List
+from typing import Callable, Iterable, Iterator, List
 
-from config import ColumnEntries, OZ_TO_KG, G_TO_KG
+from config import ColumnEntries, Schema, OZ_TO_KG, G_TO_KG, WEIGHT_CLASSES
+from profiling import StageStats, profile_methods, run_report
+from quarantine import quarantine
+from validation import Rule, ValidationReport, validate
 
 logger = logging.getLogger(__name__)
 
 
+@profile_methods
 class DataCleaning:
     """
     This class is used to represent a data to be cleaned.
 
     Attributes:
         valid_entries: A column with a list of entries which are valid for that column
+        schema: Target dtypes of the cleaned columns
+        rules: Rules rows must pass, rows failing any rule are dropped
+        max_rejected_fraction: Cleaning fails if more than this fraction of the rows are dropped
     """
 
-    months_with_leading_zero = [
-        '01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12'
-    ]
-
-    def __init__(self, column_entries: ColumnEntries = None):
+    month_numbers = {
+        'january': '01',
+        'february': '02',
+        'march': '03',
+        'april': '04',
+        'may': '05',
+        'june': '06',
+        'july': '07',
+        'august': '08',
+        'september': '09',
+        'october': '10',
+        'november': '11',
+        'december': '12'
+    }
+
+    weight_units_to_kg = {'kg': 1, 'g': G_TO_KG, 'ml': G_TO_KG, 'oz': OZ_TO_KG}
+
+    def __init__(self,
+                 column_entries: ColumnEntries = None,
+                 schema: Schema = None,
+                 rules: List[Rule] = None,
+                 max_rejected_fraction: float = None):
         """
         valid_entries is of type ColumnEntries, which has a column_name, and a list of 'valid' entries.
         During cleaning the dataframe column with non matching entries will be dropped.
+        When rules are given they replace the check of valid_entries.
+        When a schema is given the cleaned columns are cast to its dtypes.
         """
         self.valid_entries = column_entries
+        self.schema = schema
+        if rules is None and column_entries is not None:
+            rules = [column_entries.rule()]
+        self.rules = rules or []
+        self.max_rejected_fraction = max_rejected_fraction
+
+    def apply_schema(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Cast columns to the dtypes of the schema, recording the memory used by the dataframe before
+        and after in the run report. Raises a ValueError if a column has entries outside its categories.
+        """
+        if self.schema is None:
+            return df
+        bytes_before = int(df.memory_usage(deep=True).sum())
+
+        for column, dtype in self.schema.dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype) and dtype.categories is not None:
+                unknown_mask = df[column].notna() & ~df[column].isin(dtype.categories)
+                if unknown_mask.any():
+                    raise ValueError(
+                        f"Entries of {column} not in its categories: "
+                        f"{df.loc[unknown_mask, column].unique().tolist()[:5]}")
+        df = df.astype(self.schema.dtypes)
+
+        bytes_after = int(df.memory_usage(deep=True).sum())
+        logger.info(f"Memory of {self.schema.table_name} cut from {bytes_before} to {bytes_after} bytes")
+        run_report.add(
+            StageStats(stage=f"schema {self.schema.table_name}",
+                       calls=1,
+                       rows_in=len(df.index),
+                       rows_out=len(df.index),
+                       bytes_in=bytes_before,
+                       bytes_out=bytes_after))
+        return df
 
     @staticmethod
     def _set_index_column_as_index(df: pd.DataFrame) -> pd.DataFrame:
@@ -36,19 +95,6 @@ class DataCleaning:
         df = df.set_index('index')
         return df.sort_index()
 
-    def _clean_country_code(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Drop rows where country_code not valid (identifies dodgy data)"""
-        logger.debug("Clean data in column country_code")
-
-        # Update Country code GGB to GB (data typo)
-        df.loc[df['country_code'] == 'GGB', 'country_code'] = 'GB'
-
-        df = self._drop_rows_with_invalid_entries(
-            df=df,
-            column=self.valid_entries.column_name,
-            valid_entries=self.valid_entries.entries)
-        return df
-
     @staticmethod
     def _clean_continent(df: pd.DataFrame) -> pd.DataFrame:
         """Fix continent data with typos"""
@@ -73,62 +119,50 @@ class DataCleaning:
 
     @staticmethod
     def _update_store_web_details(df: pd.DataFrame) -> pd.DataFrame:
-        """The web store doesn't have a physical address. Update all address related fields to nan"""
-        df.loc[
-            df['store_type'] == 'Web Portal',
-            ['address', 'longitude', 'latitude', 'lat', 'locality']] = np.nan
+        """
+        The web store doesn't have a physical address. Set its address and locality to N/A and the
+        other address related fields to nan
+        """
+        web_portal_mask = df['store_type'] == 'Web Portal'
+        df.loc[web_portal_mask, ['longitude', 'latitude', 'lat']] = np.nan
+        # All null address columns are float, which can't hold N/A
+        df[['address', 'locality']] = df.reindex(columns=['address', 'locality']).astype(object)
+        df.loc[web_portal_mask, ['address', 'locality']] = 'N/A'
+        return df
 
+    @staticmethod
+    def _cast_store_coordinates(df: pd.DataFrame) -> pd.DataFrame:
+        """Drop the unused lat column and convert longitude and latitude to floats"""
+        logger.debug("Clean data in columns longitude and latitude")
+        df = df.drop(columns='lat')
+        df[['longitude', 'latitude']] = df[['longitude', 'latitude']].astype(float)
         return df
 
     @staticmethod
-    def _update_address(row: pd.Series):
+    def _clean_address(df: pd.DataFrame) -> pd.DataFrame:
         """
-        Remove locality, which is after the comma. Split by line end
+        Remove locality from store addresses, which is after the comma. Split by line end
         The remaining entries are written to address, address_2/3/4 (where entries exist)
         """
-        address = row['address']
+        logger.debug("Clean data in column address")
         columns = ['address', 'address_2', 'address_3', 'address_4']
+        if df.empty:
+            return df.reindex(columns=df.columns.union(columns, sort=False))
+
+        addresses = df['address']
 
         # store addresses have the locality at the end
-        if 'store_code' in row:
-            locality_removed = address.split(',')[:-1]
-            address = "".join(locality_removed)
-        address_lines = address.split('\n')
-
-        for line, column in zip(address_lines, columns):
-            row[column] = line
-
-        return row
-
-    def _clean_address(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Add columns address_2, address_3, address_4 and update cleaned address"""
-        # logger.debug(f"Clean data in column address")
-        df['address_2'] = np.nan
-        df['address_3'] = np.nan
-        df['address_4'] = np.nan
-        df = df.apply(self._update_address, axis=1)
+        if 'store_code' in df.columns:
+            addresses = addresses.str.extract(r'(?s)^(.*),[^,]*$',
+                                              expand=False)
+            addresses = addresses.fillna('').str.replace(',', '', regex=False)
+
+        address_lines = addresses.str.split('\n', expand=True)
+        for line_number, column in enumerate(columns):
+            # None rather than nan keeps the columns as strings when a chunk has no entries for them
+            df[column] = address_lines.get(line_number)
         return df
 
-    @staticmethod
-    def _log_number_of_rows_to_drop(df: pd.DataFrame, subset: List):
-        """Return number of rows which will be dropped"""
-        number_rows = len(df.index) - len(df.dropna(subset=subset))
-        logger.debug(f"Dropping {number_rows} rows for subset {subset}")
-
-    @staticmethod
-    def _standardize_dob(date: str) -> str:
-        """The month and years are in varying orders, always return as YYYY-MM-DD"""
-        date_split = date.split()
-
-        if date_split[0].isnumeric():
-            # Handle YYYY Month Day e.g. 1968 October 16
-            month = strptime(date_split[1], '%B').tm_mon
-            return f"{date_split[0]}-{month:02d}-{date_split[2]}"
-
-        # Handle Month YYYY Day e.g. January 1951 27
-        month = strptime(date_split[0], '%B').tm_mon
-        return f"{date_split[1]}-{month:02d}-{date_split[2]}"
-
     def _clean_date(self, df: pd.DataFrame, column_name: str) -> pd.DataFrame:
         """
         Clean user date in pandas dataframe, 4 date formats are used
@@ -138,38 +172,77 @@ class DataCleaning:
           -- YYYY/MM/DD
         returns the dataframe with the date standardised to YYYY-MM-DD in pandas Timestamp format
         """
-        logger.info("Clean data in date column {column_name}")
-
-        # Add month column to identify dates to clean
-        df['month'] = df[column_name].str.slice(5, 7)
-        month_valid_mask = ~df['month'].isin(self.months_with_leading_zero)
-
-        df.loc[month_valid_mask,
-               column_name] = df.loc[month_valid_mask, column_name].apply(
-                   DataCleaning._standardize_dob)
-        df = df.drop('month', axis=1)
-
-        # Change formats which are YYYY/MM/DD to YYYY-MM-DD
-        df[column_name] = df[column_name].apply(lambda x: x.replace('/', '-'))
-        df[column_name] = pd.to_datetime(df[column_name])
-
+        logger.info(f"Clean data in date column {column_name}")
+
+        # Parse YYYY-MM-DD in one pass, only the remaining dates need standardising
+        dates = pd.to_datetime(df[column_name],
+                               format='%Y-%m-%d',
+                               errors='coerce')
+        unparsed_mask = dates.isna() & df[column_name].notna()
+
+        if unparsed_mask.any():
+            # Change formats which are YYYY/MM/DD to YYYY-MM-DD
+            to_standardize = df.loc[unparsed_mask, column_name].str.replace(
+                '/', '-', regex=False)
+
+            # Change formats which are YYYY Month DD or Month YYYY DD to YYYY-MM-DD
+            year_month_day = to_standardize.str.extract(
+                r'^(?P<year>\d{4})\s+(?P<month>[A-Za-z]+)\s+(?P<day>\d+)$')
+            month_year_day = to_standardize.str.extract(
+                r'^(?P<month>[A-Za-z]+)\s+(?P<year>\d{4})\s+(?P<day>\d+)$')
+            parts = year_month_day.fillna(month_year_day)
+            month_name_mask = parts['month'].notna()
+            month = parts['month'].str.lower().map(self.month_numbers)
+            to_standardize[month_name_mask] = (parts['year'] + '-' + month +
+                                               '-' + parts['day'])
+
+            dates[unparsed_mask] = pd.to_datetime(to_standardize,
+                                                  format='%Y-%m-%d')
+
+        df[column_name] = dates
         return df
 
-    def _drop_rows_with_invalid_entries(self, df: pd.DataFrame, column: str,
-                                        valid_entries: List) -> pd.DataFrame:
+    def _drop_invalid_rows(self, df: pd.DataFrame, stage: str) -> pd.DataFrame:
         """
-        Drop rows where entries in column are not valid (Pattern identified so far across the data,
-        be very sure this is the case before using this!)
+        Drop rows failing any of the rules. Every rule is evaluated as a mask in one pass and the rejected
+        rows are recorded and quarantined by drop_rejected_rows. Raises a ValueError if more than
+        max_rejected_fraction of the rows are rejected, which points to a change in the source rather
+        than the usual bad rows. Tables cleaned in chunks leave max_rejected_fraction unset and check the
+        totals of the stream with a StreamValidator.
         """
-        logger.debug(f"Clean data in column {column}")
-        invalid_entries_mask = ~df[column].isin(valid_entries).copy()
-
-        df.loc[invalid_entries_mask, column] = np.nan
-
-        self._log_number_of_rows_to_drop(df=df, subset=[column])
-        df.dropna(subset=[column], inplace=True)
+        if not self.rules:
+            return df
+        df, rejected, report = validate(df, self.rules)
+        table_name = self.schema.table_name if self.schema is not None else 'dataframe'
+        df = self.drop_rejected_rows(df, rejected, report, table_name, stage)
+        if self.max_rejected_fraction is not None and report.rejected_fraction > self.max_rejected_fraction:
+            raise ValueError(
+                f"{report.rows_rejected} of {report.rows_in} rows of {table_name} rejected, more than "
+                f"{self.max_rejected_fraction:.1%}: {report.rejected_by_rule}")
         return df
 
+    @staticmethod
+    def drop_rejected_rows(df: pd.DataFrame, rejected: np.ndarray, report: ValidationReport, table_name: str,
+                           stage: str) -> pd.DataFrame:
+        """
+        Drop the rejected rows of df, recording the rows rejected by each rule in the run report. The rejected
+        rows are quarantined, tagged with the first rule they failed and the stage which rejected them.
+        """
+        for rule_name, number_rows in report.rejected_by_rule.items():
+            run_report.add(
+                StageStats(stage=f"rejected {table_name} {rule_name}",
+                           calls=1,
+                           rows_in=report.rows_in,
+                           rows_out=report.rows_in - number_rows))
+        if report.rows_rejected:
+            rejected_rows = df.take(np.flatnonzero(rejected))
+            rejected_rows['rule'] = report.rejected_rules
+            rejected_rows['stage'] = stage
+            quarantine.add(table_name, rejected_rows)
+        logger.debug(f"Dropping {report.rows_rejected} rows of {table_name}")
+        # take rather than a boolean index, so later steps can assign columns without a copy warning
+        return df.take(np.flatnonzero(~rejected))
+
     def _clean_card_number_expiry_date(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         This function uses values in 'card_number expiry_date' column to populate missing values
@@ -177,8 +250,10 @@ class DataCleaning:
         """
         logger.debug("Clean data in columns card_number and expiry_date")
         df = self._set_card_number_and_expiry_date(df=df)
-        df['card_number'] = df['card_number'].apply(
-            lambda x: str(x).replace('?', ''))
+        card_numbers = df['card_number']
+        df['card_number'] = card_numbers.where(
+            card_numbers.isna(),
+            card_numbers.astype(str).str.replace('?', '', regex=False))
         logger.debug("Remove ??'s from column 'card_number'")
 
         # Drop columns 'card_number expiry_date' and 'Unnamed'
@@ -192,6 +267,8 @@ class DataCleaning:
             "Set the card number and expiry dates for nan entries from 'card_number expiry_date'"
         )
         card_no_expiry_date_mask = ~df['card_number expiry_date'].isna()
+        # All null card number or expiry date columns are float, which can't hold the strings copied
+        df[['card_number', 'expiry_date']] = df[['card_number', 'expiry_date']].astype(object)
 
         df.loc[card_no_expiry_date_mask, 'card_number'] = df.loc[
             card_no_expiry_date_mask,
@@ -208,37 +285,6 @@ class DataCleaning:
         df = df.rename(columns={'Unnamed: 0': 'index'})
         return df
 
-    @staticmethod
-    def _calculate_total_weight(weight: str) -> str:
-        """Accepts a weight of a number of items e.g. 2 x 200g Returns total weight in Kg"""
-        number_items = weight.split(' ')
-        item_weight = number_items[-1]
-        total_weight = int(number_items[0]) * int(item_weight.rstrip('g'))
-        return f"{total_weight / G_TO_KG}"
-
-    @staticmethod
-    def _convert_weight_from_oz_to_kg(weight: str) -> str:
-        """Accepts a weight in oz e.g. 200oz Returns weight in Kg rounded to 3dp"""
-        weight_in_oz = int(weight.rstrip('oz'))
-        return f"{round(weight_in_oz / OZ_TO_KG, 3)}"
-
-    @staticmethod
-    def _convert_weight_from_g_or_ml_to_kg(weight: str) -> str:
-        """Accepts a weight in g e.g. 200g/200ml Returns weight in Kg"""
-        weight_g = float(re.sub(r'g|ml', '', weight))
-        return f"{weight_g / G_TO_KG}"
-
-    def _determine_weight_function(self, weight: str):
-        """Routes to the appropriate function based on the contents of the weight string"""
-        if 'x' in weight:
-            return self._calculate_total_weight(weight)
-        elif 'oz' in weight:
-            return self._convert_weight_from_oz_to_kg(weight)
-        elif 'kg' in weight:
-            return float(weight.replace('kg', ''))
-
-        return self._convert_weight_from_g_or_ml_to_kg(weight)
-
     def convert_product_weights(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Converts a mixture of weight data to kg by first removing disallowed characters.
@@ -246,30 +292,97 @@ class DataCleaning:
           - Weights with multiple items e.g. 2 x 200g converted to 0.4
           - Weights with ml as converted 1:1 to g (converted directly to kg)
           - Weights with kg suffix remove the suffix
-          - Weights with oz converted to kg
+          - Weights with oz converted to kg (rounded to 3dp)
           - Weights with g converted to kg
         Returns weight as a float
         """
         logger.info("Clean data in column weight")
-        df_invalid_chars = df[df['weight'].str.endswith(' .')].copy()
-        df_invalid_chars['weight'] = df_invalid_chars['weight'].str.replace(
-            ' .', '')
-        df.update(df_invalid_chars)
+        # Weights repeat across products, so only parse each distinct weight once
+        codes, unique_weights = pd.factorize(df['weight'])
+        weights = pd.Series(unique_weights, dtype=object).str.removesuffix(' .')
+        parts = weights.str.extract(
+            r'^(?:(?P<items>\d+)\s*x\s*)?(?P<quantity>\d+(?:\.\d+)?)(?P<unit>kg|g|ml|oz)$'
+        )
+
+        unparsed_mask = parts['unit'].isna()
+        if unparsed_mask.any():
+            raise ValueError(
+                f"Unrecognised product weights: {weights[unparsed_mask].tolist()[:5]}"
+            )
 
-        df_rest = df.copy()
-        df_rest['weight'] = df_rest['weight'].apply(
-            self._determine_weight_function)
-        df.update(df_rest)
+        items = parts['items'].astype(float).fillna(1)
+        quantity = parts['quantity'].astype(float)
+        unit_to_kg = parts['unit'].map(self.weight_units_to_kg).astype(float)
+        weight_kg = items * quantity / unit_to_kg
+        weight_kg = weight_kg.mask(parts['unit'] == 'oz', weight_kg.round(3))
 
-        df['weight'] = df['weight'].astype('float')
+        # Missing weights have code -1, which picks up the nan appended to the end
+        df['weight'] = np.append(weight_kg.to_numpy(), np.nan)[codes]
         return df
 
+    @staticmethod
+    def _clean_product_price(df: pd.DataFrame) -> pd.DataFrame:
+        """Remove the £ from product prices and convert them to floats"""
+        logger.debug("Clean data in column product_price")
+        df['product_price'] = df['product_price'].str.replace(
+            '£', '', regex=False).astype(float)
+        return df
+
+    @staticmethod
+    def _add_weight_class(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Add a weight_class column with a human-readable range of the weight in kg. Ranges include
+        both ends and the first match wins, e.g. 40kg is Mid_Sized. Missing weights are Truck_Required
+        """
+        weight = df['weight']
+        df['weight_class'] = np.select(
+            [weight < 2, weight.between(2, 40), weight.between(40, 140)],
+            WEIGHT_CLASSES[:3],
+            default=WEIGHT_CLASSES[3])
+        return df
+
+    @staticmethod
+    def _set_still_available(df: pd.DataFrame) -> pd.DataFrame:
+        """Replace the removed column with a still_available boolean, False where the product was Removed"""
+        df['still_available'] = df['removed'] != 'Removed'
+        return df.drop(columns='removed')
+
+    @staticmethod
+    def _time_of_day(timestamps: pd.Series) -> np.ndarray:
+        """
+        Returns the time since midnight of HH:MM:SS timestamps as timedelta64, read from the digits of their
+        bytes. Columns with other timestamps are parsed by pd.to_timedelta
+        """
+        try:
+            characters = timestamps.to_numpy().astype('S9').view(np.uint8).reshape(-1, 9)
+        except UnicodeEncodeError:
+            return pd.to_timedelta(timestamps).to_numpy()
+        hours, minutes, seconds = ((characters[:, position].astype(np.int32) - ord('0')) * 10
+                                   + characters[:, position + 1] - ord('0') for position in (0, 3, 6))
+        # Characters below '0' wrap around to above 9
+        well_formed = ((characters[:, [0, 1, 3, 4, 6, 7]] - np.uint8(ord('0')) <= 9).all()
+                       and (characters[:, [2, 5]] == ord(':')).all()
+                       and (characters[:, 8] == 0).all()
+                       and (hours < 24).all() and (minutes < 60).all() and (seconds < 60).all())
+        if not well_formed:
+            return pd.to_timedelta(timestamps).to_numpy()
+        return ((hours * 60 + minutes) * 60 + seconds).astype('timedelta64[s]')
+
     @staticmethod
     def _add_date_column(df: pd.DataFrame) -> pd.DataFrame:
-        """Add a date column by concatenating year, month, day and timestamp"""
-        df['date'] = df['year'] + '-' + df['month'] + '-' + df[
-            'day'] + ' ' + df['timestamp']
-        df['date'] = pd.to_datetime(df['date'])
+        """
+        Add a datetime64 date column from the year, month, day and timestamp columns. The date is assembled
+        from the numbers as datetime64 months and days plus the time of day of the timestamp, rather than
+        parsing a concatenated string
+        """
+        year, month, day = (df[column].to_numpy().astype(np.int32) for column in ['year', 'month', 'day'])
+        months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+        days = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+        past_end_of_month = days.astype('datetime64[M]') != months
+        if past_end_of_month.any():
+            raise ValueError(f"{past_end_of_month.sum()} dates are past the end of their month, "
+                             f"e.g. row {df.index[past_end_of_month][0]}")
+        df['date'] = days.astype('datetime64[ns]') + DataCleaning._time_of_day(df['timestamp'])
         return df
 
     @staticmethod
@@ -286,11 +399,21 @@ class DataCleaning:
         """
         logger.info("Clean user data")
         df = self._set_index_column_as_index(df)
-        df = self._clean_country_code(df)
+        df = self._drop_invalid_rows(df, stage='clean_user_data')
         df = self._clean_date(df, 'date_of_birth')
         df = self._clean_date(df, 'join_date')
         df = self._clean_address(df)
-        return df
+        return self.apply_schema(df)
+
+    @staticmethod
+    def clean_chunks(chunks: Iterable[pd.DataFrame],
+                     clean_function: Callable) -> Iterator[pd.DataFrame]:
+        """
+        Apply clean_function (e.g. clean_order_data) to each dataframe chunk, yielding the cleaned chunks.
+        Only cleaning steps which work row by row are safe to use on chunks.
+        """
+        for chunk in chunks:
+            yield clean_function(df=chunk)
 
     def clean_card_data(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -298,14 +421,12 @@ class DataCleaning:
         and standardizes dates
         """
         logger.info("Clean card data")
-        df = self._drop_rows_with_invalid_entries(
-            df=df,
-            column=self.valid_entries.column_name,
-            valid_entries=self.valid_entries.entries)
-        df = self._clean_date(df, 'date_payment_confirmed')
+        # Card numbers are complete and without ?'s before the rules, so Unique('card_number') compares final values
         df = self._clean_card_number_expiry_date(df)
+        df = self._drop_invalid_rows(df, stage='clean_card_data')
+        df = self._clean_date(df, 'date_payment_confirmed')
         df.reset_index(inplace=True, drop=True)
-        return df
+        return self.apply_schema(df)
 
     def clean_store_data(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -314,13 +435,14 @@ class DataCleaning:
         """
         logger.info("Clean store data")
         df = self._set_index_column_as_index(df)
-        df = self._clean_country_code(df)
+        df = self._drop_invalid_rows(df, stage='clean_store_data')
         df = self._clean_continent(df)
         df = self._clean_date(df, 'opening_date')
         df = self._clean_staff_numbers(df)
         df = self._clean_address(df)
         df = self._update_store_web_details(df)
-        return df
+        df = self._cast_store_coordinates(df)
+        return self.apply_schema(df)
 
     def clean_product_data(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -331,13 +453,13 @@ class DataCleaning:
         logger.info("Clean product data")
         df = self._rename_product_columns(df)
         df = self._set_index_column_as_index(df)
-        df = self._drop_rows_with_invalid_entries(
-            df=df,
-            column=self.valid_entries.column_name,
-            valid_entries=self.valid_entries.entries)
+        df = self._drop_invalid_rows(df, stage='clean_product_data')
         df = self._clean_date(df, 'date_added')
         df = self.convert_product_weights(df)
-        return df
+        df = self._clean_product_price(df)
+        df = self._add_weight_class(df)
+        df = self._set_still_available(df)
+        return self.apply_schema(df)
 
     def clean_order_data(self, df: pd.DataFrame) -> pd.DataFrame:
         """This function cleans the orders data. It drops columns not required and sets the index."""
@@ -345,14 +467,11 @@ class DataCleaning:
         df = self._drop_columns(
             df, columns=['first_name', 'last_name', '1', 'level_0'])
         df = self._set_index_column_as_index(df)
-        return df
+        return self.apply_schema(df)
 
     def clean_date_times_data(self, df: pd.DataFrame) -> pd.DataFrame:
         """This function cleans the date_times data. It drops rows with invalid entries and adds a date column."""
         logger.info("Clean date_times data")
-        df = self._drop_rows_with_invalid_entries(
-            df=df,
-            column=self.valid_entries.column_name,
-            valid_entries=self.valid_entries.entries)
+        df = self._drop_invalid_rows(df, stage='clean_date_times_data')
         df = self._add_date_column(df)
-        return df
+        return self.apply_schema(df)
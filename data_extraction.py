@@ -1,20 +1,212 @@
 import boto3
 import botocore
+import codecs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import json
 import logging
+import multiprocessing
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from pypdf import PdfReader
 import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import MetaData, Table, select
 import tabula
-from typing import Dict, Tuple
+import re
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+from urllib3.util.retry import Retry
+
+from cache import LocalCache
+from config import (STORE_API_MAX_WORKERS, REQUEST_TIMEOUT, REQUEST_RETRIES,
+                    REQUEST_BACKOFF_FACTOR, RETRY_STATUS_CODES, RDS_CHUNK_SIZE,
+                    CACHE_DIR, CACHE_MAX_BYTES, CACHE_AS_PARQUET,
+                    PDF_PAGES_PER_BATCH, PDF_MAX_WORKERS, STREAM_S3,
+                    S3_READ_BLOCK_SIZE, S3_CHUNK_SIZE)
+from profiling import add_worker_cpu, cpu_timed, profile_methods
+from staging import read_parquet
 
 logger = logging.getLogger(__name__)
 
 
+def _read_pdf_pages(pdf_path: str, pages: List[int]) -> List[pd.DataFrame]:
+    """Returns the tables on the pages of the pdf. Module level so it can run in a worker process"""
+    return tabula.read_pdf(pdf_path, stream=True, pages=pages)
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_VALUE_END = re.compile(r'[ \t\n\r,:}\]]')
+_STRING = r'"([^"\\]*(?:\\.[^"\\]*)*)"'
+# A "key": value entry of an object and the , or } after it, the value a string or a number, true, false or null
+_ENTRY = re.compile(rf'[ \t\n\r]*{_STRING}[ \t\n\r]*:[ \t\n\r]*(?:{_STRING}|([^,}}\s"{{\[]+))[ \t\n\r]*([,}}])')
+_JSON_DECODER = json.JSONDecoder()
+# Distinct values of a column shared as one string object, beyond this a column is treated as unique
+_SHARED_VALUES_LIMIT = 4096
+
+
+class _JsonTokens:
+    """Reads the values and punctuation of a JSON document from a binary stream, a block at a time"""
+
+    def __init__(self, stream: BinaryIO, block_size: int):
+        self.stream = codecs.getreader('utf-8')(stream)
+        self.block_size = block_size
+        self.buffer = ''
+        self.position = 0
+        self.end_of_stream = False
+
+    def _read_block(self):
+        block = self.stream.read(self.block_size)
+        self.end_of_stream = not block
+        self.buffer = self.buffer[self.position:] + block
+        self.position = 0
+
+    def _skip_whitespace(self):
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer) or self.end_of_stream:
+                return
+            self._read_block()
+
+    def peek(self) -> str:
+        self._skip_whitespace()
+        if self.position == len(self.buffer):
+            raise ValueError("Unexpected end of JSON document")
+        return self.buffer[self.position]
+
+    def punctuation(self, expected: str) -> str:
+        """Consume one of the expected punctuation characters, returning it"""
+        char = self.peek()
+        if char not in expected:
+            raise ValueError(f"Expected one of {expected!r} at {char!r} in JSON document")
+        self.position += 1
+        return char
+
+    @staticmethod
+    def _string(string: str) -> str:
+        return json.loads(f'"{string}"') if '\\' in string else string
+
+    def entry(self) -> Tuple:
+        """Consume a "key": value entry of an object and the , or } after it, returning all three"""
+        while True:
+            match = _ENTRY.match(self.buffer, self.position)
+            if match:
+                self.position = match.end()
+                key, string, other, separator = match.groups()
+                value = self._string(string) if other is None else json.loads(other)
+                return self._string(key), value, separator
+            if self.end_of_stream:
+                break
+            self._read_block()
+        # Not a simple entry, e.g. the value is an object
+        key = self.value()
+        self.punctuation(':')
+        value = self.value()
+        return key, value, self.punctuation(',}')
+
+    def value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _JSON_DECODER.raw_decode(self.buffer, self.position)
+                # A number cut off at the end of the block continues in the next one
+                if _VALUE_END.match(self.buffer, end) or self.end_of_stream:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.end_of_stream:
+                    raise
+            self._read_block()
+
+
+def _index(keys: List[str]) -> pd.Index:
+    """Returns row keys as an index, as integers when they are digits as to_json writes a RangeIndex"""
+    index = pd.Index(keys)
+    if all(key.isdigit() for key in keys):
+        index = index.astype('int64')
+    return index
+
+
+def _read_column(tokens: _JsonTokens, chunksize: int) -> Iterator[Tuple[pd.Index, np.ndarray]]:
+    """
+    Yields the keys and values of the entries of a column's object chunksize entries at a time, the values
+    as an array typed as pandas infers it. Repeated strings of the column share one object.
+    """
+    tokens.punctuation('{')
+    separator = ',' if tokens.peek() != '}' else tokens.punctuation('}')
+    shared_values = {}
+    while separator == ',':
+        keys, values = [], []
+        while separator == ',' and len(values) < chunksize:
+            key, value, separator = tokens.entry()
+            if shared_values is not None and isinstance(value, str):
+                value = shared_values.setdefault(value, value)
+                if len(shared_values) > _SHARED_VALUES_LIMIT:
+                    shared_values = None
+            keys.append(key)
+            values.append(value)
+        yield _index(keys), pd.Series(values).to_numpy()
+
+
+def read_json_columns(stream: BinaryIO, chunksize: int = S3_CHUNK_SIZE,
+                      block_size: int = S3_READ_BLOCK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Parse a column oriented JSON document, {column: {row key: value}} as written by to_json, in one pass
+    over a binary stream, yielding dataframes of chunksize rows. Each column is parsed chunksize rows at a
+    time into arrays typed as pd.read_json(dtype=False) types them, so only the arrays are held rather than
+    the document. A row is only complete once the last column is read, so the chunks are yielded when the
+    document ends, each chunk's arrays released as it is. Rows are indexed by the first column's keys.
+    """
+    tokens = _JsonTokens(stream, block_size)
+    indexes, columns = [], {}
+    tokens.punctuation('{')
+    while tokens.peek() != '}':
+        if columns:
+            tokens.punctuation(',')
+        name = tokens.value()
+        tokens.punctuation(':')
+        blocks = []
+        for number, (index, values) in enumerate(_read_column(tokens, chunksize)):
+            if not columns:
+                indexes.append(index)
+            elif number >= len(indexes) or not index.equals(indexes[number]):
+                raise ValueError(f"Rows of column {name} are not keyed as the first column")
+            blocks.append(values)
+        if columns and len(blocks) != len(indexes):
+            raise ValueError(f"Rows of column {name} are not keyed as the first column")
+        columns[name] = blocks
+    tokens.punctuation('}')
+    for number, index in enumerate(indexes):
+        yield pd.DataFrame({name: blocks[number] for name, blocks in columns.items()}, index=index)
+        for blocks in columns.values():
+            blocks[number] = None
+
+
+@profile_methods
 class DataExtractor:
     """
     This class is used to assist with data extraction.
+
+    Attributes:
+        cache: Local cache for extracted files
+        cache_as_parquet: Cache s3 extracts as parquet rather than the downloaded file
+        stream_s3: Parse s3 extracts in chunks as they are read, see stream_from_s3
     """
 
+    def __init__(self,
+                 s3_client=None,
+                 cache: LocalCache = None,
+                 cache_as_parquet: bool = CACHE_AS_PARQUET,
+                 stream_s3: bool = STREAM_S3):
+        """
+        s3_client defaults to a boto3 s3 client, created when first needed.
+        cache defaults to a LocalCache in CACHE_DIR.
+        """
+        self._s3_client = s3_client
+        self.cache = cache or LocalCache(CACHE_DIR, CACHE_MAX_BYTES)
+        self.cache_as_parquet = cache_as_parquet
+        self.stream_s3 = stream_s3
+
     @staticmethod
     def read_rds_table(connection, table_name: str) -> pd.DataFrame:
         """This function accepts a sql connection and table name and returns the table as a dataframe"""
@@ -23,20 +215,105 @@ class DataExtractor:
         return pd.read_sql_table(table_name=table_name, con=connection)
 
     @staticmethod
-    def retrieve_pdf_data(pdf_path: str) -> pd.DataFrame:
-        """This function accepts a path to a pdf, reads the pdf and returns the contents"""
+    def read_rds_table_in_chunks(
+            connection,
+            table_name: str,
+            chunksize: int = RDS_CHUNK_SIZE,
+            after_index: int = None) -> Iterator[pd.DataFrame]:
+        """
+        This function accepts a sql connection and table name and yields the table as dataframes
+        of chunksize rows. A server side cursor is used so only one chunk is held in memory at a time.
+        The connection must remain open until all chunks have been consumed.
+        If after_index is set only rows with an index column greater than after_index are read,
+        in index order.
+        """
+        logger.info(
+            f"Read table {table_name} in chunks of {chunksize} rows from host {connection.engine.url.host}"
+        )
+        streaming_connection = connection.execution_options(
+            stream_results=True, max_row_buffer=chunksize)
+        if after_index is None:
+            yield from pd.read_sql_table(table_name=table_name,
+                                         con=streaming_connection,
+                                         chunksize=chunksize)
+            return
+
+        logger.info(f"Read rows of {table_name} after index {after_index}")
+        table = Table(table_name, MetaData(), autoload_with=connection)
+        query = select(table).where(table.c['index'] > after_index).order_by(
+            table.c['index'])
+        yield from pd.read_sql_query(query,
+                                     con=streaming_connection,
+                                     chunksize=chunksize)
+
+    @staticmethod
+    def _read_cached_parquet(path: Path) -> pd.DataFrame:
+        """Returns a cached dataframe"""
+        return read_parquet(path)
+
+    @staticmethod
+    def _read_pdf_bytes(pdf_path: str) -> bytes:
+        """Returns the contents of the pdf at a url or local path"""
+        if pdf_path.startswith(('http://', 'https://')):
+            response = requests.get(pdf_path, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            return response.content
+        return Path(pdf_path).read_bytes()
+
+    @staticmethod
+    def _parse_pdf(pdf_path: str, max_workers: int) -> List[pd.DataFrame]:
+        """Parse the tables on every page of the pdf, in batches of pages across worker processes"""
+        number_pages = len(PdfReader(pdf_path).pages)
+        batches = [
+            list(range(first_page, min(first_page + PDF_PAGES_PER_BATCH, number_pages + 1)))
+            for first_page in range(1, number_pages + 1, PDF_PAGES_PER_BATCH)
+        ]
+        logger.info(f"Parse {number_pages} pdf pages in {len(batches)} batches")
+
+        if len(batches) <= 1 or max_workers <= 1:
+            tables = [_read_pdf_pages(pdf_path, pages) for pages in batches]
+        else:
+            # Called from a pipeline thread while the others run, which isn't safe to fork
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     mp_context=multiprocessing.get_context('forkserver')) as executor:
+                timed_tables = list(executor.map(cpu_timed, [_read_pdf_pages] * len(batches),
+                                                 [pdf_path] * len(batches), batches))
+            add_worker_cpu(sum(cpu_seconds for _, cpu_seconds in timed_tables))
+            tables = [batch for batch, _ in timed_tables]
+        return [table for batch in tables for table in batch]
+
+    def retrieve_pdf_data(self, pdf_path: str, max_workers: int = PDF_MAX_WORKERS) -> pd.DataFrame:
+        """
+        This function accepts a path to a pdf, reads the pdf and returns the contents.
+        The parsed table is cached as parquet keyed by a hash of the pdf, so an unchanged pdf isn't parsed again.
+        """
         logger.info(f"Read pdf file from path {pdf_path}")
-        df = pd.DataFrame(columns=[
-            'card_number', 'expiry_date', 'card_provider',
-            'date_payment_confirmed'
-        ])
+        pdf_bytes = self._read_pdf_bytes(pdf_path)
+        cache_key = self.cache.make_key(hashlib.sha256(pdf_bytes).hexdigest())
 
-        cards = tabula.read_pdf(pdf_path, stream=True, pages="all")
-        for card in cards:
-            df = pd.concat([df, card])
+        parquet_path = self.cache.get(cache_key, '.parquet')
+        if parquet_path is not None:
+            logger.info(f"Read pdf table from cached parquet {parquet_path}")
+            return self._read_cached_parquet(parquet_path)
+
+        local_pdf = self.cache.put(cache_key, '.pdf', lambda path: path.write_bytes(pdf_bytes))
+        cards = self._parse_pdf(str(local_pdf), max_workers)
+        df = pd.concat([
+            pd.DataFrame(columns=[
+                'card_number', 'expiry_date', 'card_provider',
+                'date_payment_confirmed'
+            ]), *cards
+        ])
 
         # Reset the index as each page has a new index starting from 0
         df.reset_index(inplace=True, drop=True)
+
+        # Pages are typed separately so a column can mix e.g. int and str card numbers, store as str
+        for column in df.select_dtypes(include='object').columns:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+
+        self.cache.put(cache_key, '.parquet', df.to_parquet)
+        self.cache.remove(cache_key, '.pdf')
         return df
 
     @staticmethod
@@ -49,23 +326,58 @@ class DataExtractor:
         return response.json()['number_stores']
 
     @staticmethod
-    def retrieve_stores_data(url: str, headers: Dict,
-                             number_stores: int) -> pd.DataFrame:
+    def _create_session(headers: Dict, pool_size: int) -> requests.Session:
+        """
+        Returns a requests session with a keep-alive connection pool of pool_size.
+        Requests are retried with backoff on 429 and 5xx responses
+        """
+        retry = Retry(total=REQUEST_RETRIES,
+                      backoff_factor=REQUEST_BACKOFF_FACTOR,
+                      status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.headers.update(headers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def _retrieve_store(session: requests.Session, store_url: str,
+                        timeout: float) -> Dict:
+        """Request the store details for a single store url"""
+        logger.info(f"Request store data for {store_url}")
+        response = session.get(store_url, timeout=timeout)
+        response.raise_for_status()
+        store = response.json()
+        logger.debug(f"Adding store data {store}")
+        return store
+
+    def retrieve_stores_data(self,
+                             url: str,
+                             headers: Dict,
+                             number_stores: int,
+                             max_workers: int = STORE_API_MAX_WORKERS,
+                             timeout: float = REQUEST_TIMEOUT) -> pd.DataFrame:
         """
         This function accepts a partial string url and the total number of
-        stores. It iterates through each store, building the url and
-        then requesting the store details. It returns a dataframe
-        with all stores.
+        stores. It builds the url for each store and requests the store
+        details concurrently (up to max_workers at a time) over a shared
+        session. It returns a dataframe with all stores in store number order.
         """
-        stores = []
+        store_urls = [f"{url}{number}" for number in range(number_stores)]
 
-        for number in range(number_stores):
-            store_url = f"{url}{number}"
-            logger.info(f"Request store data for {store_url}")
-            response = requests.get(store_url, headers=headers)
-            stores.append(response.json())
-            logger.debug(f"Adding store data {response.json()}")
-        return pd.DataFrame(stores)
+        with self._create_session(headers, pool_size=max_workers) as session:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # map preserves the order of store_urls
+                timed_stores = list(
+                    executor.map(
+                        lambda store_url: cpu_timed(self._retrieve_store,
+                                                    session, store_url, timeout), store_urls))
+        add_worker_cpu(sum(cpu_seconds for _, cpu_seconds in timed_stores))
+        return pd.DataFrame([store for store, _ in timed_stores])
 
     @staticmethod
     def _parse_s3_url(s3_url) -> Tuple[str, str]:
@@ -74,25 +386,97 @@ class DataExtractor:
         bucket, key = components[-2], components[-1]
         return bucket, key
 
-    def extract_from_s3(self, s3_address) -> pd.DataFrame or None:
-        """Download file from s3 bucket, returns contents as a dataframe"""
-        bucket, key = self._parse_s3_url(s3_address)
-        s3 = boto3.client('s3')
-        local_path = Path.cwd() / key
+    @staticmethod
+    def _read_extract(path: Path) -> pd.DataFrame:
+        """Returns the contents of a csv or json file as a dataframe"""
+        if path.suffix == '.csv':
+            return pd.read_csv(path)
+        # Values keep their json types, as read_json_columns reads them when streaming
+        return pd.read_json(path, dtype=False, convert_dates=False)
 
+    def _head_s3_object(self, s3, bucket: str, key: str) -> Dict or None:
+        """Returns the s3 object metadata, or None if the object does not exist"""
         try:
-            s3.download_file(bucket, key, local_path)
+            return s3.head_object(Bucket=bucket, Key=key)
         except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "403":
-                print(f"The s3 object {s3_address} does not exist.")
-            else:
-                raise
+            if e.response['Error']['Code'] in ("403", "404"):
+                print(f"The s3 object s3://{bucket}/{key} does not exist.")
+                return None
+            raise
+
+    def get_s3_etag(self, s3_address) -> str or None:
+        """Returns the ETag of the s3 object, which changes whenever the object does"""
+        bucket, key = self._parse_s3_url(s3_address)
+        head = self._head_s3_object(self._s3_client or boto3.client('s3'),
+                                    bucket, key)
+        return None if head is None else head['ETag']
+
+    def extract_from_s3(self, s3_address) -> pd.DataFrame or None:
+        """
+        Download file from s3 bucket, returns contents as a dataframe. Files are cached locally
+        by bucket, key, ETag and LastModified, a HEAD request checks whether the cached copy is current.
+        """
+        bucket, key = self._parse_s3_url(s3_address)
+        s3 = self._s3_client or boto3.client('s3')
+
+        head = self._head_s3_object(s3, bucket, key)
+        if head is None:
             return None
 
-        if local_path.suffix == '.csv':
-            df = pd.read_csv(local_path)
-        else:
-            df = pd.read_json(local_path)
+        cache_key = self.cache.make_key(bucket, key, head['ETag'],
+                                        head['LastModified'])
+        suffix = Path(key).suffix
+
+        if self.cache_as_parquet:
+            parquet_path = self.cache.get(cache_key, '.parquet')
+            if parquet_path is not None:
+                logger.info(f"Read {s3_address} from cached parquet")
+                return self._read_cached_parquet(parquet_path)
+
+        local_path = self.cache.get(cache_key, suffix)
+        if local_path is None:
+            logger.info(f"Download {s3_address}")
+            local_path = self.cache.put(
+                cache_key, suffix,
+                lambda path: s3.download_file(bucket, key, str(path)))
+        df = self._read_extract(local_path)
 
-        local_path.unlink(missing_ok=True)
+        if self.cache_as_parquet:
+            self.cache.put(cache_key, '.parquet', df.to_parquet)
+            self.cache.remove(cache_key, suffix)
         return df
+
+    def stream_from_s3(self, s3_address, chunksize: int = S3_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+        """
+        Read a csv or json file from s3 bucket, yielding its contents as dataframes of chunksize rows.
+        The body is parsed as it is read, without downloading the file: csv in chunks and json column
+        by column with read_json_columns. The local cache is not used.
+        """
+        bucket, key = self._parse_s3_url(s3_address)
+        s3 = self._s3_client or boto3.client('s3')
+        logger.info(f"Stream {s3_address} in chunks of {chunksize} rows")
+        body = s3.get_object(Bucket=bucket, Key=key)['Body']
+        try:
+            if Path(key).suffix == '.csv':
+                yield from pd.read_csv(body, chunksize=chunksize)
+            else:
+                yield from read_json_columns(body, chunksize)
+        finally:
+            body.close()
+
+    @staticmethod
+    def hash_rows(df: pd.DataFrame) -> pd.Series:
+        """
+        Returns a 64 bit hash of the contents of each row, ignoring the index. Values are hashed as text and
+        missing values alike, so a row hashes the same in a chunk whose columns were typed differently
+        """
+        text = df.astype(str).mask(df.isna(), None)
+        return pd.util.hash_pandas_object(text, index=False).astype('int64')
+
+    @staticmethod
+    def select_changed_rows(df: pd.DataFrame, row_hashes: pd.Series,
+                            previous_hashes: pd.Series) -> pd.DataFrame:
+        """Returns the rows of df which are new or changed, i.e. whose hash is not in previous_hashes"""
+        df_changed = df[~row_hashes.isin(previous_hashes).to_numpy()]
+        logger.info(f"{len(df_changed.index)} of {len(df.index)} rows are new or changed")
+        return df_changed
@@ -1,11 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import io
 import logging
-from sqlalchemy import create_engine, inspect
-from typing import Dict
+import time
+import pandas as pd
+from sqlalchemy import create_engine, inspect, text
+from typing import Callable, Dict, Iterable, List, Optional
 import yaml
 
+from config import WATERMARK_TABLE, ROW_HASH_TABLE, FINALISE_MAX_WORKERS
+from profiling import StageStats, add_worker_cpu, cpu_timed, profile_methods, run_report
+
 logger = logging.getLogger(__name__)
 
+# Field written for missing values and read as NULL by COPY
+_COPY_NULL = '\\N'
+
 
+@profile_methods
 class DatabaseConnector:
 
     @staticmethod
@@ -36,7 +48,380 @@ class DatabaseConnector:
         logger.info(f"Tables: {table_names}")
 
     @staticmethod
-    def upload_to_db(engine, df, table_name):
-        """This function accepts a dataframe and uploads it to the table_name"""
+    def _copy_from_stdin(table, conn, keys, data_iter):
+        """
+        pandas to_sql insert method which writes the rows to an in-memory CSV buffer and
+        streams it into Postgres with COPY FROM STDIN, rather than an INSERT per row. Missing
+        values are written as \\N, so empty strings load as '' as they do through to_sql.
+        """
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            [_COPY_NULL if value is None else value for value in row] for row in data_iter)
+        buffer.seek(0)
+
+        columns = ', '.join(f'"{key}"' for key in keys)
+        table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+        sql = f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT CSV, NULL '{_COPY_NULL}')"
+
+        with conn.connection.cursor() as cursor:
+            cursor.copy_expert(sql=sql, file=buffer)
+            return cursor.rowcount
+
+    @staticmethod
+    def _insert_method(engine, bulk_copy: bool) -> Optional[Callable]:
+        """Returns the COPY insert method for Postgres engines when bulk_copy is set, otherwise to_sql's default"""
+        if bulk_copy and engine.dialect.name == 'postgresql':
+            return DatabaseConnector._copy_from_stdin
+        return None
+
+    @staticmethod
+    def create_table(connection,
+                     df: pd.DataFrame,
+                     table_name: str,
+                     sql_dtypes: Dict = None,
+                     primary_key: str = None):
+        """
+        Replace the table_name with an empty table for df's index and columns, typed with sql_dtypes
+        and with primary_key, so rows are written once with their final types and keys. Columns not in
+        sql_dtypes take the type to_sql would give them.
+        """
+        logger.info(f"Create table: {table_name}")
+        # get_schema leaves out the index, which to_sql writes as a column
+        sample = df.head(1000).reset_index()
+        ddl = pd.io.sql.get_schema(sample,
+                                   table_name,
+                                   keys=primary_key,
+                                   con=connection,
+                                   dtype=sql_dtypes)
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{table_name}"')
+        connection.exec_driver_sql(ddl)
+
+    @staticmethod
+    def upload_to_db(engine,
+                     df,
+                     table_name,
+                     bulk_copy: bool = True,
+                     sql_dtypes: Dict = None,
+                     primary_key: str = None):
+        """
+        This function accepts a dataframe and uploads it to the table_name. Rows are loaded with
+        COPY FROM STDIN on Postgres, set bulk_copy to False to fall back to to_sql INSERTs.
+        When sql_dtypes or a primary_key are given the table is created with them before loading.
+        """
         logger.info(f"Upload dataframe to: {table_name}")
-        df.to_sql(table_name, engine, if_exists='replace')
+        method = DatabaseConnector._insert_method(engine, bulk_copy)
+        if sql_dtypes is None and primary_key is None:
+            df.to_sql(table_name, engine, if_exists='replace', method=method)
+            return
+        with engine.begin() as conn:
+            DatabaseConnector.create_table(conn, df, table_name, sql_dtypes, primary_key)
+            df.to_sql(table_name, conn, if_exists='append', method=method)
+
+    @staticmethod
+    def append_to_db(connection,
+                     df: pd.DataFrame,
+                     table_name: str,
+                     bulk_copy: bool = True,
+                     sql_dtypes: Dict = None):
+        """
+        This function appends df to the table_name, which is created if it does not exist, with the column
+        types of sql_dtypes
+        """
+        logger.info(f"Append {len(df.index)} rows to: {table_name}")
+        df.to_sql(table_name,
+                  connection,
+                  if_exists='append',
+                  dtype=sql_dtypes,
+                  method=DatabaseConnector._insert_method(connection, bulk_copy))
+
+    @staticmethod
+    def upload_chunks_to_db(engine,
+                            chunks: Iterable[pd.DataFrame],
+                            table_name: str,
+                            bulk_copy: bool = True,
+                            sql_dtypes: Dict = None,
+                            primary_key: str = None) -> int:
+        """
+        This function accepts an iterable of dataframes and uploads them to the table_name one chunk
+        at a time. The first chunk replaces the table, the rest are appended. When sql_dtypes or a
+        primary_key are given the table is created with them from the first chunk. Returns the number
+        of rows uploaded.
+        """
+        logger.info(f"Upload dataframe chunks to: {table_name}")
+        method = DatabaseConnector._insert_method(engine, bulk_copy)
+        typed = sql_dtypes is not None or primary_key is not None
+        number_rows = 0
+        with engine.begin() as conn:
+            for chunk_number, df in enumerate(chunks):
+                if chunk_number == 0 and typed:
+                    DatabaseConnector.create_table(conn, df, table_name, sql_dtypes,
+                                                   primary_key)
+                if_exists = 'replace' if chunk_number == 0 and not typed else 'append'
+                df.to_sql(table_name, conn, if_exists=if_exists, method=method)
+                number_rows += len(df.index)
+                logger.debug(
+                    f"Uploaded chunk {chunk_number} of {len(df.index)} rows to {table_name}"
+                )
+        return number_rows
+
+    @staticmethod
+    def _ensure_unique_key(connection, table_name: str, key_columns: List[str]):
+        """Create a unique index on key_columns unless the table's primary key is already key_columns"""
+        primary_key = inspect(connection).get_pk_constraint(table_name)
+        if primary_key['constrained_columns'] == key_columns:
+            return
+        index_name = f"{table_name}_{'_'.join(key_columns)}_key"
+        columns = ', '.join(f'"{column}"' for column in key_columns)
+        connection.exec_driver_sql(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS "{index_name}" ON "{table_name}" ({columns})'
+        )
+
+    @staticmethod
+    def upsert_to_db(connection,
+                     df: pd.DataFrame,
+                     table_name: str,
+                     key_columns: List[str],
+                     bulk_copy: bool = True,
+                     sql_dtypes: Dict = None) -> int:
+        """
+        This function accepts a dataframe and merges it into the table_name with
+        INSERT ... ON CONFLICT (key_columns) DO UPDATE. The rows are first loaded into a staging
+        table, with COPY FROM STDIN on Postgres, and cast to the column types of the target table.
+        The table is created, typed with sql_dtypes, if it does not exist. Pass a connection from engine.begin() so the
+        upsert commits together with any watermark written alongside it. Returns the number of rows.
+        """
+        logger.info(f"Upsert {len(df.index)} rows to: {table_name}")
+        method = DatabaseConnector._insert_method(connection, bulk_copy)
+        if not inspect(connection).has_table(table_name):
+            DatabaseConnector.create_table(connection, df, table_name, sql_dtypes)
+            df.to_sql(table_name, connection, if_exists='append', method=method)
+            DatabaseConnector._ensure_unique_key(connection, table_name, key_columns)
+            return len(df.index)
+
+        staging_table = f"{table_name}_staging"
+        df.to_sql(staging_table, connection, if_exists='replace', method=method)
+        DatabaseConnector._ensure_unique_key(connection, table_name, key_columns)
+        inspector = inspect(connection)
+        dialect = connection.dialect
+        target_types = {
+            column['name']: column['type'].compile(dialect=dialect)
+            for column in inspector.get_columns(table_name)
+        }
+        staging_types = {
+            column['name']: column['type'].compile(dialect=dialect)
+            for column in inspector.get_columns(staging_table)
+        }
+        # The target table was created with the sql_dtypes of its schema in config.py, e.g. UUID, the staging
+        # table with the types pandas infers, so only cast the columns whose types differ
+        selects = ', '.join(
+            f'"{name}"' if target_types.get(name) == staging_type else
+            f'CAST("{name}" AS {target_types[name]})'
+            for name, staging_type in staging_types.items())
+        columns = ', '.join(f'"{name}"' for name in staging_types)
+        conflict_columns = ', '.join(f'"{name}"' for name in key_columns)
+        updates = ', '.join(f'"{name}" = EXCLUDED."{name}"'
+                            for name in staging_types if name not in key_columns)
+        on_conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        # WHERE true stops SQLite parsing ON CONFLICT as a join constraint
+        connection.exec_driver_sql(
+            f'INSERT INTO "{table_name}" ({columns}) '
+            f'SELECT {selects} FROM "{staging_table}" WHERE true '
+            f'ON CONFLICT ({conflict_columns}) {on_conflict}')
+        connection.exec_driver_sql(f'DROP TABLE "{staging_table}"')
+        return len(df.index)
+
+    @staticmethod
+    def upsert_chunks_to_db(engine,
+                            chunks: Iterable[pd.DataFrame],
+                            table_name: str,
+                            key_columns: List[str],
+                            watermark_source: str = None,
+                            bulk_copy: bool = True,
+                            sql_dtypes: Dict = None) -> int:
+        """
+        This function accepts an iterable of dataframes, ordered by the first key column, and upserts
+        them to the table_name. Each chunk is committed in its own transaction together with the
+        largest value of the first key column as the high-watermark of watermark_source, so an
+        interrupted load resumes after the last committed chunk. Returns the number of rows upserted.
+        """
+        logger.info(f"Upsert dataframe chunks to: {table_name}")
+        number_rows = 0
+        for df in chunks:
+            if df.empty:
+                continue
+            with engine.begin() as conn:
+                number_rows += DatabaseConnector.upsert_to_db(
+                    conn, df, table_name, key_columns, bulk_copy=bulk_copy,
+                    sql_dtypes=sql_dtypes)
+                if watermark_source is not None:
+                    key = key_columns[0]
+                    keys = df.index.get_level_values(
+                        key) if key in df.index.names else df[key]
+                    DatabaseConnector.write_watermark(conn, watermark_source,
+                                                      keys.max())
+        return number_rows
+
+    @staticmethod
+    def read_watermark(engine, source: str) -> str or None:
+        """Returns the high-watermark recorded for the source, or None if it has not been loaded"""
+        with engine.connect() as conn:
+            if not inspect(conn).has_table(WATERMARK_TABLE):
+                return None
+            watermark = conn.execute(
+                text(f"SELECT watermark FROM {WATERMARK_TABLE} WHERE source = :source"),
+                {'source': source}).scalar()
+        logger.info(f"Watermark of {source}: {watermark}")
+        return watermark
+
+    @staticmethod
+    def write_watermark(connection, source: str, watermark):
+        """
+        Record the high-watermark of the source, e.g. the largest index loaded or an s3 ETag.
+        A watermark of None removes the source's watermark.
+        """
+        logger.info(f"Set watermark of {source} to {watermark}")
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} "
+            f"(source VARCHAR(255) PRIMARY KEY, watermark VARCHAR(255))")
+        if watermark is None:
+            connection.execute(
+                text(f"DELETE FROM {WATERMARK_TABLE} WHERE source = :source"),
+                {'source': source})
+            return
+        connection.execute(
+            text(f"INSERT INTO {WATERMARK_TABLE} (source, watermark) "
+                 f"VALUES (:source, :watermark) "
+                 f"ON CONFLICT (source) DO UPDATE SET watermark = EXCLUDED.watermark"),
+            {'source': source, 'watermark': str(watermark)})
+
+    @staticmethod
+    def read_row_hashes(engine, source: str) -> pd.Series:
+        """Returns the row hashes recorded when the source was last loaded"""
+        with engine.connect() as conn:
+            if not inspect(conn).has_table(ROW_HASH_TABLE):
+                return pd.Series([], dtype='int64')
+            df = pd.read_sql_query(
+                text(f"SELECT row_hash FROM {ROW_HASH_TABLE} WHERE source = :source"),
+                conn,
+                params={'source': source})
+        return df['row_hash'].astype('int64')
+
+    @staticmethod
+    def write_row_hashes(connection, source: str, row_hashes: pd.Series,
+                         bulk_copy: bool = True):
+        """Replace the row hashes recorded for the source"""
+        logger.info(f"Record {len(row_hashes)} row hashes of {source}")
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {ROW_HASH_TABLE} "
+            f"(source VARCHAR(255), row_hash BIGINT)")
+        connection.execute(
+            text(f"DELETE FROM {ROW_HASH_TABLE} WHERE source = :source"),
+            {'source': source})
+        pd.DataFrame({
+            'source': source,
+            'row_hash': row_hashes.to_numpy()
+        }).to_sql(ROW_HASH_TABLE,
+                  connection,
+                  if_exists='append',
+                  index=False,
+                  method=DatabaseConnector._insert_method(connection, bulk_copy))
+
+    @staticmethod
+    def run_sql_script(engine, filename: str):
+        """This function accepts a file of sql statements and runs them in a single transaction"""
+        logger.info(f"Run sql script: {filename}")
+        with open(filename, mode='r') as f:
+            sql = f.read()
+        with engine.begin() as conn:
+            conn.exec_driver_sql(sql)
+
+    @staticmethod
+    def _run_timed(engine, name: str, statements: List[str]) -> float:
+        """Run the statements in one transaction on a connection of their own, returning the seconds taken"""
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            for statement in statements:
+                conn.exec_driver_sql(statement)
+        seconds = time.perf_counter() - start
+        logger.info(f"{name} took {seconds:.2f}s")
+        run_report.add(StageStats(stage=f"constraint {name}", calls=1, wall_seconds=seconds))
+        return seconds
+
+    @staticmethod
+    def _primary_key_statements(engine, table_name: str, primary_key: str) -> List[str]:
+        """
+        Returns the statements adding primary_key to the table, none if it already has it.
+        sqlite can't add a primary key to an existing table, so a unique index is created instead.
+        """
+        if inspect(engine).get_pk_constraint(table_name)['constrained_columns'] == [primary_key]:
+            return []
+        if engine.dialect.name == 'postgresql':
+            return [
+                f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{table_name}_pkey" '
+                f'PRIMARY KEY ("{primary_key}")'
+            ]
+        return [
+            f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_pkey" ON "{table_name}" ("{primary_key}")'
+        ]
+
+    @staticmethod
+    def finalise_load(engine,
+                      primary_keys: Dict[str, str],
+                      table_name: str,
+                      foreign_keys: Dict[str, str],
+                      max_workers: int = FINALISE_MAX_WORKERS,
+                      unique_keys: Dict[str, str] = None) -> Dict[str, float]:
+        """
+        This function builds the keys and indexes of a loaded star schema. The primary_keys
+        (table: column) of the dimension tables, a unique index on their unique_keys (table: column), such
+        as the natural keys of tables keyed by surrogate keys, and an index on each of table_name's
+        foreign_keys (column: dimension table) are built at the same time on separate connections. The foreign keys
+        are then added NOT VALID, which doesn't scan table_name, and validated one at a time, as
+        validating takes a lock on table_name which conflicts with itself. Foreign keys are only added
+        on Postgres. Returns the seconds taken by each constraint and index.
+        """
+        logger.info(f"Finalise load of {table_name} and {list(primary_keys)}")
+        builds = {
+            f"{dimension_table}_pkey": DatabaseConnector._primary_key_statements(
+                engine, dimension_table, column)
+            for dimension_table, column in primary_keys.items()
+        }
+        builds.update({
+            f"{dimension_table}_{column}_key":
+            [f'CREATE UNIQUE INDEX IF NOT EXISTS "{dimension_table}_{column}_key" '
+             f'ON "{dimension_table}" ("{column}")']
+            for dimension_table, column in (unique_keys or {}).items()
+        })
+        builds.update({
+            f"ix_{table_name}_{column}":
+            [f'CREATE INDEX IF NOT EXISTS "ix_{table_name}_{column}" ON "{table_name}" ("{column}")']
+            for column in foreign_keys
+        })
+        timings = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(cpu_timed, DatabaseConnector._run_timed, engine, name, statements)
+                for name, statements in builds.items() if statements
+            }
+            # Raises the first error once every build has finished
+            timed_builds = {name: future.result() for name, future in futures.items()}
+        add_worker_cpu(sum(cpu_seconds for _, cpu_seconds in timed_builds.values()))
+        timings.update({name: seconds for name, (seconds, _) in timed_builds.items()})
+
+        if engine.dialect.name != 'postgresql':
+            logger.warning(f"Foreign keys of {table_name} not added, {engine.dialect.name} can't add "
+                           "constraints to an existing table")
+            return timings
+        existing = {foreign_key['name'] for foreign_key in inspect(engine).get_foreign_keys(table_name)}
+        for column, dimension_table in foreign_keys.items():
+            constraint = f"fk_{table_name}_{column}"
+            if constraint in existing:
+                continue
+            timings[constraint] = DatabaseConnector._run_timed(engine, constraint, [
+                f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{constraint}" FOREIGN KEY ("{column}") '
+                f'REFERENCES "{dimension_table}" ("{primary_keys[dimension_table]}") NOT VALID'
+            ])
+            timings[f"{constraint} validate"] = DatabaseConnector._run_timed(
+                engine, f"{constraint} validate",
+                [f'ALTER TABLE "{table_name}" VALIDATE CONSTRAINT "{constraint}"'])
+        return timings
@@ -0,0 +1,145 @@
+from collections import Counter
+import logging
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List
+
+import numpy as np
+import pandas as pd
+
+from config import DataType, dimensions, order
+from profiling import profile_methods, run_report, StageStats
+from quarantine import quarantine
+
+logger = logging.getLogger(__name__)
+
+# What to do with orders whose foreign key is missing from its dimension table: only report them, quarantine
+# them rather than load them, or load a stub dimension row holding only the missing key
+REPORT, QUARANTINE, STUB = 'report', 'quarantine', 'stub'
+ORPHAN_ACTIONS = (REPORT, QUARANTINE, STUB)
+
+
+class KeySet:
+    """
+    The keys of a dimension table. The index hashes them once, on the first lookup, rather than for every
+    chunk of orders as Series.isin would
+    """
+
+    def __init__(self, keys: pd.Series):
+        self.index = pd.Index(keys.dropna().unique(), dtype=object)
+
+    def add(self, keys: pd.Series):
+        """Add keys missing from the set"""
+        self.index = self.index.append(pd.Index(keys, dtype=object))
+
+    def orphans(self, keys: pd.Series) -> np.ndarray:
+        """
+        Returns a mask of the keys missing from the set, nulls are not orphans. Categorical keys are looked
+        up once per category and mapped to rows through their integer codes.
+        """
+        if isinstance(keys.dtype, pd.CategoricalDtype):
+            missing = self.index.get_indexer(keys.cat.categories) < 0
+            # Null codes are -1, which picks the False appended
+            return np.append(missing, False)[keys.cat.codes.to_numpy()]
+        return (self.index.get_indexer(keys) < 0) & keys.notna().to_numpy()
+
+
+@profile_methods
+class ReferentialIntegrity:
+    """
+    This class checks the foreign keys of orders against the keys of the cleaned dimension tables before
+    the orders are loaded, so orders missing a dimension row are found when they are loaded rather than
+    failing the foreign keys built at the end of the load. The keys of each dimension are collected as its
+    cleaned chunks are loaded, orders are checked once every dimension has been. The orphans of each
+    foreign key column are counted in the run report, and reported, quarantined or given stub dimension rows
+    by on_orphans. It is safe to use from the threads of the pipelines.
+
+    Attributes:
+        dimensions: the dimension DataTypes by table name
+        on_orphans: one of ORPHAN_ACTIONS
+        orphans: number of orphans of each foreign key column
+    """
+
+    def __init__(self, data_types: List[DataType] = dimensions, on_orphans: str = REPORT):
+        if on_orphans not in ORPHAN_ACTIONS:
+            raise ValueError(f"on_orphans must be one of {ORPHAN_ACTIONS}, not {on_orphans}")
+        self.dimensions = {data_type.table_name: data_type for data_type in data_types}
+        self.on_orphans = on_orphans
+        self.orphans = Counter()
+        self._lock = threading.Lock()
+        self._keys: Dict[str, List[pd.Series]] = {}
+        self._key_sets: Dict[str, KeySet] = {}
+
+    def _key_set(self, table_name: str) -> KeySet:
+        """Returns the keys of a loaded dimension table"""
+        with self._lock:
+            if table_name not in self._key_sets:
+                if table_name not in self._keys:
+                    raise ValueError(f"Load {table_name} before checking the foreign keys of orders")
+                keys = self._keys.pop(table_name)
+                self._key_sets[table_name] = KeySet(pd.concat(keys, ignore_index=True) if keys else
+                                                    pd.Series([], dtype=object))
+            return self._key_sets[table_name]
+
+    def check(self, df: pd.DataFrame,
+              load_stubs: Callable[[DataType, pd.DataFrame], None] = None) -> pd.DataFrame:
+        """
+        Check each foreign key column of orders df against its dimension table. Returns df without its
+        orphans when quarantining them, and df otherwise. Stub rows are handed to load_stubs before df is
+        returned, so they are loaded ahead of the orders referencing them.
+        """
+        columns = {
+            data_type.primary_key: table_name
+            for table_name, data_type in self.dimensions.items() if data_type.primary_key in df.columns
+        }
+        key_sets = {column: self._key_set(table_name) for column, table_name in columns.items()}
+        orphans = {column: key_set.orphans(df[column]) for column, key_set in key_sets.items()}
+        for column, mask in orphans.items():
+            number_orphans = int(mask.sum())
+            run_report.add(
+                StageStats(stage=f"orphans orders_table {column}",
+                           calls=1,
+                           rows_in=len(df.index),
+                           rows_out=len(df.index) - number_orphans))
+            if number_orphans:
+                with self._lock:
+                    self.orphans[column] += number_orphans
+                logger.warning(f"{number_orphans} orders have a {column} missing from {columns[column]}")
+        orphaned = np.logical_or.reduce([np.zeros(len(df.index), dtype=bool), *orphans.values()])
+        if not orphaned.any():
+            return df
+
+        if self.on_orphans == QUARANTINE:
+            rejected_rows = df.take(np.flatnonzero(orphaned))
+            rejected_rows['rule'] = np.select([mask[orphaned] for mask in orphans.values()],
+                                              [f"orphan {column}" for column in orphans])
+            rejected_rows['stage'] = 'check_orphans'
+            quarantine.add(order.table_name, rejected_rows)
+            return df.take(np.flatnonzero(~orphaned))
+        if self.on_orphans == STUB:
+            for column, mask in orphans.items():
+                if not mask.any():
+                    continue
+                missing_keys = pd.Series(df[column].to_numpy()[mask], dtype=object).unique()
+                data_type = self.dimensions[columns[column]]
+                key_sets[column].add(pd.Series(missing_keys, dtype=object))
+                logger.warning(f"Loading {len(missing_keys)} stub rows to {data_type.table_name}")
+                load_stubs(data_type, pd.DataFrame({column: missing_keys}))
+        return df
+
+    def check_chunks(self, data_type: DataType, chunks: Iterable[pd.DataFrame],
+                     load_stubs: Callable[[DataType, pd.DataFrame], None] = None) -> Iterator[pd.DataFrame]:
+        """
+        Pass through the cleaned chunks of a DataType about to be loaded, collecting the keys of a dimension
+        table or checking the foreign keys of orders. A dimension is loaded once its chunks run out
+        """
+        if data_type.table_name not in self.dimensions:
+            for chunk in chunks:
+                yield self.check(chunk, load_stubs)
+            return
+        keys = []
+        for chunk in chunks:
+            keys.append(chunk[data_type.primary_key].drop_duplicates())
+            yield chunk
+        with self._lock:
+            self._keys[data_type.table_name] = keys
+            self._key_sets.pop(data_type.table_name, None)
@@ -0,0 +1,342 @@
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from functools import partial
+import logging
+import os
+from typing import Callable, Collection, Dict, Iterable, Iterator, List, Type
+
+import pandas as pd
+
+from config import endpoints, DataType, LOAD_CHUNK_SIZE
+from data_cleaning import DataCleaning
+from data_extraction import DataExtractor
+from database_utils import DatabaseConnector
+from integrity import ReferentialIntegrity
+from profiling import run_report
+from quarantine import quarantine
+from scheduler import timed
+from staging import Staging, RAW, CLEANED
+from surrogate_keys import SurrogateKeys
+from validation import StreamValidator
+
+logger = logging.getLogger(__name__)
+
+EXTRACT, CLEAN, LOAD = 'extract', 'clean', 'load'
+STAGES = (EXTRACT, CLEAN, LOAD)
+
+
+def count_rows(chunks: Iterable[pd.DataFrame], counts: Counter,
+               stage: str) -> Iterator[pd.DataFrame]:
+    """Pass through dataframe chunks, adding the number of rows seen to counts[stage]"""
+    for chunk in chunks:
+        counts[stage] += len(chunk.index)
+        yield chunk
+
+
+def track_max_index(chunks: Iterable[pd.DataFrame],
+                    watermark: Dict) -> Iterator[pd.DataFrame]:
+    """Pass through dataframe chunks, keeping the largest index seen in watermark['index']"""
+    for chunk in chunks:
+        if not chunk.empty:
+            watermark['index'] = max(watermark.get('index', chunk.index.max()),
+                                     chunk.index.max())
+        yield chunk
+
+
+def split_chunks(chunks: Iterable[pd.DataFrame], chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Pass through dataframe chunks, splitting those longer than chunk_size rows into slices of chunk_size rows"""
+    for chunk in chunks:
+        if len(chunk.index) <= chunk_size:
+            yield chunk
+            continue
+        for start in range(0, len(chunk.index), chunk_size):
+            yield chunk.iloc[start:start + chunk_size]
+
+
+def reject_repeated_keys(chunks: Iterable[pd.DataFrame],
+                         validator: StreamValidator) -> Iterator[pd.DataFrame]:
+    """
+    Pass through cleaned chunks, dropping rows which repeat a unique key of an earlier chunk. Once every chunk
+    has passed, raises a ValueError if more than the tolerated fraction of the rows were rejected in total
+    """
+    for chunk in chunks:
+        repeated, report = validator.repeated(chunk)
+        chunk = DataCleaning.drop_rejected_rows(chunk, repeated, report, validator.table_name,
+                                                stage='reject_repeated_keys')
+        validator.count_out(len(chunk.index))
+        yield chunk
+    validator.check()
+
+
+def clean_dataframe(data_type: DataType, df: pd.DataFrame) -> pd.DataFrame:
+    """Clean df with the DataType's clean_function. Module level so it can run in a worker process"""
+    data_cleaner = DataCleaning(column_entries=data_type.column_entries,
+                                schema=data_type.schema,
+                                rules=data_type.rules,
+                                max_rejected_fraction=data_type.max_rejected_fraction)
+    return getattr(data_cleaner, data_type.clean_function)(df=df)
+
+
+def reset_worker():
+    """Worker process initializer, workers start without any stats and rejected rows left in the process"""
+    run_report.reset()
+    quarantine.reset()
+
+
+def clean_dataframe_in_worker(data_type: DataType, df: pd.DataFrame):
+    """
+    Clean df in a worker process, returning the cleaned df with the stage stats and rejected rows
+    collected by the worker
+    """
+    try:
+        df = clean_dataframe(data_type, df)
+    except ValueError as error:
+        # Return the rows rejected before the failure with the error, so they are still quarantined
+        return error, run_report.pop_stats(), quarantine.pop()
+    return df, run_report.pop_stats(), quarantine.pop()
+
+
+def run_cleaning(cleaning_pool: ProcessPoolExecutor or None, data_type: DataType,
+                 df: pd.DataFrame) -> pd.DataFrame:
+    """Clean df in the cleaning process pool, or in this process when there is no pool"""
+    if cleaning_pool is None:
+        return clean_dataframe(data_type, df)
+    df_cleaned, stats, rejected = cleaning_pool.submit(clean_dataframe_in_worker, data_type,
+                                                       df).result()
+    run_report.merge(stats)
+    quarantine.merge(rejected)
+    if isinstance(df_cleaned, Exception):
+        raise df_cleaned
+    return df_cleaned
+
+
+@dataclass
+class RunContext:
+    """
+    The databases, extractor, cleaning pool and stages shared by the pipelines of a run. With integrity the
+    foreign keys of orders are checked against the dimension tables before they are loaded. With surrogate_keys
+    the dimension tables are loaded with surrogate keys, which the foreign keys of orders are mapped to.
+    """
+    source_engine: object
+    target_engine: object
+    target_db: DatabaseConnector = field(default_factory=DatabaseConnector)
+    data_extractor: DataExtractor = field(default_factory=DataExtractor)
+    cleaning_pool: ProcessPoolExecutor = None
+    stages: Collection[str] = STAGES
+    staging: Staging = None
+    integrity: ReferentialIntegrity = None
+    surrogate_keys: SurrogateKeys = None
+
+
+class SourceReader(ABC):
+    """
+    Extracts the Source of a DataType as a stream of dataframes. A reader is registered for a kind of
+    source with register_reader. Readers of incremental sources watch the chunks go by and record what
+    was loaded in the target database for the next incremental run. The validator of the reader checks the
+    rules which span the chunks of the stream.
+    """
+
+    def __init__(self, data_type: DataType, context: RunContext):
+        self.data_type = data_type
+        self.source = data_type.source
+        self.context = context
+        self.validator = StreamValidator(data_type.table_name, data_type.rules, data_type.max_rejected_fraction)
+
+    @abstractmethod
+    def extract(self) -> Iterator[pd.DataFrame]:
+        """Yields the extracted data, in chunks when the source can be read in chunks"""
+
+    def watch_raw(self, chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Pass through the raw chunks about to be cleaned"""
+        return chunks
+
+    def watch_cleaned(self, chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Pass through the cleaned chunks about to be loaded"""
+        return chunks
+
+    def record_load(self, connection):
+        """Record what was loaded once every chunk has been loaded"""
+
+
+READERS: Dict[str, Type[SourceReader]] = {}
+
+
+def register_reader(kind: str) -> Callable[[Type[SourceReader]], Type[SourceReader]]:
+    """Class decorator registering a SourceReader for sources of the kind"""
+
+    def register(reader: Type[SourceReader]) -> Type[SourceReader]:
+        READERS[kind] = reader
+        return reader
+
+    return register
+
+
+@register_reader('rds_table')
+class RdsTableReader(SourceReader):
+    """Streams a table of the source database in chunks, incremental tables record the largest index loaded"""
+
+    def __init__(self, data_type: DataType, context: RunContext):
+        super().__init__(data_type, context)
+        self.watermark = {}
+
+    def extract(self) -> Iterator[pd.DataFrame]:
+        with self.context.source_engine.execution_options(
+                isolation_level='AUTOCOMMIT').connect() as conn:
+            yield from self.context.data_extractor.read_rds_table_in_chunks(conn, self.source.location)
+
+    def watch_cleaned(self, chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        return track_max_index(chunks, self.watermark) if self.source.incremental else chunks
+
+    def record_load(self, connection):
+        if self.source.incremental:
+            self.context.target_db.write_watermark(connection, self.source.location,
+                                                   self.watermark.get('index'))
+
+
+@register_reader('s3')
+class S3Reader(SourceReader):
+    """
+    Reads a csv or json object from s3, in chunks when the extractor streams s3. Incremental objects
+    record their ETag and row hashes
+    """
+
+    def __init__(self, data_type: DataType, context: RunContext):
+        super().__init__(data_type, context)
+        self.etag = None
+        self.row_hashes: List[pd.Series] = []
+
+    def extract(self) -> Iterator[pd.DataFrame]:
+        data_extractor = self.context.data_extractor
+        if self.source.incremental:
+            self.etag = data_extractor.get_s3_etag(self.source.location)
+        if data_extractor.stream_s3:
+            yield from data_extractor.stream_from_s3(self.source.location)
+        else:
+            yield data_extractor.extract_from_s3(s3_address=self.source.location)
+
+    def watch_raw(self, chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        if not self.source.incremental:
+            return chunks
+        return self._hash_rows(chunks)
+
+    def _hash_rows(self, chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        # Hashed before cleaning, which changes the chunks in place
+        for chunk in chunks:
+            self.row_hashes.append(self.context.data_extractor.hash_rows(chunk))
+            yield chunk
+
+    def record_load(self, connection):
+        if not self.source.incremental:
+            return
+        if CLEAN not in self.context.stages:
+            # Loading from staging, hash the staged raw rows
+            self.row_hashes = [
+                self.context.data_extractor.hash_rows(chunk)
+                for chunk in self.context.staging.read_chunks(self.data_type.table_name, RAW)
+            ]
+        # The ETag is unknown when not extracting, so the next run compares row hashes
+        target_db = self.context.target_db
+        target_db.write_watermark(connection, self.source.location, self.etag)
+        row_hashes = pd.concat(self.row_hashes) if self.row_hashes else pd.Series([], dtype='int64')
+        target_db.write_row_hashes(connection, self.source.location, row_hashes)
+
+
+@register_reader('pdf')
+class PdfReader(SourceReader):
+    """Reads the tables of every page of a pdf file"""
+
+    def extract(self) -> Iterator[pd.DataFrame]:
+        yield self.context.data_extractor.retrieve_pdf_data(pdf_path=self.source.location)
+
+
+@register_reader('store_api')
+class StoreApiReader(SourceReader):
+    """Requests every store from the store details API"""
+
+    def extract(self) -> Iterator[pd.DataFrame]:
+        headers = {
+            "Content-Type": "application/json",
+            "X-API-KEY": os.getenv('x-api-key')
+        }
+        data_extractor = self.context.data_extractor
+        num_stores = data_extractor.list_number_of_stores(url=endpoints.number_of_stores,
+                                                          headers=headers)
+        yield data_extractor.retrieve_stores_data(url=self.source.location,
+                                                  headers=headers,
+                                                  number_stores=num_stores)
+
+
+def load_stub_rows(context: RunContext, data_type: DataType, df: pd.DataFrame):
+    """Append stub rows, holding only the keys orders reference, to a dimension table already loaded"""
+    if context.surrogate_keys is not None:
+        df = context.surrogate_keys.assign(data_type, df)
+    with context.target_engine.begin() as conn:
+        context.target_db.append_to_db(conn, df, data_type.table_name)
+
+
+def stream_stages(data_type: DataType, context: RunContext, reader: SourceReader,
+                  counts: Counter) -> Iterator[pd.DataFrame]:
+    """
+    Chain the extract and clean stages over a stream of dataframe chunks, staging the output of each.
+    A stage which is not run is replaced by reading its output from staging.
+    """
+    stages, staging = context.stages, context.staging
+    if EXTRACT in stages:
+        chunks = count_rows(reader.extract(), counts, 'extracted')
+        if staging is not None:
+            chunks = staging.write_chunks(data_type.table_name, RAW, chunks)
+    elif CLEAN in stages:
+        chunks = staging.read_chunks(data_type.table_name, RAW)
+    else:
+        chunks = staging.read_chunks(data_type.table_name, CLEANED)
+
+    if CLEAN in stages:
+        chunks = reader.watch_raw(chunks)
+        chunks = reader.validator.count_in(chunks)
+        # The rejected fraction is checked against the totals of the stream by the validator rather than per chunk
+        chunks = DataCleaning.clean_chunks(
+            chunks, partial(run_cleaning, context.cleaning_pool, replace(data_type, max_rejected_fraction=None)))
+        chunks = reject_repeated_keys(chunks, reader.validator)
+        chunks = count_rows(chunks, counts, 'cleaned')
+        if staging is not None:
+            chunks = staging.write_chunks(data_type.table_name, CLEANED, chunks)
+    return chunks
+
+
+def run_pipeline(data_type: DataType, context: RunContext):
+    """
+    Extract -> Clean -> Load the DataType, with the reader registered for its source. The data is
+    streamed from stage to stage one chunk at a time, and loaded as each chunk is cleaned. Rows repeating a
+    unique key of an earlier chunk are rejected, and the load fails if too many rows were rejected across the
+    whole stream. Sources read in one piece are cleaned whole, then loaded in slices of LOAD_CHUNK_SIZE rows.
+    The foreign keys of the slices are checked and surrogate keys assigned to them as they are loaded.
+    """
+    print(f"Processing {data_type.name} Data")
+    reader = READERS[data_type.source.kind](data_type, context)
+    counts = Counter()
+    chunks = stream_stages(data_type, context, reader, counts)
+    with timed(f"{data_type.name} {', '.join(context.stages)}"):
+        if LOAD in context.stages:
+            chunks = reader.watch_cleaned(split_chunks(chunks, LOAD_CHUNK_SIZE))
+            if context.integrity is not None:
+                chunks = context.integrity.check_chunks(data_type, chunks,
+                                                        partial(load_stub_rows, context))
+            sql_dtypes = data_type.schema.sql_dtypes
+            if context.surrogate_keys is not None:
+                chunks = context.surrogate_keys.map_chunks(data_type, chunks)
+                sql_dtypes = context.surrogate_keys.sql_dtypes(data_type)
+            context.target_db.upload_chunks_to_db(context.target_engine,
+                                                  chunks=chunks,
+                                                  table_name=data_type.table_name,
+                                                  sql_dtypes=sql_dtypes)
+            with context.target_engine.begin() as conn:
+                reader.record_load(conn)
+        else:
+            deque(chunks, maxlen=0)
+
+    if EXTRACT in context.stages:
+        print(f"{data_type.name} rows extracted: {counts['extracted']}")
+    if CLEAN in context.stages:
+        print(f"{data_type.name} rows after cleaning: {counts['cleaned']}")
@@ -0,0 +1,229 @@
+import cProfile
+from dataclasses import dataclass, asdict, replace
+from datetime import datetime
+import functools
+import inspect
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Set to a stage name e.g. DataCleaning.clean_user_data to dump a cProfile of that stage
+PROFILE_STAGE_ENV = 'PIPELINE_PROFILE_STAGE'
+PROFILE_DIR = Path('profiles')
+# Written with the report, as the peak RSS can't be tied to a single stage
+METRIC_NOTES = {
+    'cpu_seconds': 'cpu time of the thread running the stage and of the pool workers it waited on',
+    'process_peak_rss_bytes': 'process-wide, the peak RSS of the whole process when the stage last returned, '
+                              'raised by every thread running at the time rather than by the stage',
+}
+
+
+@dataclass
+class StageStats:
+    """
+    Totals across every call of a stage. cpu_seconds counts the thread running the stage and the thread or process
+    pool workers it handed work to. process_peak_rss_bytes is the peak RSS of the whole process when the stage last
+    returned. It is a high-water mark raised by every thread running at the time, not the memory of the stage, as
+    the pipelines run in threads at once.
+    bytes_in and bytes_out are the memory used by dataframes, only recorded by stages which measure it.
+    """
+    stage: str
+    calls: int = 0
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    process_peak_rss_bytes: int = 0
+    rows_in: int = 0
+    rows_out: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+
+    def add(self, other: 'StageStats'):
+        self.calls += other.calls
+        self.wall_seconds += other.wall_seconds
+        self.cpu_seconds += other.cpu_seconds
+        self.process_peak_rss_bytes = max(self.process_peak_rss_bytes, other.process_peak_rss_bytes)
+        self.rows_in += other.rows_in
+        self.rows_out += other.rows_out
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+
+
+class RunReport:
+    """Collects StageStats from every profiled call in this process, it is safe to use from threads"""
+
+    def __init__(self):
+        self.started = datetime.now()
+        self._lock = threading.Lock()
+        self._stages: Dict[str, StageStats] = {}
+
+    def reset(self):
+        """Discard all stats. Used as a worker process initializer so forked workers start empty"""
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stats: StageStats):
+        with self._lock:
+            self._stages.setdefault(stats.stage,
+                                    StageStats(stage=stats.stage)).add(stats)
+
+    def merge(self, stats: List[StageStats]):
+        """Add stats collected in another process"""
+        for stage_stats in stats:
+            self.add(stage_stats)
+
+    def stats(self) -> List[StageStats]:
+        """Return a copy of the stats collected so far"""
+        with self._lock:
+            return [replace(stats) for stats in self._stages.values()]
+
+    def pop_stats(self) -> List[StageStats]:
+        """Return and clear the stats collected so far"""
+        with self._lock:
+            stats, self._stages = list(self._stages.values()), {}
+        return stats
+
+    def write(self, filename: str, task_timings: Dict[str, float] = None):
+        """Write the stage stats and task wall times as a json run report"""
+        with self._lock:
+            stages = [asdict(stats) for stats in self._stages.values()]
+        report = {
+            'run_started': self.started.isoformat(timespec='seconds'),
+            'tasks': task_timings or {},
+            'metrics': METRIC_NOTES,
+            'stages': stages,
+        }
+        with open(filename, mode='w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Run report written to {filename}")
+
+
+run_report = RunReport()
+
+
+class _WorkerCpu(threading.local):
+    """Cpu seconds of pool workers for each stage running in a thread, the innermost stage last"""
+
+    def __init__(self):
+        self.stages: List[float] = []
+
+
+_worker_cpu = _WorkerCpu()
+
+
+def cpu_timed(function: Callable, *args, **kwargs) -> Tuple[Any, float]:
+    """
+    Returns the result of function with the cpu time it took. Module level so pool workers can run it, their
+    time is then added to the waiting stage with add_worker_cpu
+    """
+    start = time.thread_time()
+    result = function(*args, **kwargs)
+    return result, time.thread_time() - start
+
+
+def add_worker_cpu(seconds: float):
+    """Count cpu time spent by pool workers in the stage running in this thread"""
+    if _worker_cpu.stages:
+        _worker_cpu.stages[-1] += seconds
+
+
+def _peak_rss_bytes() -> int:
+    """Returns the peak resident set size of this process"""
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes on Linux
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _count_rows(args, kwargs) -> int:
+    """Returns the number of rows in the first dataframe argument"""
+    for value in [*args, *kwargs.values()]:
+        if isinstance(value, pd.DataFrame):
+            return len(value.index)
+    return 0
+
+
+def _call_with_cprofile(stage: str, function: Callable, *args, **kwargs):
+    """Run function under cProfile, dumping the stats to PROFILE_DIR"""
+    PROFILE_DIR.mkdir(exist_ok=True)
+    profile_path = PROFILE_DIR / f"{stage}_{os.getpid()}_{time.time_ns()}.prof"
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile_path)
+        logger.info(f"cProfile for {stage} written to {profile_path}")
+
+
+def profiled(stage: str) -> Callable:
+    """Decorator recording wall time, cpu time, the process peak RSS and rows in/out for each call"""
+
+    def decorator(function: Callable) -> Callable:
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            rows_in = _count_rows(args, kwargs)
+            stages = _worker_cpu.stages
+            stages.append(0.0)
+            start_cpu = time.thread_time()
+            start = time.perf_counter()
+            try:
+                if os.environ.get(PROFILE_STAGE_ENV) == stage:
+                    result = _call_with_cprofile(stage, function, *args,
+                                                 **kwargs)
+                else:
+                    result = function(*args, **kwargs)
+            finally:
+                worker_cpu = stages.pop()
+                if stages:
+                    # The enclosing stage's thread time doesn't include the workers either
+                    stages[-1] += worker_cpu
+                stats = StageStats(
+                    stage=stage,
+                    calls=1,
+                    wall_seconds=time.perf_counter() - start,
+                    cpu_seconds=time.thread_time() - start_cpu + worker_cpu,
+                    process_peak_rss_bytes=_peak_rss_bytes(),
+                    rows_in=rows_in)
+            if isinstance(result, pd.DataFrame):
+                stats.rows_out = len(result.index)
+            run_report.add(stats)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def profile_methods(cls):
+    """
+    Class decorator which profiles every method of the class as stage '<class>.<method>'.
+    Generator methods are skipped, their work happens as the caller consumes them.
+    """
+    for name, attribute in list(vars(cls).items()):
+        if name.startswith('__'):
+            continue
+        if isinstance(attribute, (staticmethod, classmethod)):
+            function = attribute.__func__
+            if inspect.isgeneratorfunction(function):
+                continue
+            wrapped = profiled(f"{cls.__name__}.{name}")(function)
+            setattr(cls, name, type(attribute)(wrapped))
+        elif inspect.isfunction(attribute) and not inspect.isgeneratorfunction(
+                attribute):
+            setattr(cls, name, profiled(f"{cls.__name__}.{name}")(attribute))
+    return cls
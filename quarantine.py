@@ -0,0 +1,103 @@
+from datetime import datetime
+import logging
+import threading
+from typing import Dict, List
+
+import pandas as pd
+from sqlalchemy.types import TEXT
+
+from database_utils import DatabaseConnector
+from profiling import StageStats, run_report
+from staging import Staging, REJECTED
+
+logger = logging.getLogger(__name__)
+
+
+class Quarantine:
+    """
+    Collects the rows rejected during cleaning in this process, tagged with the rule and stage which
+    rejected them, to be written in one batch at the end of the run. It is safe to use from threads.
+    """
+
+    def __init__(self):
+        self.started = datetime.now()
+        self._lock = threading.Lock()
+        self._rejected: Dict[str, List[pd.DataFrame]] = {}
+
+    def reset(self):
+        """Discard all rejected rows. Used as a worker process initializer so forked workers start empty"""
+        self._lock = threading.Lock()
+        self._rejected = {}
+
+    def add(self, table_name: str, df: pd.DataFrame):
+        with self._lock:
+            self._rejected.setdefault(table_name, []).append(df)
+
+    def merge(self, rejected: Dict[str, List[pd.DataFrame]]):
+        """Add rows rejected in another process"""
+        for table_name, dfs in rejected.items():
+            for df in dfs:
+                self.add(table_name, df)
+
+    def pop(self) -> Dict[str, List[pd.DataFrame]]:
+        """Return and clear the rows rejected so far"""
+        with self._lock:
+            rejected, self._rejected = self._rejected, {}
+        return rejected
+
+    def frames(self) -> Dict[str, pd.DataFrame]:
+        """Returns the rows rejected from each table as one dataframe, with the time the run started"""
+        with self._lock:
+            rejected = {table_name: list(dfs) for table_name, dfs in self._rejected.items()}
+        frames = {}
+        for table_name, dfs in rejected.items():
+            df = pd.concat(dfs) if len(dfs) > 1 else dfs[0].copy()
+            df['run_started'] = self.started
+            frames[table_name] = df
+        return frames
+
+    @staticmethod
+    def _as_text(df: pd.DataFrame) -> pd.DataFrame:
+        """Returns the rejected rows with every column but run_started as strings, nulls are kept"""
+        columns = df.columns.drop('run_started')
+        return df.astype({column: 'string' for column in columns})
+
+    def write_to_db(self, engine):
+        """
+        Append the rejected rows of each table to <table>_rejected in one transaction. The rows are written as
+        text, as the types of a rejected column vary from run to run, e.g. a batch of all null rows is float.
+        The rows of each table written, none when the write fails, are recorded as quarantine <table> stages.
+        """
+        frames = self.frames()
+        if not frames:
+            return
+        try:
+            with engine.begin() as conn:
+                for table_name, df in frames.items():
+                    logger.info(f"Quarantine {len(df.index)} rows rejected from {table_name}")
+                    df = self._as_text(df)
+                    DatabaseConnector.append_to_db(conn, df, f"{table_name}_rejected",
+                                                   sql_dtypes={column: TEXT for column in df.columns
+                                                               if column != 'run_started'})
+        except Exception:
+            self._record_write(frames, written=False)
+            raise
+        self._record_write(frames, written=True)
+
+    @staticmethod
+    def _record_write(frames: Dict[str, pd.DataFrame], written: bool):
+        """Record the rows of each table to quarantine, and those written, in the run report"""
+        for table_name, df in frames.items():
+            run_report.add(
+                StageStats(stage=f"quarantine {table_name}",
+                           calls=1,
+                           rows_in=len(df.index),
+                           rows_out=len(df.index) if written else 0))
+
+    def write_to_staging(self, staging: Staging):
+        """Stage the rejected rows of each table as parquet next to its raw and cleaned data"""
+        for table_name, df in self.frames().items():
+            staging.write(table_name, REJECTED, df)
+
+
+quarantine = Quarantine()
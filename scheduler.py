@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Task:
+    name: str
+    function: Callable
+    depends_on: List[str] = field(default_factory=list)
+
+
+@contextmanager
+def timed(stage: str):
+    """Log and print the wall clock time taken by the stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        logger.info(f"{stage} took {seconds:.2f}s")
+        print(f"{stage} took {seconds:.2f}s")
+
+
+def run_tasks(tasks: List[Task], max_workers: int) -> Dict[str, float]:
+    """
+    Runs the tasks on a pool of max_workers threads. Each task is started as soon as the tasks it
+    depends on have finished. If a task fails, no further tasks are started and the error is
+    raised once the running tasks finish. Returns the wall clock seconds taken by each task.
+    """
+    names = {task.name for task in tasks}
+    for task in tasks:
+        unknown = set(task.depends_on) - names
+        if unknown:
+            raise ValueError(f"Task {task.name} depends on unknown tasks {unknown}")
+
+    pending = {task.name: task for task in tasks}
+    finished = set()
+    timings = {}
+    running = {}
+
+    def timed_call(task: Task):
+        start = time.perf_counter()
+        task.function()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            ready = [task for task in pending.values() if finished.issuperset(task.depends_on)]
+            for task in ready:
+                logger.info(f"Start task {task.name}")
+                running[executor.submit(timed_call, task)] = task.name
+                del pending[task.name]
+
+            if not running:
+                raise ValueError(f"Tasks {list(pending)} have circular dependencies")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    logger.error(f"Task {name} failed: {future.exception()}")
+                    pending.clear()
+                    wait(running)
+                    raise future.exception()
+                timings[name] = future.result()
+                finished.add(name)
+                logger.info(f"Finished task {name} in {timings[name]:.2f}s")
+
+    return timings
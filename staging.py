@@ -0,0 +1,132 @@
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+import shutil
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from config import STAGING_COMPRESSION
+from profiling import profile_methods
+
+logger = logging.getLogger(__name__)
+
+# Names of the dataframes staged for each source
+RAW = 'raw'
+CLEANED = 'cleaned'
+# Rows rejected during cleaning
+REJECTED = 'rejected'
+
+
+def read_parquet(path: Path) -> pd.DataFrame:
+    """
+    Returns a parquet file as a dataframe, memory mapping the file rather than reading it into a buffer.
+    Parquet nulls in string columns are read as None, set them to nan as pandas does.
+    """
+    df = pq.read_table(path, memory_map=True).to_pandas()
+    for column in df.select_dtypes(include='object').columns:
+        df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
+
+
+def _to_arrow_compatible(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns df with the values of object columns holding a mix of types, e.g. ints and strings, as strings"""
+    mixed_columns = [
+        column for column in df.select_dtypes(include='object').columns
+        if pd.api.types.infer_dtype(df[column], skipna=True).startswith('mixed')
+    ]
+    if not mixed_columns:
+        return df
+    logger.debug(f"Store mixed type columns {mixed_columns} as strings")
+    df = df.copy()
+    for column in mixed_columns:
+        df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+
+@profile_methods
+class Staging:
+    """
+    This class stages the output of each pipeline stage as compressed parquet, so a later stage can be run
+    without repeating the earlier ones. Files are partitioned by source and run id:
+    <staging_dir>/<source>/run_id=<run_id>/<raw|cleaned>/part-00000.parquet
+
+    Attributes:
+        staging_dir: Directory the parquet files are written to
+        run_id: Identifies the run whose files are written and read
+    """
+
+    def __init__(self, staging_dir: str, run_id: str):
+        self.staging_dir = Path(staging_dir)
+        self.run_id = run_id
+
+    @staticmethod
+    def new_run_id() -> str:
+        """Returns a run id for a new run, run ids sort in the order they were created"""
+        return datetime.now().strftime('%Y%m%dT%H%M%S')
+
+    @staticmethod
+    def latest_run_id(staging_dir: str) -> str or None:
+        """Returns the most recent run id in the staging directory, or None if nothing has been staged"""
+        run_ids = [
+            path.name.removeprefix('run_id=')
+            for path in Path(staging_dir).glob('*/run_id=*') if path.is_dir()
+        ]
+        return max(run_ids, default=None)
+
+    def stage_dir(self, source: str, name: str) -> Path:
+        """Returns the directory holding the staged dataframe of the source"""
+        return self.staging_dir / source / f"run_id={self.run_id}" / name
+
+    def _write_part(self, directory: Path, part_number: int, df: pd.DataFrame):
+        """Write a part file, to a temporary path first so readers never see a partial file"""
+        path = directory / f"part-{part_number:05d}.parquet"
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            _to_arrow_compatible(df).to_parquet(tmp_path,
+                                                engine='pyarrow',
+                                                compression=STAGING_COMPRESSION)
+            tmp_path.replace(path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def _clear(self, source: str, name: str) -> Path:
+        """Remove anything staged before for the source in this run, returning the empty directory"""
+        directory = self.stage_dir(source, name)
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir(parents=True)
+        return directory
+
+    def write(self, source: str, name: str, df: pd.DataFrame):
+        """Stage the dataframe, replacing anything staged before for the source in this run"""
+        directory = self._clear(source, name)
+        logger.info(f"Stage {len(df.index)} rows of {source} {name} in {directory}")
+        self._write_part(directory, 0, df)
+
+    def write_chunks(self, source: str, name: str,
+                     chunks: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Pass through dataframe chunks, staging each one as a part file as it goes by"""
+        directory = self._clear(source, name)
+        logger.info(f"Stage chunks of {source} {name} in {directory}")
+        for part_number, chunk in enumerate(chunks):
+            self._write_part(directory, part_number, chunk)
+            yield chunk
+
+    def read_chunks(self, source: str, name: str) -> Iterator[pd.DataFrame]:
+        """Yields the staged part files of the source in the order they were written"""
+        directory = self.stage_dir(source, name)
+        paths = sorted(directory.glob('part-*.parquet'))
+        if not paths:
+            raise FileNotFoundError(
+                f"Nothing staged for {source} {name} in run {self.run_id}, run the earlier stages first")
+        logger.info(f"Read {len(paths)} staged parts of {source} {name} from {directory}")
+        for path in paths:
+            yield read_parquet(path)
+
+    def read(self, source: str, name: str) -> pd.DataFrame:
+        """Returns the staged dataframe of the source"""
+        chunks = list(self.read_chunks(source, name))
+        return chunks[0] if len(chunks) == 1 else pd.concat(chunks)
@@ -0,0 +1,141 @@
+import logging
+import threading
+from typing import Dict, Iterable, Iterator, List
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect
+from sqlalchemy.types import INTEGER
+
+from config import DataType, dimensions, order
+from profiling import profile_methods
+
+logger = logging.getLogger(__name__)
+
+# Surrogate keys are 4 byte integers, nullable in orders_table for orders missing a dimension row
+KEY_DTYPE = 'Int32'
+
+
+def key_positions(keys: pd.Series, dimension_keys: pd.Series) -> np.ndarray:
+    """
+    Returns the row of dimension_keys matching each key, -1 where there is none. Categorical keys are
+    looked up once per category and mapped to rows through their integer codes.
+    """
+    index = pd.Index(dimension_keys)
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        category_rows = index.get_indexer(keys.cat.categories)
+        codes = keys.cat.codes.to_numpy()
+        return np.where(codes >= 0, category_rows[codes], -1)
+    return index.get_indexer(keys)
+
+
+def join_keys(connection, data_types: List[DataType] = dimensions) -> Dict[str, str]:
+    """
+    Returns the column orders_table references each dimension table by, its surrogate key when
+    orders_table was loaded with surrogate keys and its primary key otherwise
+    """
+    columns = {column['name'] for column in inspect(connection).get_columns(order.table_name)}
+    return {
+        data_type.table_name:
+        data_type.surrogate_key if data_type.surrogate_key in columns else data_type.primary_key
+        for data_type in data_types
+    }
+
+
+@profile_methods
+class SurrogateKeys:
+    """
+    This class numbers the rows of the dimension tables with integer surrogate keys as they are loaded,
+    and rewrites the foreign keys of orders_table from the natural keys of the dimensions to their
+    surrogate keys, so orders_table holds 4 byte integers in place of uuids and codes and the reports join
+    on them. The natural keys stay in the dimension tables. Orders are mapped once every dimension has
+    been loaded. It is safe to use from the threads of the pipelines.
+
+    Attributes:
+        dimensions: the dimension DataTypes by table name
+    """
+
+    def __init__(self, data_types: List[DataType] = dimensions):
+        self.dimensions = {data_type.table_name: data_type for data_type in data_types}
+        self._lock = threading.Lock()
+        # Natural keys of each dimension in surrogate key order, one series per chunk loaded
+        self._natural_keys: Dict[str, List[pd.Series]] = {}
+        self._loaded = set()
+        self._lookups: Dict[str, pd.Series] = {}
+
+    def assign(self, data_type: DataType, df: pd.DataFrame) -> pd.DataFrame:
+        """Returns df with the next surrogate keys of its dimension table as the first column"""
+        codes, natural_keys = pd.factorize(df[data_type.primary_key], use_na_sentinel=False)
+        with self._lock:
+            chunks = self._natural_keys.setdefault(data_type.table_name, [])
+            first_key = sum(len(chunk) for chunk in chunks) + 1
+            chunks.append(pd.Series(natural_keys))
+            # Stub rows are numbered after orders have been mapped
+            self._lookups.pop(data_type.table_name, None)
+        df = df.copy(deep=False)
+        df.insert(0, data_type.surrogate_key, (codes + first_key).astype(np.int32))
+        return df
+
+    def _lookup(self, table_name: str) -> pd.Series:
+        """Returns the surrogate keys of a loaded dimension table indexed by its natural keys"""
+        with self._lock:
+            if table_name not in self._lookups:
+                natural_keys = self._natural_keys.get(table_name, [])
+                natural_keys = pd.concat(natural_keys, ignore_index=True) if natural_keys else pd.Series([])
+                lookup = pd.Series(np.arange(1, len(natural_keys) + 1, dtype=np.int32),
+                                   index=natural_keys.to_numpy())
+                # A natural key loaded twice fails the primary key, orders reference the first
+                self._lookups[table_name] = lookup[~lookup.index.duplicated()]
+            return self._lookups[table_name]
+
+    def map_foreign_keys(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Returns orders df with the natural key of each dimension replaced by the dimension's surrogate key,
+        null for orders missing a dimension row
+        """
+        with self._lock:
+            not_loaded = sorted(set(self.dimensions) - self._loaded)
+        if not_loaded:
+            raise ValueError(f"Load {', '.join(not_loaded)} before mapping the foreign keys of orders")
+        for table_name, data_type in self.dimensions.items():
+            natural_key = data_type.primary_key
+            if natural_key not in df.columns:
+                continue
+            lookup = self._lookup(table_name)
+            rows = key_positions(df[natural_key], lookup.index)
+            rows[df[natural_key].isna().to_numpy()] = -1
+            missing = rows < 0
+            if missing.any():
+                logger.warning(f"{missing.sum()} orders have no row in {table_name}, their "
+                               f"{data_type.surrogate_key} is null")
+            keys = pd.arrays.IntegerArray(lookup.to_numpy()[np.where(missing, 0, rows)], missing)
+            position = df.columns.get_loc(natural_key)
+            df = df.drop(columns=natural_key)
+            df.insert(position, data_type.surrogate_key, keys)
+        return df
+
+    def map_chunks(self, data_type: DataType,
+                   chunks: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """
+        Pass through the chunks of a DataType about to be loaded, numbering the rows of a dimension table
+        or mapping the foreign keys of orders. A dimension is loaded once its chunks run out
+        """
+        if data_type.table_name not in self.dimensions:
+            for chunk in chunks:
+                yield self.map_foreign_keys(chunk)
+            return
+        for chunk in chunks:
+            yield self.assign(data_type, chunk)
+        with self._lock:
+            self._loaded.add(data_type.table_name)
+
+    def sql_dtypes(self, data_type: DataType) -> Dict:
+        """Returns the sql_dtypes of the DataType's table with its surrogate key columns in place of natural keys"""
+        sql_dtypes = dict(data_type.schema.sql_dtypes)
+        if data_type.table_name in self.dimensions:
+            sql_dtypes[data_type.surrogate_key] = INTEGER
+            return sql_dtypes
+        for dimension in self.dimensions.values():
+            sql_dtypes.pop(dimension.primary_key, None)
+            sql_dtypes[dimension.surrogate_key] = INTEGER
+        return sql_dtypes
@@ -0,0 +1,311 @@
+"""
+Synthetic raw data for every source, dirty in the ways the sources are, at any scale of the size of the sources.
+Used to measure the pipeline at volumes the sources don't have, see benchmarks/bench_scale.py.
+"""
+import calendar
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from config import (DataType, card, data_types, date_times, order, product, store, user, valid_card_providers,
+                    valid_categories)
+from validation import validate
+
+# Fraction of the rows of a source which are NULL in every column, and which are random strings in every column.
+# Both are rejected by cleaning
+NULL_ROWS_FRACTION = 0.001
+GARBAGE_ROWS_FRACTION = 0.001
+# The store API has proportionally more bad rows
+STORE_BAD_ROWS_FRACTION = 0.01
+# Fraction of the dates which are YYYY Month DD, Month YYYY DD or YYYY/MM/DD rather than YYYY-MM-DD
+OTHER_DATE_FORMATS_FRACTION = 0.03
+# Fraction of GB country codes which are GGB, and of continents which are eeEurope or eeAmerica
+TYPO_FRACTION = 0.01
+# Fraction of card numbers prefixed with ?s, and of cards on pdf pages where tabula merged the card_number and
+# expiry_date columns into 'card_number expiry_date'
+CARD_QUESTION_MARKS_FRACTION = 0.001
+CARD_MERGED_COLUMNS_FRACTION = 0.001
+
+MONTH_NAMES = np.array(calendar.month_name[1:], dtype=object)
+COUNTRIES = np.array(['United Kingdom', 'Germany', 'United States'], dtype=object)
+COUNTRY_CODES = np.array(['GB', 'DE', 'US'], dtype=object)
+CONTINENTS = np.array(['Europe', 'Europe', 'America'], dtype=object)
+COUNTRY_WEIGHTS = [0.6, 0.3, 0.1]
+NAMES = np.array(['Sigfried', 'Guy', 'Harry', 'Darren', 'Laura', 'Ute', 'Carol', 'Keith', 'Amelia', 'Inge'],
+                 dtype=object)
+STREETS = np.array(['High Street', 'Sally isle', 'Station Road', 'Kirchstr.', 'Main St.', 'Mill Lane'], dtype=object)
+TOWNS = np.array(['East Deantown', 'Hamburg', 'New York', 'High Wycombe', 'Munich', 'Lake Matthew'], dtype=object)
+POSTCODES = np.array(['E7B 8EB', 'W1 4DS', '80331', '10001', 'HP12 3AA', '20095'], dtype=object)
+STORE_TYPES = np.array(['Local', 'Super Store', 'Mall Kiosk', 'Outlet'], dtype=object)
+TIME_PERIODS = np.array(['Late_Hours', 'Morning', 'Midday', 'Evening'], dtype=object)
+
+
+def _rows(rng: np.random.Generator, number_rows: int, fraction: float) -> np.ndarray:
+    """Returns the positions of fraction of number_rows rows, picked at random"""
+    return rng.choice(number_rows, round(number_rows * fraction), replace=False)
+
+
+def _pick(rng: np.random.Generator, values: np.ndarray, number_rows: int, p: List[float] = None) -> np.ndarray:
+    return values[rng.choice(len(values), number_rows, p=p)]
+
+
+def _random_strings(rng: np.random.Generator, number_rows: int) -> np.ndarray:
+    """Returns strings of 10 random capitals and digits, as the garbage rows of the sources have"""
+    characters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'))
+    return np.array([''.join(row) for row in characters[rng.integers(0, 36, (number_rows, 10))]], dtype=object)
+
+
+def _uuids(rng: np.random.Generator, number_rows: int) -> np.ndarray:
+    hex_digits = rng.bytes(16 * number_rows).hex()
+    return np.array([
+        f"{hex_digits[start:start + 8]}-{hex_digits[start + 8:start + 12]}-{hex_digits[start + 12:start + 16]}-"
+        f"{hex_digits[start + 16:start + 20]}-{hex_digits[start + 20:start + 32]}"
+        for start in range(0, 32 * number_rows, 32)
+    ], dtype=object)
+
+
+def _dates(rng: np.random.Generator, number_rows: int, first_year: int, last_year: int) -> np.ndarray:
+    """Returns YYYY-MM-DD dates between the years, OTHER_DATE_FORMATS_FRACTION of them in the other formats"""
+    first_day, last_day = np.datetime64(f"{first_year}-01-01"), np.datetime64(f"{last_year}-12-31")
+    days = first_day + rng.integers(0, (last_day - first_day).astype(int) + 1, number_rows).astype('timedelta64[D]')
+    dates = np.datetime_as_string(days).astype(object)
+    for position in _rows(rng, number_rows, OTHER_DATE_FORMATS_FRACTION):
+        year, month, day = dates[position].split('-')
+        month_name = MONTH_NAMES[int(month) - 1]
+        dates[position] = [f"{year} {month_name} {day}", f"{month_name} {year} {day}",
+                           f"{year}/{month}/{day}"][rng.integers(3)]
+    return dates
+
+
+def _addresses(rng: np.random.Generator, number_rows: int) -> np.ndarray:
+    """Returns addresses of 2 to 4 lines"""
+    addresses = rng.integers(1, 200, number_rows).astype(str).astype(object) + ' ' + _pick(rng, STREETS, number_rows)
+    flats = rng.random(number_rows) < 0.3
+    addresses[flats] = 'Flat ' + rng.integers(1, 99, flats.sum()).astype(str).astype(object) + '\n' + addresses[flats]
+    addresses = addresses + '\n' + _pick(rng, TOWNS, number_rows)
+    postcodes = rng.random(number_rows) < 0.5
+    addresses[postcodes] = addresses[postcodes] + '\n' + _pick(rng, POSTCODES, postcodes.sum())
+    return addresses
+
+
+def _spoil_rows(rng: np.random.Generator, df: pd.DataFrame, null_value, fraction: float = None,
+                keep_columns: List[str] = ()) -> pd.DataFrame:
+    """
+    Replaces fraction of the rows with null_value, and as many with random strings, in every column but
+    keep_columns. fraction defaults to NULL_ROWS_FRACTION and GARBAGE_ROWS_FRACTION
+    """
+    null_fraction = NULL_ROWS_FRACTION if fraction is None else fraction
+    garbage_fraction = GARBAGE_ROWS_FRACTION if fraction is None else fraction
+    number_rows = len(df.index)
+    rows = rng.permutation(number_rows)
+    number_null, number_garbage = round(number_rows * null_fraction), round(number_rows * garbage_fraction)
+    null_rows, garbage_rows = rows[:number_null], rows[number_null:number_null + number_garbage]
+    columns = [column for column in df.columns if column not in keep_columns]
+    df = df.astype({column: object for column in columns})
+    for column in columns:
+        position = df.columns.get_loc(column)
+        df.iloc[null_rows, position] = null_value
+        df.iloc[garbage_rows, position] = _random_strings(rng, len(garbage_rows))
+    return df
+
+
+def make_users(number_rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Returns raw users as they are read from the legacy_users table, with GGB typos and mixed date formats"""
+    countries = rng.choice(len(COUNTRIES), number_rows, p=COUNTRY_WEIGHTS)
+    country_codes = COUNTRY_CODES[countries]
+    typos = (country_codes == 'GB') & (rng.random(number_rows) < TYPO_FRACTION)
+    country_codes[typos] = 'GGB'
+    first_names = _pick(rng, NAMES, number_rows)
+    df = pd.DataFrame({
+        'index': np.arange(number_rows),
+        'first_name': first_names,
+        'last_name': _pick(rng, NAMES, number_rows),
+        'date_of_birth': _dates(rng, number_rows, 1940, 2006),
+        'company': _pick(rng, NAMES, number_rows) + ' Ltd',
+        'email_address': first_names + np.arange(number_rows).astype(str).astype(object) + '@example.com',
+        'address': _addresses(rng, number_rows),
+        'country': COUNTRIES[countries],
+        'country_code': country_codes,
+        'phone_number': '+44 (0)' + rng.integers(10**9, 10**10, number_rows).astype(str).astype(object),
+        'join_date': _dates(rng, number_rows, 1992, 2022),
+        'user_uuid': _uuids(rng, number_rows),
+    })
+    return _spoil_rows(rng, df, 'NULL', keep_columns=['index'])
+
+
+def make_cards(number_rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Returns raw cards as they are parsed from the card details pdf, with ?s before some card numbers and some
+    card numbers and expiry dates merged in the 'card_number expiry_date' column
+    """
+    card_numbers = (4 * 10**15 + np.arange(number_rows, dtype=np.int64) * 7919).astype(str).astype(object)
+    expiry_dates = np.array([f"{month:02d}/{year:02d}" for month, year in
+                             zip(rng.integers(1, 13, number_rows), rng.integers(23, 33, number_rows))], dtype=object)
+    question_marks = _rows(rng, number_rows, CARD_QUESTION_MARKS_FRACTION)
+    card_numbers[question_marks] = (_pick(rng, np.array(['?', '??', '???', '????'], dtype=object),
+                                          len(question_marks)) + card_numbers[question_marks])
+    df = pd.DataFrame({
+        'card_number': card_numbers,
+        'expiry_date': expiry_dates,
+        'card_provider': _pick(rng, np.array(valid_card_providers.entries, dtype=object), number_rows),
+        'date_payment_confirmed': _dates(rng, number_rows, 1992, 2022),
+        'card_number expiry_date': None,
+        'Unnamed: 0': np.nan,
+    })
+    df = _spoil_rows(rng, df, 'NULL', keep_columns=['card_number expiry_date', 'Unnamed: 0'])
+    # The merged rows are on pages of their own
+    merged = slice(number_rows // 2, number_rows // 2 + round(number_rows * CARD_MERGED_COLUMNS_FRACTION))
+    df.iloc[merged, df.columns.get_loc('card_number expiry_date')] = (card_numbers[merged] + ' '
+                                                                      + expiry_dates[merged])
+    df.iloc[merged, df.columns.get_indexer(['card_number', 'expiry_date'])] = np.nan
+    return df
+
+
+def make_stores(number_rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Returns raw stores as they are read from the store API, with eeEurope and eeAmerica typos, letters in the
+    staff numbers and a web portal for every 451 stores
+    """
+    countries = rng.choice(len(COUNTRIES), number_rows, p=COUNTRY_WEIGHTS)
+    country_codes, continents = COUNTRY_CODES[countries], CONTINENTS[countries]
+    typos = _rows(rng, number_rows, TYPO_FRACTION)
+    continents[typos] = 'ee' + continents[typos]
+    localities = _pick(rng, TOWNS, number_rows)
+    staff_numbers = rng.integers(3, 100, number_rows).astype(str).astype(object)
+    typos = _rows(rng, number_rows, TYPO_FRACTION)
+    staff_numbers[typos] = _pick(rng, np.array(list('JAeR'), dtype=object), len(typos)) + staff_numbers[typos]
+    # Multiplying by an odd number not divisible by 5 gives unique codes for up to 16**8 stores
+    store_codes = np.array([f"{locality[:2].upper()}-{(n * 2654435761) % 16**8:08X}"
+                            for n, locality in enumerate(localities)], dtype=object)
+    store_types = _pick(rng, STORE_TYPES, number_rows)
+    df = pd.DataFrame({
+        'index': np.arange(number_rows),
+        'address': _addresses(rng, number_rows) + ', ' + localities,
+        'longitude': rng.uniform(-120, 15, number_rows).round(5).astype(str).astype(object),
+        'lat': None,
+        'locality': localities,
+        'store_code': store_codes,
+        'staff_numbers': staff_numbers,
+        'opening_date': _dates(rng, number_rows, 1992, 2022),
+        'store_type': store_types,
+        'latitude': rng.uniform(25, 60, number_rows).round(5).astype(str).astype(object),
+        'country_code': country_codes,
+        'continent': continents,
+    })
+    web_portals = np.arange(0, number_rows, store.source_rows)
+    df.loc[web_portals, ['address', 'longitude', 'locality', 'latitude']] = 'N/A'
+    df.loc[web_portals, 'store_code'] = [f"WEB-{store_code[3:]}" for store_code in store_codes[web_portals]]
+    df.loc[web_portals, ['store_type', 'country_code', 'continent']] = ['Web Portal', 'GB', 'Europe']
+    return _spoil_rows(rng, df, 'NULL', fraction=STORE_BAD_ROWS_FRACTION, keep_columns=['index'])
+
+
+def make_products(number_rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Returns raw products as they are read from products.csv, with weights in g, kg, ml, oz and 2 x 200g"""
+    quantities = rng.integers(1, 5000, number_rows)
+    weight_formats = [
+        lambda quantity: f"{quantity}g",
+        lambda quantity: f"{quantity % 40 + quantity % 100 / 100}kg",
+        lambda quantity: f"{quantity}ml",
+        lambda quantity: f"{quantity % 200 + 1}oz",
+        lambda quantity: f"{quantity % 12 + 1} x {quantity % 500 + 1}g",
+        lambda quantity: f"{quantity}g .",
+    ]
+    formats = rng.choice(len(weight_formats), number_rows, p=[0.4, 0.3, 0.1, 0.1, 0.08, 0.02])
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    # Multiplying by an odd number not divisible by 5 gives unique codes for up to 10**7 products
+    product_codes = np.array([f"{letters[n % 26]}{n % 10}-{(n * 2654435761) % 10**7:07d}{letters[n % 23]}"
+                              for n in range(number_rows)], dtype=object)
+    df = pd.DataFrame({
+        'Unnamed: 0': np.arange(number_rows),
+        'product_name': _pick(rng, NAMES, number_rows) + ' ' + _pick(rng, STREETS, number_rows),
+        'product_price': np.array([f"£{price:.2f}" for price in rng.uniform(0.5, 800, number_rows)], dtype=object),
+        'weight': np.array([weight_formats[fmt](quantity) for fmt, quantity in zip(formats, quantities)],
+                           dtype=object),
+        'category': _pick(rng, np.array(valid_categories.entries, dtype=object), number_rows),
+        'EAN': rng.integers(10**12, 10**13, number_rows).astype(str).astype(object),
+        'date_added': _dates(rng, number_rows, 2017, 2022),
+        'uuid': _uuids(rng, number_rows),
+        'removed': _pick(rng, np.array(['Still_avaliable', 'Removed'], dtype=object), number_rows, p=[0.9, 0.1]),
+        'product_code': product_codes,
+    })
+    return _spoil_rows(rng, df, np.nan, keep_columns=['Unnamed: 0'])
+
+
+def make_date_times(number_rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Returns raw date times as they are read from date_details.json"""
+    first_second = np.datetime64('1992-01-01T00:00:00')
+    seconds = rng.integers(0, 31 * 365 * 86400, number_rows).astype('timedelta64[s]')
+    times = first_second + seconds
+    months = times.astype('datetime64[M]')
+    hours = (times - times.astype('datetime64[D]')).astype(int) // 3600
+    df = pd.DataFrame({
+        'timestamp': pd.Series(np.datetime_as_string(times), dtype=object).str[11:],
+        'month': (months.astype(int) % 12 + 1).astype(str).astype(object),
+        'year': (months.astype('datetime64[Y]').astype(int) + 1970).astype(str).astype(object),
+        'day': ((times.astype('datetime64[D]') - months).astype(int) + 1).astype(str).astype(object),
+        'time_period': TIME_PERIODS[np.searchsorted([6, 12, 17], hours, side='right')],
+        'date_uuid': _uuids(rng, number_rows),
+    })
+    return _spoil_rows(rng, df, 'NULL')
+
+
+def _loaded_keys(data_type: DataType, df: pd.DataFrame) -> np.ndarray:
+    """
+    Returns the keys of the rows of a raw dimension table which pass its rules. Card numbers are taken from the
+    merged column and stripped of ?'s first, as cleaning does
+    """
+    df = df.copy(deep=False)
+    if data_type is card:
+        merged = df['card_number expiry_date'].notna()
+        card_numbers = df['card_number'].mask(merged, df['card_number expiry_date'].str.split().str[0])
+        df['card_number'] = card_numbers.str.replace('?', '', regex=False)
+    _, rejected, _ = validate(df, data_type.rules)
+    return df.loc[~rejected, data_type.primary_key].dropna().to_numpy()
+
+
+def make_orders(number_rows: int, rng: np.random.Generator, sources: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Returns raw orders as they are read from the orders_table table, referencing the rows of the raw dimension
+    tables in sources which are loaded. Each order has its own date while there are dates enough
+    """
+    keys = {
+        data_type.primary_key: _loaded_keys(data_type, sources[data_type.table_name])
+        for data_type in [user, card, store, product, date_times]
+    }
+    date_uuids = keys.pop('date_uuid')
+    return pd.DataFrame({
+        'level_0': np.arange(number_rows),
+        'index': np.arange(number_rows),
+        'date_uuid': rng.choice(date_uuids, number_rows, replace=number_rows > len(date_uuids)),
+        'first_name': None,
+        'last_name': None,
+        **{column: column_keys[rng.integers(0, len(column_keys), number_rows)] for column, column_keys in keys.items()},
+        '1': np.nan,
+        'product_quantity': rng.integers(1, 14, number_rows),
+    })
+
+
+MAKE_SOURCE = {
+    user.table_name: make_users,
+    card.table_name: make_cards,
+    store.table_name: make_stores,
+    product.table_name: make_products,
+    date_times.table_name: make_date_times,
+}
+
+
+def source_rows(data_type: DataType, scale: float) -> int:
+    """Returns the rows of the DataType's source at scale times its size"""
+    return max(1, round(data_type.source_rows * scale))
+
+
+def make_sources(scale: float = 1, seed: int = 0) -> Dict[str, pd.DataFrame]:
+    """Returns the raw data of every source at scale times its size, by table name"""
+    rng = np.random.default_rng(seed)
+    sources = {}
+    for data_type in data_types:
+        if data_type is not order:
+            sources[data_type.table_name] = MAKE_SOURCE[data_type.table_name](source_rows(data_type, scale), rng)
+    sources[order.table_name] = make_orders(source_rows(order, scale), rng, sources)
+    return {data_type.table_name: sources[data_type.table_name] for data_type in data_types}
@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+from analytics import FrameReports, SalesReports, SalesSummaries
+from config import date_times, product, store
+from database_utils import DatabaseConnector
+from staging import Staging, CLEANED
+from surrogate_keys import SurrogateKeys
+
+NUMBER_ORDERS = 2000
+
+
+@pytest.fixture
+def frames():
+    """Returns cleaned products, stores, date times and orders"""
+    rng = np.random.default_rng(0)
+    stores = pd.DataFrame({
+        'store_code': ['WEB-1388012W', 'HI-9B97EE4E', 'MU-1A2B3C4D', 'LO-5E6F7A8B'],
+        'store_type': pd.Categorical(['Web Portal', 'Local', 'Super Store', 'Local']),
+        'country_code': pd.Categorical(['GB', 'DE', 'DE', 'US'], categories=['GB', 'DE', 'US']),
+        'locality': ['N/A', 'High Wycombe', 'Munich', 'High Wycombe'],
+        'longitude': [np.nan, -0.74934, 11.58, -0.75],
+        'staff_numbers': np.array([325, 34, 60, 12], dtype=np.uint16),
+    }).astype({'store_code': 'string[pyarrow]'})
+    products = pd.DataFrame({
+        'product_code': [f"A{n}-{n:07d}S" for n in range(20)],
+        'product_price': rng.uniform(1, 100, 20).round(2),
+    }).astype({'product_code': 'string[pyarrow]'})
+    dates = pd.Timestamp('2018-01-01') + pd.to_timedelta(
+        rng.integers(0, 3 * 365 * 24 * 3600, NUMBER_ORDERS), 's')
+    date_times = pd.DataFrame({
+        'date_uuid': [f"date-{n:036d}" for n in range(NUMBER_ORDERS)],
+        'year': dates.year.astype(str),
+        'month': dates.month.astype(str),
+        'date': dates,
+    }).astype({'date_uuid': 'string[pyarrow]', 'year': 'category', 'month': 'category'})
+    orders = pd.DataFrame({
+        'date_uuid': date_times['date_uuid'],
+        'store_code': rng.choice(stores['store_code'], NUMBER_ORDERS),
+        'product_code': rng.choice(products['product_code'], NUMBER_ORDERS),
+        'product_quantity': rng.integers(1, 14, NUMBER_ORDERS).astype(np.int16),
+    }).astype({'store_code': 'category', 'product_code': 'category'}).rename_axis('index')
+    return {
+        'orders_table': orders,
+        'dim_products': products,
+        'dim_store_details': stores,
+        'dim_date_times': date_times,
+    }
+
+
+@pytest.fixture
+def star(tmp_path, frames):
+    """Returns an engine for a sqlite database holding the dimension tables, and the orders"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+    for table_name in ['dim_store_details', 'dim_products', 'dim_date_times']:
+        DatabaseConnector.upload_to_db(engine, df=frames[table_name], table_name=table_name)
+    return engine, frames['orders_table']
+
+
+def read_sql(engine, sql: str) -> pd.DataFrame:
+    return pd.read_sql_query(sql, engine)
+
+
+def test_reports_match_sql_queries(star):
+    """Reports served from the summaries match the queries over the full star schema"""
+    engine, orders = star
+    DatabaseConnector.upload_to_db(engine, df=orders, table_name='orders_table')
+    SalesSummaries.build(engine)
+    reports = SalesReports(engine)
+
+    expected = read_sql(
+        engine, """
+        SELECT ROUND(SUM(ord.product_quantity * prod.product_price), 2) AS total_sales, dt.year, dt.month
+        FROM orders_table ord
+        INNER JOIN dim_products prod ON ord.product_code = prod.product_code
+        INNER JOIN dim_date_times dt ON ord.date_uuid = dt.date_uuid
+        GROUP BY dt.year, dt.month ORDER BY total_sales DESC LIMIT 10""")
+    pd.testing.assert_frame_equal(reports.sales_by_year_and_month(), expected)
+
+    expected = read_sql(
+        engine, """
+        SELECT COUNT(*) AS number_of_sales, SUM(ord.product_quantity) AS product_quantity_count,
+               CASE WHEN store.store_type = 'Web Portal' THEN 'Web' ELSE 'Offline' END AS location
+        FROM orders_table ord
+        INNER JOIN dim_products prod ON ord.product_code = prod.product_code
+        INNER JOIN dim_store_details store ON ord.store_code = store.store_code
+        GROUP BY location ORDER BY number_of_sales""")
+    pd.testing.assert_frame_equal(reports.online_sales(), expected)
+
+    expected = read_sql(
+        engine, """
+        SELECT ROUND(SUM(ord.product_quantity * prod.product_price), 2) AS total_sales,
+               store_type, country_code
+        FROM orders_table ord
+        INNER JOIN dim_products prod ON ord.product_code = prod.product_code
+        INNER JOIN dim_store_details store ON ord.store_code = store.store_code
+        GROUP BY store_type, country_code HAVING country_code = 'DE' ORDER BY total_sales""")
+    pd.testing.assert_frame_equal(reports.sales_by_store_type_in('DE'), expected)
+
+    sales_by_store_type = reports.sales_by_store_type()
+    assert sales_by_store_type['percentage_total(%)'].sum() == pytest.approx(100, abs=0.05)
+
+    assert reports.stores_by_country().to_dict('list') == {
+        'country': ['DE', 'US', 'GB'],
+        'total_no_stores': [2, 1, 0]
+    }
+    assert reports.stores_by_locality()['locality'].tolist() == ['High Wycombe', 'Munich', 'N/A']
+    assert reports.staff_by_country()['total_staff_numbers'].tolist() == [325, 94, 12]
+
+
+def test_time_between_sales_matches_window_query(star):
+    """The average time between sales per year matches the mean of consecutive differences"""
+    engine, orders = star
+    DatabaseConnector.upload_to_db(engine, df=orders, table_name='orders_table')
+    SalesSummaries.build(engine)
+
+    dates = pd.read_sql_table('dim_date_times', engine, parse_dates=['date'])
+    expected = dates.sort_values('date').groupby('year')['date'].apply(
+        lambda date: date.diff().mean())
+    report = SalesReports(engine).time_between_sales().set_index('year')['actual_time_taken']
+    pd.testing.assert_series_equal(report.sort_index(), expected.rename('actual_time_taken'),
+                                   check_exact=False, rtol=1e-9)
+
+
+def test_refresh_merges_new_orders(star):
+    """Refreshing with orders loaded since the last build gives the same summary as a rebuild"""
+    engine, orders = star
+    first, second = orders.iloc[:1500], orders.iloc[1500:]
+    DatabaseConnector.upload_to_db(engine, df=first, table_name='orders_table')
+    SalesSummaries.build(engine)
+    with engine.begin() as conn:
+        DatabaseConnector.upsert_to_db(conn, second, 'orders_table', key_columns=['index'])
+
+    assert SalesSummaries.refresh(engine) == len(second.index)
+    assert SalesSummaries.refresh(engine) == 0
+    refreshed = SalesReports(engine).all_reports()
+
+    SalesSummaries.build(engine)
+    rebuilt = SalesReports(engine).all_reports()
+    for name, df in rebuilt.items():
+        pd.testing.assert_frame_equal(refreshed[name], df, obj=name)
+
+
+def test_summaries_join_surrogate_keys(tmp_path, star, frames):
+    """Orders loaded with surrogate keys are summarised by joining on them, with the same reports"""
+    engine, orders = star
+    DatabaseConnector.upload_to_db(engine, df=orders, table_name='orders_table')
+    SalesSummaries.build(engine)
+    expected = SalesReports(engine).all_reports()
+
+    surrogate_engine = create_engine(f"sqlite:///{tmp_path / 'surrogate.db'}")
+    surrogate_keys = SurrogateKeys([product, store, date_times])
+    for data_type in [store, product, date_times]:
+        df, = surrogate_keys.map_chunks(data_type, [frames[data_type.table_name]])
+        DatabaseConnector.upload_to_db(surrogate_engine, df=df, table_name=data_type.table_name)
+    DatabaseConnector.upload_to_db(surrogate_engine, df=surrogate_keys.map_foreign_keys(orders),
+                                   table_name='orders_table')
+    SalesSummaries.build(surrogate_engine)
+    for name, df in SalesReports(surrogate_engine).all_reports().items():
+        pd.testing.assert_frame_equal(df, expected[name], obj=name)
+
+
+def test_frame_reports_match_summary_reports(star, frames):
+    """Reports computed from the cleaned dataframes match those served from the database"""
+    engine, orders = star
+    DatabaseConnector.upload_to_db(engine, df=orders, table_name='orders_table')
+    SalesSummaries.build(engine)
+    expected = SalesReports(engine).all_reports()
+
+    reports = FrameReports(frames['orders_table'], frames['dim_products'],
+                           frames['dim_store_details'], frames['dim_date_times']).all_reports()
+    for name, df in expected.items():
+        pd.testing.assert_frame_equal(reports[name], df, check_dtype=False, obj=name)
+
+
+def test_frame_reports_drop_orders_missing_a_dimension(frames):
+    """Orders whose product isn't in dim_products are left out, as an inner join leaves them out"""
+    orders = frames['orders_table']
+    orders['product_code'] = orders['product_code'].cat.add_categories(['XX-0000000X'])
+    orders.loc[orders.index[:10], 'product_code'] = 'XX-0000000X'
+    reports = FrameReports(orders, frames['dim_products'], frames['dim_store_details'],
+                           frames['dim_date_times'])
+    assert len(reports.orders.index) == NUMBER_ORDERS - 10
+    assert reports.online_sales()['number_of_sales'].sum() == NUMBER_ORDERS - 10
+
+
+def test_frame_reports_from_staging(tmp_path, frames):
+    """Reports are computed from the cleaned dataframes of a staged run"""
+    staging = Staging(tmp_path / 'staging', run_id='20231101T120000')
+    for table_name, df in frames.items():
+        staging.write(table_name, CLEANED, df)
+    pd.testing.assert_frame_equal(
+        FrameReports.from_staging(staging).sales_by_store_type(),
+        FrameReports(frames['orders_table'], frames['dim_products'], frames['dim_store_details'],
+                     frames['dim_date_times']).sales_by_store_type())
@@ -0,0 +1,63 @@
+import os
+
+from cache import LocalCache
+
+
+def write_bytes(size):
+    """Returns a writer which writes size bytes to a path"""
+    return lambda path: path.write_bytes(b'x' * size)
+
+
+def test_make_key_changes_with_version():
+    """A different ETag gives a different cache key"""
+    assert LocalCache.make_key('bucket', 'products.csv', '"abc"') == LocalCache.make_key(
+        'bucket', 'products.csv', '"abc"')
+    assert LocalCache.make_key('bucket', 'products.csv', '"abc"') != LocalCache.make_key(
+        'bucket', 'products.csv', '"abd"')
+
+
+def test_get_returns_none_until_put(tmp_path):
+    cache = LocalCache(tmp_path, max_bytes=100)
+    assert cache.get('key', '.csv') is None
+    path = cache.put('key', '.csv', write_bytes(10))
+    assert cache.get('key', '.csv') == path
+    assert path.read_bytes() == b'x' * 10
+
+
+def test_failed_write_leaves_no_entry(tmp_path):
+    """A write which raises doesn't leave a partial file in the cache"""
+    cache = LocalCache(tmp_path, max_bytes=100)
+
+    def failing_write(path):
+        path.write_bytes(b'partial')
+        raise OSError('connection reset')
+
+    try:
+        cache.put('key', '.csv', failing_write)
+    except OSError:
+        pass
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_least_recently_used_entries_evicted(tmp_path):
+    """Entries used least recently are removed once the cache is over max_bytes"""
+    cache = LocalCache(tmp_path, max_bytes=25)
+    cache.put('first', '.csv', write_bytes(10))
+    cache.put('second', '.csv', write_bytes(10))
+    os.utime(cache.path('first', '.csv'), (1, 1))
+    os.utime(cache.path('second', '.csv'), (2, 2))
+
+    # Reading first makes second the least recently used
+    cache.get('first', '.csv')
+    cache.put('third', '.csv', write_bytes(10))
+
+    assert cache.get('second', '.csv') is None
+    assert cache.get('first', '.csv') is not None
+    assert cache.get('third', '.csv') is not None
+
+
+def test_entry_larger_than_cache_is_kept(tmp_path):
+    """The entry just written is never evicted, even when it alone is over max_bytes"""
+    cache = LocalCache(tmp_path, max_bytes=5)
+    cache.put('big', '.csv', write_bytes(10))
+    assert cache.get('big', '.csv') is not None
@@ -2,8 +2,10 @@ import pandas as pd
 import pytest
 import numpy as np
 
-from config import valid_months, valid_categories, valid_country_codes, valid_card_providers
+from config import (valid_months, valid_categories, valid_country_codes, valid_card_providers,
+                    date_times_schema, order_schema, card)
 from data_cleaning import DataCleaning
+from profiling import run_report
 
 
 @pytest.fixture
@@ -43,24 +45,27 @@ def date_time_cleaner():
 
 
 def test_date_of_birth_with_year_month_day(user_cleaner):
-    """Test function _standardize_dob returns correct format where YYYY Month DD provided"""
-    date_of_birth = '1968 October 16'
-    assert user_cleaner._standardize_dob(date_of_birth) == '1968-10-16'
+    """Test function _clean_date returns correct format where YYYY Month DD provided"""
+    df = pd.DataFrame(data=[['1968 October 16']], columns=['date_of_birth'])
+    cleaned_df = user_cleaner._clean_date(df=df, column_name='date_of_birth')
+    assert cleaned_df['date_of_birth'][0] == pd.Timestamp('1968-10-16')
 
 
 def test_date_of_birth_with_year_4_characters(user_cleaner):
     """
-    Test function _standardize_dob returns correct format where YYYY Month DD provided
+    Test function _clean_date returns correct format where YYYY Month DD provided
     Handles case where were initially checking the length of YYYY and a 4 character month created an issue
     """
-    date_of_birth = '1968 June 16'
-    assert user_cleaner._standardize_dob(date_of_birth) == '1968-06-16'
+    df = pd.DataFrame(data=[['1968 June 16']], columns=['date_of_birth'])
+    cleaned_df = user_cleaner._clean_date(df=df, column_name='date_of_birth')
+    assert cleaned_df['date_of_birth'][0] == pd.Timestamp('1968-06-16')
 
 
 def test_date_of_birth_with_month_year_day(user_cleaner):
-    """Test function _standardize_dob returns correct format where Month YYYY DD provided"""
-    date_of_birth = 'October 1968 16'
-    assert user_cleaner._standardize_dob(date_of_birth) == '1968-10-16'
+    """Test function _clean_date returns correct format where Month YYYY DD provided"""
+    df = pd.DataFrame(data=[['October 1968 16']], columns=['date_of_birth'])
+    cleaned_df = user_cleaner._clean_date(df=df, column_name='date_of_birth')
+    assert cleaned_df['date_of_birth'][0] == pd.Timestamp('1968-10-16')
 
 
 def test_clean_date_slashes(user_cleaner):
@@ -77,6 +82,22 @@ def test_clean_date_with_month_year_day(user_cleaner):
     assert cleaned_df['join_date'][0] == pd.Timestamp('1973-07-08 00:00:00')
 
 
+def test_clean_date_with_mixed_formats(user_cleaner):
+    """Test function clean_date standardises all 4 date formats in a single column"""
+    df = pd.DataFrame(data=[['1972-09-09'], ['1972 September 09'],
+                            ['September 1972 09'], ['1972/09/09']],
+                      columns=['join_date'])
+    cleaned_df = user_cleaner._clean_date(df=df, column_name='join_date')
+    assert all(cleaned_df['join_date'] == pd.Timestamp('1972-09-09')) is True
+
+
+def test_clean_date_with_may_year_day(user_cleaner):
+    """Test function clean_date handles Month YYYY DD where the year could be mistaken for a month"""
+    df = pd.DataFrame(data=[['May 2010 12']], columns=['join_date'])
+    cleaned_df = user_cleaner._clean_date(df=df, column_name='join_date')
+    assert cleaned_df['join_date'][0] == pd.Timestamp('2010-05-12 00:00:00')
+
+
 def test_clean_user_data_remove_rows_with_null_in_last_name(user_cleaner):
     """Test function clean_user_data removes rows where the last_name = NULL"""
     df = pd.DataFrame(data=[{
@@ -131,8 +152,9 @@ def test_clean_user_data_remove_rows_with_invalid_country_code(user_cleaner):
     assert all(cleaned_df['country_code'] == ['GB', 'DE', 'US']) is True
 
 
+@pytest.mark.filterwarnings('error::FutureWarning')
 def test_set_card_number_and_expiry_date(card_cleaner):
-    """Test function _set_card_number_and_expiry_date updates card_number and expiry_date"""
+    """Test function _set_card_number_and_expiry_date updates all null card_number and expiry_date columns"""
     df = pd.DataFrame(data=[{
         'card_number': np.nan,
         'expiry_date': np.nan,
@@ -191,6 +213,40 @@ def test_question_marks_removed_from_card_number(card_cleaner):
     assert cleaned_df['card_number'][0] == '30060773296198'
 
 
+@pytest.mark.filterwarnings('error::FutureWarning')
+def test_clean_card_data_keeps_cards_from_merged_column():
+    """Cards whose number and expiry date are only in 'card_number expiry_date' aren't rejected as duplicates"""
+    df = pd.DataFrame(data=[
+        ['30060773296197', '09/32', 'VISA 16 digit', '2015-11-25', np.nan, np.nan],
+        [np.nan, np.nan, 'VISA 16 digit', '2015-11-25', '6011036876440620 09/32', np.nan],
+        [np.nan, np.nan, 'VISA 16 digit', '2015-11-25', '6011036876440621 10/31', np.nan],
+    ],
+                      columns=[
+                          'card_number', 'expiry_date', 'card_provider',
+                          'date_payment_confirmed', 'card_number expiry_date',
+                          'Unnamed: 0'
+                      ])
+    cleaned_df = DataCleaning(column_entries=valid_card_providers, rules=card.rules).clean_card_data(df=df)
+    assert list(cleaned_df['card_number']) == ['30060773296197', '6011036876440620', '6011036876440621']
+    assert list(cleaned_df['expiry_date']) == ['09/32', '09/32', '10/31']
+
+
+def test_clean_card_data_rejects_duplicate_card_number_after_question_marks_removed():
+    """A card number with ?'s is a duplicate of the same number without them"""
+    df = pd.DataFrame(data=[
+        ['4222', '09/32', 'VISA 16 digit', '2015-11-25', np.nan, np.nan],
+        ['???4222', '09/32', 'VISA 16 digit', '2015-11-25', np.nan, np.nan],
+    ],
+                      columns=[
+                          'card_number', 'expiry_date', 'card_provider',
+                          'date_payment_confirmed', 'card_number expiry_date',
+                          'Unnamed: 0'
+                      ])
+    cleaned_df = DataCleaning(column_entries=valid_card_providers, rules=card.rules).clean_card_data(df=df)
+    assert list(cleaned_df['card_number']) == ['4222']
+
+
+@pytest.mark.filterwarnings('error::FutureWarning')
 def test_typos_removed_from_store_data(store_cleaner):
     df = pd.DataFrame(data=[{
         'index': '0',
@@ -220,6 +276,21 @@ def test_store_data_address_removes_locality(store_cleaner):
     assert cleaned_df['address_4'][0] == 'E7B 8EB'
 
 
+def test_user_data_address_split_into_lines(user_cleaner):
+    """User addresses keep everything after a comma, lines missing from an address are None"""
+    df = pd.DataFrame(data=[{
+        'address': '4 High Street, Flat 2\nLondon',
+    }, {
+        'address': '1 Low Road',
+    }])
+    cleaned_df = user_cleaner._clean_address(df=df)
+    assert cleaned_df['address'][0] == '4 High Street, Flat 2'
+    assert cleaned_df['address_2'][0] == 'London'
+    assert cleaned_df['address'][1] == '1 Low Road'
+    assert cleaned_df['address_2'][1] is None
+    assert cleaned_df['address_4'][1] is None
+
+
 def test_clean_product_data_removes_rows_with_invalid_category(
         product_cleaner):
     """Test function clean_product_data removes rows where the category not valid"""
@@ -288,6 +359,25 @@ def test_convert_product_weights_with_g(product_cleaner):
     assert cleaned_df['weight'][0] == 0.0116
 
 
+def test_convert_product_weights_with_mixed_and_missing_weights(product_cleaner):
+    """Each weight is converted in its own unit, missing weights stay missing"""
+    df = pd.DataFrame(data={'weight': ['100g', '1kg', np.nan, '100g', '3 x 2g']},
+                      index=[5, 3, 9, 1, 2])
+    cleaned_df = product_cleaner.convert_product_weights(df=df)
+    assert cleaned_df['weight'][5] == 0.1
+    assert cleaned_df['weight'][3] == 1.0
+    assert np.isnan(cleaned_df['weight'][9])
+    assert cleaned_df['weight'][1] == 0.1
+    assert cleaned_df['weight'][2] == 0.006
+
+
+def test_convert_product_weights_unrecognised_weight(product_cleaner):
+    """Weights which aren't in a known format raise a ValueError"""
+    df = pd.DataFrame(data=[{'index': '0', 'weight': '77 stone'}])
+    with pytest.raises(ValueError):
+        product_cleaner.convert_product_weights(df=df)
+
+
 def test_drop_columns(order_cleaner):
     """Columns are dropped"""
     df = pd.DataFrame(data=[{
@@ -304,12 +394,141 @@ def test_drop_columns(order_cleaner):
 
 
 def test_add_date_column(date_time_cleaner):
-    """New column created which concatenates year, month, day and timestamp"""
-    df = pd.DataFrame(data=[{
-        'timestamp': '22:00:06',
-        'month': '3',
-        'year': '1972',
-        'day': '28',
-    }])
+    """New datetime64 column assembled from year, month, day and timestamp"""
+    df = pd.DataFrame({
+        'timestamp': ['22:00:06', '00:00:00', '23:59:59'],
+        'month': ['3', '2', '12'],
+        'year': ['1972', '2000', '1969'],
+        'day': ['28', '29', '31'],
+    })
     cleaned_df = date_time_cleaner._add_date_column(df)
-    assert cleaned_df['date'][0] == pd.Timestamp('1972-03-28 22:00:06')
+    assert cleaned_df['date'].dtype == 'datetime64[ns]'
+    assert cleaned_df['date'].tolist() == [
+        pd.Timestamp('1972-03-28 22:00:06'),
+        pd.Timestamp('2000-02-29 00:00:00'),
+        pd.Timestamp('1969-12-31 23:59:59'),
+    ]
+
+
+def test_add_date_column_from_numbers(date_time_cleaner):
+    """Year, month and day columns which were read as numbers give the same date"""
+    df = pd.DataFrame({'timestamp': ['22:00:06'], 'month': [3], 'year': [1972], 'day': [28]})
+    assert date_time_cleaner._add_date_column(df)['date'][0] == pd.Timestamp('1972-03-28 22:00:06')
+
+
+def test_add_date_column_other_timestamps(date_time_cleaner):
+    """Timestamps not in HH:MM:SS are parsed as timedeltas"""
+    df = pd.DataFrame({
+        'timestamp': ['22:00:06.5', '1:02:03'],
+        'month': ['3', '3'],
+        'year': ['1972', '1972'],
+        'day': ['28', '28'],
+    })
+    assert date_time_cleaner._add_date_column(df)['date'].tolist() == [
+        pd.Timestamp('1972-03-28 22:00:06.5'),
+        pd.Timestamp('1972-03-28 01:02:03'),
+    ]
+
+
+def test_add_date_column_rejects_day_past_end_of_month(date_time_cleaner):
+    """A day which doesn't exist in its month fails, rather than rolling over into the next month"""
+    df = pd.DataFrame({'timestamp': ['22:00:06'], 'month': ['2'], 'year': ['2001'], 'day': ['29']})
+    with pytest.raises(ValueError, match='past the end of their month'):
+        date_time_cleaner._add_date_column(df)
+
+
+@pytest.fixture
+def date_times():
+    """Returns 1000 rows of date times data"""
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'timestamp': '22:00:06',
+        'month': rng.integers(1, 13, 1000).astype(str),
+        'year': rng.integers(1992, 2023, 1000).astype(str),
+        'day': rng.integers(1, 29, 1000).astype(str),
+        'time_period': rng.choice(['Evening', 'Morning', 'Midday', 'Late_Hours'], 1000),
+        'date_uuid': [f"{n:08d}-5d6a-4117-874d-9cdb38ca1fa6" for n in range(1000)],
+    })
+
+
+def test_clean_date_times_data_applies_schema(date_times):
+    """Cleaned columns are cast to the schema's dtypes, using less memory"""
+    run_report.pop_stats()
+    cleaner = DataCleaning(column_entries=valid_months, schema=date_times_schema)
+    bytes_before = date_times.memory_usage(deep=True).sum()
+    cleaned_df = cleaner.clean_date_times_data(df=date_times)
+
+    assert cleaned_df['month'].dtype == pd.CategoricalDtype(valid_months.entries)
+    assert cleaned_df['time_period'].dtype == 'category'
+    assert cleaned_df['date_uuid'].dtype == 'string[pyarrow]'
+    assert cleaned_df['date_uuid'][0] == '00000000-5d6a-4117-874d-9cdb38ca1fa6'
+    assert cleaned_df.memory_usage(deep=True).sum() < bytes_before / 2
+
+    stats = {stats.stage: stats for stats in run_report.pop_stats()}['schema dim_date_times']
+    assert stats.rows_out == 1000
+    assert stats.bytes_out < stats.bytes_in
+
+
+def test_apply_schema_fixed_width_ints(order_cleaner):
+    """Product quantities are stored as 16 bit ints"""
+    df = pd.DataFrame({
+        'date_uuid': ['a'],
+        'user_uuid': ['b'],
+        'card_number': ['4971858637664481'],
+        'store_code': ['WEB-1388012W'],
+        'product_code': ['A8-4686892S'],
+        'product_quantity': [3],
+    })
+    cleaned_df = DataCleaning(schema=order_schema).apply_schema(df)
+    assert cleaned_df['product_quantity'].dtype == np.int16
+
+
+def test_apply_schema_entry_outside_categories(date_times):
+    """Entries which aren't one of the categories raise rather than silently becoming nan"""
+    date_times.loc[3, 'month'] = '13'
+    with pytest.raises(ValueError, match='13'):
+        DataCleaning(schema=date_times_schema).apply_schema(
+            date_times.assign(date=pd.Timestamp('2020-01-01')))
+
+
+def test_clean_product_data_derives_price_weight_class_and_availability(product_cleaner):
+    """Prices lose their £, weights are classed with inclusive ranges and removed becomes still_available"""
+    df = pd.DataFrame({
+        'index': ['0', '1', '2', '3', '4'],
+        'product_price': ['£4.49', '£1000.00', '£0.5', '£12', '£7'],
+        'weight': ['1.99kg', '2kg', '40kg', '140kg', '141kg'],
+        'category': 'pets',
+        'date_added': '1995-06-25',
+        'removed': ['Still_avaliable', 'Removed', 'Still_avaliable', np.nan, 'Removed'],
+    })
+    cleaned_df = product_cleaner.clean_product_data(df=df)
+    assert cleaned_df['product_price'].tolist() == [4.49, 1000.0, 0.5, 12.0, 7.0]
+    assert cleaned_df['weight_class'].tolist() == [
+        'Light', 'Mid_Sized', 'Mid_Sized', 'Heavy', 'Truck_Required'
+    ]
+    assert cleaned_df['still_available'].tolist() == [True, False, True, True, False]
+    assert 'removed' not in cleaned_df.columns
+
+
+def test_clean_store_data_web_portal_and_coordinates(store_cleaner):
+    """The web portal's address and locality are N/A, coordinates are floats and lat is dropped"""
+    df = pd.DataFrame({
+        'index': ['0', '1'],
+        'address': ['N/A', 'Flat 72W\nSally isle, High Wycombe'],
+        'longitude': [None, '-0.74934'],
+        'lat': None,
+        'locality': [None, 'High Wycombe'],
+        'store_code': ['WEB-1388012W', 'HI-9B97EE4E'],
+        'staff_numbers': ['325', '34'],
+        'opening_date': '2010-06-12',
+        'store_type': ['Web Portal', 'Local'],
+        'latitude': [None, '51.62907'],
+        'country_code': 'GB',
+        'continent': 'Europe',
+    })
+    cleaned_df = store_cleaner.clean_store_data(df=df)
+    assert cleaned_df.loc[0, ['address', 'locality']].tolist() == ['N/A', 'N/A']
+    assert np.isnan(cleaned_df['longitude'][0])
+    assert cleaned_df['longitude'][1] == -0.74934
+    assert cleaned_df['latitude'][1] == 51.62907
+    assert 'lat' not in cleaned_df.columns
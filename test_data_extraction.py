@@ -0,0 +1,343 @@
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import shutil
+import threading
+import time
+
+import botocore
+import numpy as np
+import pandas as pd
+from pypdf import PdfWriter
+import pytest
+
+from cache import LocalCache
+import data_extraction
+from data_extraction import DataExtractor, read_json_columns
+
+
+class StoreDetailsHandler(BaseHTTPRequestHandler):
+    """Stub store details API. Returns 503 for the first request to each store listed in flaky_stores"""
+    flaky_stores = set()
+
+    def do_GET(self):
+        store_number = int(self.path.rstrip('/').split('/')[-1])
+        if store_number in self.flaky_stores:
+            self.flaky_stores.discard(store_number)
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        body = json.dumps({
+            'index': store_number,
+            'store_code': f"ST-{store_number:04d}"
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def store_api():
+    """Starts a local stub store details API and returns its base url"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StoreDetailsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/store_details/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_retrieve_stores_data_returns_stores_in_order(store_api):
+    """Stores requested concurrently are returned in store number order"""
+    df = DataExtractor().retrieve_stores_data(url=store_api,
+                                              headers={},
+                                              number_stores=50,
+                                              max_workers=8)
+    assert len(df.index) == 50
+    assert list(df['index']) == list(range(50))
+
+
+def test_retrieve_stores_data_sequential_matches_concurrent(store_api):
+    """A single worker returns the same dataframe as multiple workers"""
+    extractor = DataExtractor()
+    df_sequential = extractor.retrieve_stores_data(url=store_api,
+                                                   headers={},
+                                                   number_stores=20,
+                                                   max_workers=1)
+    df_concurrent = extractor.retrieve_stores_data(url=store_api,
+                                                   headers={},
+                                                   number_stores=20,
+                                                   max_workers=4)
+    assert df_sequential.equals(df_concurrent)
+
+
+def test_retrieve_stores_data_retries_server_errors(store_api):
+    """Stores which respond with a 503 are retried"""
+    StoreDetailsHandler.flaky_stores = {3, 7}
+    df = DataExtractor().retrieve_stores_data(url=store_api,
+                                              headers={},
+                                              number_stores=10,
+                                              max_workers=4)
+    assert list(df['store_code']) == [f"ST-{n:04d}" for n in range(10)]
+
+
+class LocalS3:
+    """Stand-in for a boto3 s3 client, serving objects from a local directory"""
+
+    def __init__(self, root):
+        self.root = root
+        self.downloads = 0
+
+    def head_object(self, Bucket, Key):
+        path = self.root / Bucket / Key
+        if not path.exists():
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': '404'}}, 'HeadObject')
+        stat = path.stat()
+        return {
+            'ETag': f'"{stat.st_size}-{stat.st_mtime_ns}"',
+            'LastModified': datetime.fromtimestamp(stat.st_mtime)
+        }
+
+    def download_file(self, Bucket, Key, Filename):
+        self.downloads += 1
+        shutil.copy(self.root / Bucket / Key, Filename)
+
+    def get_object(self, Bucket, Key):
+        return {'Body': open(self.root / Bucket / Key, 'rb')}
+
+
+@pytest.fixture
+def local_s3(tmp_path):
+    """Returns a LocalS3 holding products.csv in data-handling-public"""
+    bucket = tmp_path / 's3' / 'data-handling-public'
+    bucket.mkdir(parents=True)
+    pd.DataFrame({
+        'product_name': ['Dog food', 'Cat food'],
+        'weight': ['12 x 100g', None]
+    }).to_csv(bucket / 'products.csv')
+    return LocalS3(tmp_path / 's3')
+
+
+@pytest.fixture
+def s3_cache(tmp_path):
+    return LocalCache(tmp_path / 'cache', max_bytes=10**6)
+
+
+def test_extract_from_s3_downloads_once(local_s3, s3_cache):
+    """A second extract of an unchanged object is read from the cache"""
+    extractor = DataExtractor(s3_client=local_s3, cache=s3_cache)
+    df_first = extractor.extract_from_s3('s3://data-handling-public/products.csv')
+    df_second = extractor.extract_from_s3('s3://data-handling-public/products.csv')
+    assert local_s3.downloads == 1
+    pd.testing.assert_frame_equal(df_first, df_second)
+
+
+def test_extract_from_s3_downloads_changed_object(local_s3, s3_cache):
+    """A changed object has a new ETag and is downloaded again"""
+    extractor = DataExtractor(s3_client=local_s3, cache=s3_cache)
+    extractor.extract_from_s3('s3://data-handling-public/products.csv')
+    pd.DataFrame({'product_name': ['Fish food']}).to_csv(
+        local_s3.root / 'data-handling-public' / 'products.csv')
+
+    df = extractor.extract_from_s3('s3://data-handling-public/products.csv')
+    assert local_s3.downloads == 2
+    assert list(df['product_name']) == ['Fish food']
+
+
+def test_extract_from_s3_cached_as_parquet(local_s3, s3_cache, monkeypatch):
+    """With cache_as_parquet a repeat extract reads parquet and doesn't parse the csv"""
+    extractor = DataExtractor(s3_client=local_s3, cache=s3_cache, cache_as_parquet=True)
+    df_first = extractor.extract_from_s3('s3://data-handling-public/products.csv')
+
+    def fail(path):
+        raise AssertionError(f"{path} parsed again")
+
+    monkeypatch.setattr(DataExtractor, '_read_extract', staticmethod(fail))
+    df_second = extractor.extract_from_s3('s3://data-handling-public/products.csv')
+    assert local_s3.downloads == 1
+    pd.testing.assert_frame_equal(df_first, df_second)
+
+
+def test_extract_from_s3_missing_object(local_s3, s3_cache):
+    """A missing object returns None"""
+    extractor = DataExtractor(s3_client=local_s3, cache=s3_cache)
+    assert extractor.extract_from_s3('s3://data-handling-public/missing.csv') is None
+
+
+@pytest.fixture
+def date_details_json(local_s3):
+    """Writes a date_details.json to the local s3, returns the dataframe written"""
+    df = pd.DataFrame({
+        'timestamp': ['22:00:06', '22:44:06', '10:00:00', 'NULL'] * 5,
+        'month': ['9', '2', '4', 'NULL'] * 5,
+        'day': [19, 10, 3, None] * 5,
+        'time_period': ['Evening', 'Evening', 'Midday', 'NULL'] * 5,
+    })
+    df.to_json(local_s3.root / 'data-handling-public' / 'date_details.json')
+    return df
+
+
+def test_stream_from_s3_parses_json_in_chunks(local_s3, s3_cache, date_details_json):
+    """A streamed json extract matches the downloaded one, in chunks and without touching the cache"""
+    extractor = DataExtractor(s3_client=local_s3, cache=s3_cache)
+    chunks = list(extractor.stream_from_s3('s3://data-handling-public/date_details.json', chunksize=8))
+    assert [len(chunk.index) for chunk in chunks] == [8, 8, 4]
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks), extractor.extract_from_s3('s3://data-handling-public/date_details.json'))
+    assert local_s3.downloads == 1
+
+
+def test_stream_from_s3_parses_csv_in_chunks(local_s3, s3_cache):
+    """A streamed csv extract matches the downloaded one"""
+    extractor = DataExtractor(s3_client=local_s3, cache=s3_cache)
+    chunks = list(extractor.stream_from_s3('s3://data-handling-public/products.csv', chunksize=1))
+    assert len(chunks) == 2
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks), extractor.extract_from_s3('s3://data-handling-public/products.csv'))
+
+
+@pytest.mark.parametrize('block_size', [1, 2, 5, 64])
+def test_read_json_columns_across_blocks(date_details_json, local_s3, block_size):
+    """Values split across the blocks read are parsed whole"""
+    with open(local_s3.root / 'data-handling-public' / 'date_details.json', 'rb') as stream:
+        df = pd.concat(read_json_columns(stream, chunksize=8, block_size=block_size))
+    pd.testing.assert_frame_equal(df, date_details_json)
+
+
+def test_read_json_columns_in_typed_chunks():
+    """Each chunk's columns are arrays typed as pandas infers them, indexed by the keys of the first column"""
+    stream = io.BytesIO(b'{"a": {"0": 1, "1": 2, "2": 3}, "b": {"0": "x", "1": null, "2": 1.5}}')
+    first, second = read_json_columns(stream, chunksize=2, block_size=1)
+    pd.testing.assert_frame_equal(first, pd.DataFrame({'a': [1, 2], 'b': ['x', None]}))
+    pd.testing.assert_frame_equal(second, pd.DataFrame({'a': [3], 'b': [1.5]}, index=[2]))
+
+
+def test_read_json_columns_shares_repeated_strings(date_details_json, local_s3):
+    """Repeated values of a column are one string object, across chunks too"""
+    with open(local_s3.root / 'data-handling-public' / 'date_details.json', 'rb') as stream:
+        first, second = list(read_json_columns(stream, chunksize=10))
+    assert first['time_period'][0] is first['time_period'][4] is second['time_period'][12]
+
+
+def test_read_json_columns_escaped_and_nested_values():
+    """Escaped strings are decoded, and values other than strings and numbers are parsed too"""
+    stream = io.BytesIO(b'{"a \\"b\\"": {"0": "say \\"hi\\" {", "1": {"b": [1, 2]}, "2": null}}')
+    df = pd.concat(read_json_columns(stream, block_size=4))
+    assert df['a "b"'].tolist() == ['say "hi" {', {'b': [1, 2]}, None]
+
+
+@pytest.mark.parametrize('document', [
+    b'{"a": {"0": 1, "1": 2}, "b": {"1": 3, "0": 4}}',
+    b'{"a": {"0": 1, "1": 2}, "b": {"0": 3}}',
+    b'{"a": {"0": 1}, "b": {"0": 3, "1": 4}}',
+], ids=['reordered', 'fewer rows', 'more rows'])
+def test_read_json_columns_rejects_misaligned_columns(document):
+    """Columns must key their rows as the first column does"""
+    with pytest.raises(ValueError, match='not keyed as the first column'):
+        list(read_json_columns(io.BytesIO(document), chunksize=1))
+
+
+def test_streamed_and_downloaded_rows_hash_alike(local_s3, s3_cache):
+    """Rows hash the same whether streamed or downloaded, although a chunk's columns may be typed differently"""
+    pd.DataFrame({'day': [None, None, 19.0, 3.0], 'month': ['NULL', 'NULL', 9, '4']}).to_json(
+        local_s3.root / 'data-handling-public' / 'date_details.json')
+    extractor = DataExtractor(s3_client=local_s3, cache=s3_cache)
+    chunks = list(extractor.stream_from_s3('s3://data-handling-public/date_details.json', chunksize=2))
+    assert chunks[0]['day'].dtype != chunks[1]['day'].dtype
+    downloaded = extractor.extract_from_s3('s3://data-handling-public/date_details.json')
+    assert pd.concat(map(DataExtractor.hash_rows, chunks)).tolist() == DataExtractor.hash_rows(downloaded).tolist()
+
+
+@pytest.fixture
+def card_pdf(tmp_path):
+    """Returns the path of a 3 page pdf"""
+    writer = PdfWriter()
+    for _ in range(3):
+        writer.add_blank_page(width=200, height=200)
+    path = tmp_path / 'card_details.pdf'
+    with open(path, 'wb') as f:
+        writer.write(f)
+    return str(path)
+
+
+@pytest.fixture
+def parsed_pages(monkeypatch):
+    """Replaces tabula with a stub returning one table per page, records the batches of pages read"""
+    batches = []
+
+    def read_pdf_pages(pdf_path, pages):
+        batches.append(pages)
+        return [
+            pd.DataFrame({
+                'card_number': [30060773296197 + page] if page % 2 else [f"??{page}"],
+                'card_provider': ['VISA 16 digit'],
+                'expiry_date': [np.nan],
+            }) for page in pages
+        ]
+
+    monkeypatch.setattr(data_extraction, '_read_pdf_pages', read_pdf_pages)
+    return batches
+
+
+def test_retrieve_pdf_data_parses_pages_in_batches(card_pdf, parsed_pages, s3_cache,
+                                                   monkeypatch):
+    """Pages are parsed in batches of PDF_PAGES_PER_BATCH and joined into one table"""
+    monkeypatch.setattr(data_extraction, 'PDF_PAGES_PER_BATCH', 2)
+    df = DataExtractor(cache=s3_cache).retrieve_pdf_data(card_pdf, max_workers=1)
+    assert parsed_pages == [[1, 2], [3]]
+    assert list(df.index) == [0, 1, 2]
+    assert list(df['card_number']) == ['30060773296198', '??2', '30060773296200']
+    assert df['expiry_date'].isna().all()
+
+
+def read_pdf_pages_in_worker(pdf_path, pages):
+    """Stub of tabula for worker processes, one table per page naming the page and process. The first batch is
+    slowest so it finishes after the others"""
+    if 1 in pages:
+        time.sleep(0.5)
+    return [pd.DataFrame({'page': [page], 'pid': [os.getpid()]}) for page in pages]
+
+
+def test_retrieve_pdf_data_parses_batches_in_worker_processes(tmp_path, s3_cache, monkeypatch):
+    """Batches parsed in worker processes are joined in page order, however they finish"""
+    writer = PdfWriter()
+    for _ in range(7):
+        writer.add_blank_page(width=200, height=200)
+    pdf_path = tmp_path / 'card_details.pdf'
+    with open(pdf_path, 'wb') as f:
+        writer.write(f)
+    monkeypatch.setattr(data_extraction, 'PDF_PAGES_PER_BATCH', 2)
+    monkeypatch.setattr(data_extraction, '_read_pdf_pages', read_pdf_pages_in_worker)
+
+    df = DataExtractor(cache=s3_cache).retrieve_pdf_data(str(pdf_path), max_workers=2)
+    assert list(df.index) == list(range(7))
+    assert list(df['page'].astype(int)) == [1, 2, 3, 4, 5, 6, 7]
+    assert str(os.getpid()) not in set(df['pid'].astype(str))
+
+
+def test_retrieve_pdf_data_cached(card_pdf, parsed_pages, s3_cache):
+    """An unchanged pdf is read from the cache without being parsed"""
+    extractor = DataExtractor(cache=s3_cache)
+    df_first = extractor.retrieve_pdf_data(card_pdf, max_workers=1)
+    df_second = extractor.retrieve_pdf_data(card_pdf, max_workers=1)
+    assert len(parsed_pages) == 1
+    pd.testing.assert_frame_equal(df_first, df_second)
+
+
+def test_get_s3_etag_changes_with_object(local_s3, s3_cache):
+    """The ETag changes when the object is rewritten, and is None for a missing object"""
+    extractor = DataExtractor(s3_client=local_s3, cache=s3_cache)
+    etag = extractor.get_s3_etag('s3://data-handling-public/products.csv')
+    pd.DataFrame({'product_name': ['Fish food']}).to_csv(
+        local_s3.root / 'data-handling-public' / 'products.csv')
+    assert extractor.get_s3_etag('s3://data-handling-public/products.csv') != etag
+    assert extractor.get_s3_etag('s3://data-handling-public/missing.csv') is None
@@ -0,0 +1,361 @@
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.types import VARCHAR
+
+from data_cleaning import DataCleaning
+from data_extraction import DataExtractor
+from database_utils import DatabaseConnector
+
+NUMBER_ORDERS = 30000
+
+
+@pytest.fixture(scope='module')
+def source_engine(tmp_path_factory):
+    """Returns an engine for a sqlite database holding an orders_table"""
+    path = tmp_path_factory.mktemp('source') / 'source.db'
+    engine = create_engine(f"sqlite:///{path}")
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'level_0': np.arange(NUMBER_ORDERS),
+        'index': np.arange(NUMBER_ORDERS),
+        'date_uuid': [f"date-{n:036d}" for n in range(NUMBER_ORDERS)],
+        'first_name': None,
+        'last_name': None,
+        'user_uuid': [f"user-{n:036d}" for n in range(NUMBER_ORDERS)],
+        'card_number': rng.integers(10**15, 10**16, NUMBER_ORDERS),
+        'store_code': 'WEB-1388012W',
+        'product_code': 'A8-4686892S',
+        '1': None,
+        'product_quantity': rng.integers(1, 14, NUMBER_ORDERS),
+    })
+    df.to_sql('orders_table', engine, index=False)
+    return engine
+
+
+@pytest.fixture
+def target_engine(tmp_path):
+    """Returns an engine for an empty sqlite database"""
+    return create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+
+
+def run_full_pipeline(source_engine, target_engine):
+    """Read the whole orders_table, clean and upload it in one go"""
+    with source_engine.connect() as conn:
+        df = DataExtractor.read_rds_table(conn, 'orders_table')
+    df = DataCleaning().clean_order_data(df=df)
+    DatabaseConnector.upload_to_db(target_engine, df=df, table_name='orders_table')
+
+
+def run_chunked_pipeline(source_engine, target_engine, chunksize=5000):
+    """Stream orders_table in chunks through cleaning and upload"""
+    data_cleaner = DataCleaning()
+    with source_engine.connect() as conn:
+        chunks = DataExtractor.read_rds_table_in_chunks(conn,
+                                                        'orders_table',
+                                                        chunksize=chunksize)
+        chunks = data_cleaner.clean_chunks(chunks, data_cleaner.clean_order_data)
+        return DatabaseConnector.upload_chunks_to_db(target_engine,
+                                                     chunks=chunks,
+                                                     table_name='orders_table')
+
+
+def peak_memory(function, *args) -> int:
+    """Returns the peak memory traced while running function"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def test_read_rds_table_in_chunks_yields_chunksize_rows(source_engine):
+    """Chunks have chunksize rows, apart from the last chunk"""
+    with source_engine.connect() as conn:
+        chunk_lengths = [
+            len(chunk.index) for chunk in DataExtractor.read_rds_table_in_chunks(
+                conn, 'orders_table', chunksize=12000)
+        ]
+    assert chunk_lengths == [12000, 12000, 6000]
+
+
+def test_chunked_pipeline_matches_full_pipeline(source_engine, tmp_path):
+    """The chunked pipeline uploads the same table as the full pipeline"""
+    full_engine = create_engine(f"sqlite:///{tmp_path / 'full.db'}")
+    chunked_engine = create_engine(f"sqlite:///{tmp_path / 'chunked.db'}")
+    run_full_pipeline(source_engine, full_engine)
+    number_rows = run_chunked_pipeline(source_engine, chunked_engine)
+
+    df_full = pd.read_sql_table('orders_table', full_engine)
+    df_chunked = pd.read_sql_table('orders_table', chunked_engine)
+    assert number_rows == NUMBER_ORDERS
+    pd.testing.assert_frame_equal(df_full, df_chunked)
+
+
+def test_chunked_pipeline_peak_memory_is_lower(source_engine, target_engine):
+    """Peak memory of the chunked pipeline is well below reading the whole table at once"""
+    full_peak = peak_memory(run_full_pipeline, source_engine, target_engine)
+    chunked_peak = peak_memory(run_chunked_pipeline, source_engine, target_engine)
+    assert chunked_peak < full_peak / 2
+
+
+class FakeCursor:
+    """Records the sql and file contents passed to copy_expert"""
+
+    def __init__(self):
+        self.sql = None
+        self.contents = None
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def copy_expert(self, sql, file):
+        self.sql = sql
+        self.contents = file.read()
+        self.rowcount = self.contents.count('\n')
+
+
+def test_copy_from_stdin_streams_csv_rows():
+    """Rows are written as CSV and loaded with a single COPY FROM STDIN statement"""
+    cursor = FakeCursor()
+    conn = SimpleNamespace(connection=SimpleNamespace(cursor=lambda: cursor))
+    table = SimpleNamespace(name='dim_products', schema=None)
+
+    number_rows = DatabaseConnector._copy_from_stdin(
+        table, conn, ['index', 'EAN', 'product_name'],
+        iter([(0, '123', 'Dog food, large'), (1, None, 'Cat food'), (2, '', 'Fish food')]))
+
+    assert cursor.sql == (
+        'COPY "dim_products" ("index", "EAN", "product_name") FROM STDIN WITH (FORMAT CSV, NULL \'\\N\')'
+    )
+    assert cursor.contents == '0,123,"Dog food, large"\r\n1,\\N,Cat food\r\n2,,Fish food\r\n'
+    assert number_rows == 3
+
+
+def test_copy_from_stdin_writes_missing_values_as_null(target_engine):
+    """Missing values in a dataframe reach COPY as the NULL marker, empty strings as empty fields"""
+    cursor = FakeCursor()
+    conn = SimpleNamespace(connection=SimpleNamespace(cursor=lambda: cursor))
+    df = pd.DataFrame({'address': ['4 High Street', np.nan, ''], 'lat': [np.nan, 1.5, 2.0]})
+
+    df.to_sql('dim_store_details',
+              target_engine,
+              index=False,
+              method=lambda table, _, keys, data_iter: DatabaseConnector.
+              _copy_from_stdin(table, conn, keys, data_iter))
+
+    assert cursor.contents == '4 High Street,\\N\r\n\\N,1.5\r\n,2.0\r\n'
+
+
+def test_insert_method_falls_back_to_to_sql(target_engine):
+    """Non Postgres engines, or bulk_copy=False, use to_sql's default insert"""
+    assert DatabaseConnector._insert_method(target_engine, bulk_copy=True) is None
+    postgres_engine = create_engine('postgresql+psycopg2://user:pw@localhost/db')
+    assert DatabaseConnector._insert_method(postgres_engine, bulk_copy=False) is None
+    assert DatabaseConnector._insert_method(
+        postgres_engine, bulk_copy=True) == DatabaseConnector._copy_from_stdin
+
+
+def run_incremental_pipeline(source_engine, target_engine, chunksize=5000):
+    """Stream the orders added since the last watermark through cleaning and upsert"""
+    data_cleaner = DataCleaning()
+    watermark = DatabaseConnector.read_watermark(target_engine, 'orders_table')
+    with source_engine.connect() as conn:
+        chunks = DataExtractor.read_rds_table_in_chunks(
+            conn,
+            'orders_table',
+            chunksize=chunksize,
+            after_index=int(watermark) if watermark is not None else -1)
+        chunks = data_cleaner.clean_chunks(chunks, data_cleaner.clean_order_data)
+        return DatabaseConnector.upsert_chunks_to_db(target_engine,
+                                                     chunks=chunks,
+                                                     table_name='orders_table',
+                                                     key_columns=['index'],
+                                                     watermark_source='orders_table')
+
+
+def test_read_rds_table_in_chunks_after_index(source_engine):
+    """Only rows after after_index are read, in index order"""
+    with source_engine.connect() as conn:
+        df = pd.concat(
+            DataExtractor.read_rds_table_in_chunks(conn,
+                                                   'orders_table',
+                                                   chunksize=400,
+                                                   after_index=NUMBER_ORDERS - 1000))
+    assert list(df['index']) == list(range(NUMBER_ORDERS - 999, NUMBER_ORDERS))
+
+
+def test_incremental_pipeline_loads_only_new_orders(source_engine, tmp_path):
+    """A second incremental run with no new orders upserts nothing and matches a full load"""
+    full_engine = create_engine(f"sqlite:///{tmp_path / 'full.db'}")
+    incremental_engine = create_engine(f"sqlite:///{tmp_path / 'incremental.db'}")
+    run_full_pipeline(source_engine, full_engine)
+
+    assert run_incremental_pipeline(source_engine, incremental_engine) == NUMBER_ORDERS
+    assert DatabaseConnector.read_watermark(incremental_engine,
+                                            'orders_table') == str(NUMBER_ORDERS - 1)
+    assert run_incremental_pipeline(source_engine, incremental_engine) == 0
+
+    df_full = pd.read_sql_table('orders_table', full_engine)
+    df_incremental = pd.read_sql_table('orders_table', incremental_engine)
+    pd.testing.assert_frame_equal(df_full, df_incremental)
+
+
+def test_upsert_to_db_inserts_new_and_updates_existing_rows(target_engine):
+    """Rows with an existing key are updated, the rest are inserted"""
+    df = pd.DataFrame({'date_uuid': ['a', 'b'], 'month': ['1', '2']})
+    with target_engine.begin() as conn:
+        DatabaseConnector.upsert_to_db(conn, df, 'dim_date_times', ['date_uuid'])
+    df_changed = pd.DataFrame({'date_uuid': ['b', 'c'], 'month': ['12', '3']},
+                              index=[1, 2])
+    with target_engine.begin() as conn:
+        DatabaseConnector.upsert_to_db(conn, df_changed, 'dim_date_times',
+                                       ['date_uuid'])
+
+    df_loaded = pd.read_sql_query(
+        'SELECT date_uuid, month FROM dim_date_times ORDER BY date_uuid', target_engine)
+    assert df_loaded.to_dict('list') == {
+        'date_uuid': ['a', 'b', 'c'],
+        'month': ['1', '12', '3']
+    }
+    assert 'dim_date_times_staging' not in pd.read_sql_query(
+        "SELECT name FROM sqlite_master WHERE type = 'table'", target_engine)['name'].tolist()
+
+
+def test_upsert_to_db_rolls_back_with_watermark(target_engine):
+    """A failed upsert leaves neither the rows nor the watermark behind"""
+    df = pd.DataFrame({'date_uuid': ['a'], 'month': ['1']})
+    with pytest.raises(RuntimeError):
+        with target_engine.begin() as conn:
+            DatabaseConnector.upsert_to_db(conn, df, 'dim_date_times', ['date_uuid'])
+            DatabaseConnector.write_watermark(conn, 'date_details.json', '"etag"')
+            raise RuntimeError('load failed')
+
+    assert DatabaseConnector.read_watermark(target_engine, 'date_details.json') is None
+
+
+def test_row_hashes_select_changed_rows(target_engine):
+    """Rows whose hash was recorded on the last load are not selected again"""
+    df = pd.DataFrame({'date_uuid': ['a', 'b', 'c'], 'month': ['1', '2', '3']})
+    with target_engine.begin() as conn:
+        DatabaseConnector.write_row_hashes(conn, 'date_details.json',
+                                           DataExtractor.hash_rows(df))
+
+    df_new = pd.DataFrame({'date_uuid': ['a', 'b', 'c', 'd'], 'month': ['1', '12', '3', '4']})
+    previous_hashes = DatabaseConnector.read_row_hashes(target_engine, 'date_details.json')
+    df_changed = DataExtractor.select_changed_rows(df_new, DataExtractor.hash_rows(df_new),
+                                                   previous_hashes)
+    assert list(df_changed['date_uuid']) == ['b', 'd']
+
+
+def test_upload_to_db_creates_typed_table_with_primary_key(target_engine):
+    """The table is created with the given column types and primary key before rows are loaded"""
+    df = pd.DataFrame({
+        'date_uuid': ['9476f17e-5d6a-4117-874d-9cdb38ca1fa6'],
+        'month': ['3'],
+        'time_period': ['Evening'],
+    })
+    DatabaseConnector.upload_to_db(target_engine,
+                                   df=df,
+                                   table_name='dim_date_times',
+                                   sql_dtypes={'month': VARCHAR(2)},
+                                   primary_key='date_uuid')
+
+    inspector = inspect(target_engine)
+    column_types = {
+        column['name']: str(column['type'])
+        for column in inspector.get_columns('dim_date_times')
+    }
+    assert column_types == {
+        'index': 'BIGINT',
+        'date_uuid': 'TEXT',
+        'month': 'VARCHAR(2)',
+        'time_period': 'TEXT'
+    }
+    assert inspector.get_pk_constraint('dim_date_times')['constrained_columns'] == ['date_uuid']
+    pd.testing.assert_frame_equal(
+        pd.read_sql_table('dim_date_times', target_engine, index_col='index'),
+        df.rename_axis('index'))
+
+
+def test_upload_chunks_to_db_typed_table_replaced(target_engine):
+    """Typed chunk uploads replace the table on each run rather than appending"""
+    chunks = [pd.DataFrame({'user_uuid': ['a', 'b']}), pd.DataFrame({'user_uuid': ['c']}, index=[2])]
+    for _ in range(2):
+        number_rows = DatabaseConnector.upload_chunks_to_db(target_engine,
+                                                            chunks=iter(chunks),
+                                                            table_name='dim_users',
+                                                            primary_key='user_uuid')
+    assert number_rows == 3
+    assert pd.read_sql_table('dim_users', target_engine)['user_uuid'].tolist() == ['a', 'b', 'c']
+
+
+@pytest.fixture
+def loaded_star(target_engine):
+    """Loads two dimension tables without keys and an orders_table referencing them"""
+    DatabaseConnector.upload_to_db(target_engine,
+                                   df=pd.DataFrame({'user_uuid': ['a', 'b']}),
+                                   table_name='dim_users')
+    DatabaseConnector.upload_to_db(target_engine,
+                                   df=pd.DataFrame({'store_code': ['WEB-1388012W']}),
+                                   table_name='dim_store_details')
+    DatabaseConnector.upload_to_db(target_engine,
+                                   df=pd.DataFrame({
+                                       'user_uuid': ['a', 'b', 'a'],
+                                       'store_code': 'WEB-1388012W'
+                                   }),
+                                   table_name='orders_table')
+    return target_engine
+
+
+def test_finalise_load_builds_keys_and_join_indexes(loaded_star):
+    """Dimension keys and orders_table join indexes are built, and each one is timed"""
+    timings = DatabaseConnector.finalise_load(
+        loaded_star,
+        primary_keys={'dim_users': 'user_uuid', 'dim_store_details': 'store_code'},
+        table_name='orders_table',
+        foreign_keys={'user_uuid': 'dim_users', 'store_code': 'dim_store_details'},
+        max_workers=4)
+
+    assert set(timings) == {
+        'dim_users_pkey', 'dim_store_details_pkey', 'ix_orders_table_user_uuid',
+        'ix_orders_table_store_code'
+    }
+    inspector = inspect(loaded_star)
+    assert ('dim_users_pkey', 1) in [(index['name'], index['unique'])
+                                     for index in inspector.get_indexes('dim_users')]
+    assert {index['name'] for index in inspector.get_indexes('orders_table')} >= {
+        'ix_orders_table_user_uuid', 'ix_orders_table_store_code'
+    }
+
+
+def test_finalise_load_keeps_natural_keys_unique(loaded_star):
+    """Dimension tables keyed by surrogate keys get a unique index on their natural keys"""
+    timings = DatabaseConnector.finalise_load(loaded_star,
+                                              primary_keys={},
+                                              table_name='orders_table',
+                                              foreign_keys={},
+                                              unique_keys={'dim_users': 'user_uuid'})
+    assert set(timings) == {'dim_users_user_uuid_key'}
+    assert ('dim_users_user_uuid_key', 1) in [(index['name'], index['unique'])
+                                              for index in inspect(loaded_star).get_indexes('dim_users')]
+
+
+def test_finalise_load_duplicate_key_fails(loaded_star):
+    """A dimension table with a duplicated key fails the load"""
+    pd.DataFrame({'user_uuid': ['a']}).to_sql('dim_users', loaded_star, if_exists='append')
+    with pytest.raises(Exception, match='UNIQUE'):
+        DatabaseConnector.finalise_load(loaded_star,
+                                        primary_keys={'dim_users': 'user_uuid'},
+                                        table_name='orders_table',
+                                        foreign_keys={'user_uuid': 'dim_users'})
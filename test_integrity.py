@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from config import order, product, store
+import integrity
+from integrity import KeySet, QUARANTINE, ReferentialIntegrity, STUB
+from profiling import RunReport
+from quarantine import Quarantine
+
+PRODUCT_CODES = [f"A{n}-{n:07d}S" for n in range(5)]
+STORE_CODES = ['WEB-1388012W', 'HI-9B97EE4E']
+
+
+@pytest.fixture
+def rejected(monkeypatch):
+    """Replaces the quarantine and the run report with empty ones, returns the quarantine"""
+    quarantine = Quarantine()
+    monkeypatch.setattr(integrity, 'quarantine', quarantine)
+    monkeypatch.setattr(integrity, 'run_report', RunReport())
+    return quarantine
+
+
+def checked(on_orphans: str) -> ReferentialIntegrity:
+    """Returns a check of orders against products and stores, both loaded in chunks"""
+    checker = ReferentialIntegrity([product, store], on_orphans=on_orphans)
+    products = pd.DataFrame({'product_code': PRODUCT_CODES})
+    list(checker.check_chunks(product, [products.iloc[:3], products.iloc[3:]]))
+    list(checker.check_chunks(store, [pd.DataFrame({'store_code': STORE_CODES})]))
+    return checker
+
+
+@pytest.fixture
+def orders():
+    return pd.DataFrame({
+        'store_code': pd.Categorical(['HI-9B97EE4E', 'XX-00000000', None, 'WEB-1388012W']),
+        'product_code': ['A4-0000004S', 'A0-0000000S', 'unknown', 'unknown'],
+        'product_quantity': [1, 2, 3, 4],
+    })
+
+
+@pytest.mark.parametrize('dtype', ['category', 'string[pyarrow]', object])
+def test_key_set_orphans(dtype):
+    """Keys missing from the set are orphans, whatever their dtype, nulls are not"""
+    keys = pd.Series(['b', None, 'x', 'a', 'x'], dtype=dtype)
+    key_set = KeySet(pd.Series(['a', 'b', 'c']))
+    assert key_set.orphans(keys).tolist() == [False, False, True, False, True]
+    key_set.add(pd.Series(['x']))
+    assert not key_set.orphans(keys).any()
+
+
+def test_orphans_are_counted_per_column(rejected, orders):
+    checker = checked('report')
+    df = checker.check(orders)
+    assert df is orders
+    assert checker.orphans == {'store_code': 1, 'product_code': 2}
+    stats = {stats.stage: stats.rows_in - stats.rows_out for stats in integrity.run_report.stats()}
+    assert stats == {'orphans orders_table store_code': 1, 'orphans orders_table product_code': 2}
+
+
+def test_orphans_are_quarantined(rejected, orders):
+    """Orphans are quarantined with the first foreign key they are missing, and not loaded"""
+    df = checked(QUARANTINE).check(orders)
+    assert df['product_quantity'].tolist() == [1]
+    df = rejected.frames()[order.table_name]
+    assert df['product_quantity'].tolist() == [2, 3, 4]
+    assert df['rule'].tolist() == ['orphan store_code', 'orphan product_code', 'orphan product_code']
+
+
+def test_orphans_get_stub_rows_once(rejected, orders):
+    """Each missing key is handed to load_stubs once, and later orders referencing it aren't orphans"""
+    checker = checked(STUB)
+    stubs = []
+    chunks = list(checker.check_chunks(order, [orders.iloc[:2], orders.iloc[2:]],
+                                       lambda data_type, df: stubs.append((data_type.table_name, df))))
+    assert pd.concat(chunks)['product_quantity'].tolist() == [1, 2, 3, 4]
+    assert [(table_name, df.to_dict('list')) for table_name, df in stubs] == [
+        ('dim_store_details', {'store_code': ['XX-00000000']}),
+        ('dim_products', {'product_code': ['unknown']}),
+    ]
+    assert checker.orphans == {'store_code': 1, 'product_code': 2}
+
+
+def test_orders_wait_for_every_dimension(orders):
+    checker = ReferentialIntegrity([product, store])
+    list(checker.check_chunks(product, [pd.DataFrame({'product_code': PRODUCT_CODES})]))
+    with pytest.raises(ValueError, match='dim_store_details'):
+        checker.check(orders)
+
+
+def test_unknown_action():
+    with pytest.raises(ValueError, match='ignore'):
+        ReferentialIntegrity(on_orphans='ignore')
+
+
+def test_categorical_keys_are_checked_by_code(rejected):
+    """A large chunk of categorical keys is checked against each category once"""
+    codes = np.random.default_rng(0).integers(-1, len(PRODUCT_CODES) + 1, 100000)
+    keys = pd.Series(pd.Categorical.from_codes(codes, categories=[*PRODUCT_CODES, 'unknown']))
+    orphans = KeySet(pd.Series(PRODUCT_CODES)).orphans(keys)
+    np.testing.assert_array_equal(orphans, codes == len(PRODUCT_CODES))
+
+
+DATE_UUIDS = ['4b9b1f8e-6d0a-4c57-9a4e-1f0e3c2d5b6a', '0a1b2c3d-4e5f-4a6b-8c7d-9e0f1a2b3c4d',
+              'ffffffff-5d6a-4117-874d-9cdb38ca1fa6']
+
+
+@pytest.mark.parametrize('dtype', ['string[pyarrow]', object])
+def test_string_keys_are_checked_by_the_index(dtype):
+    """Keys which aren't categorical are looked up in the index of the set, nulls are not orphans"""
+    key_set = KeySet(pd.Series(DATE_UUIDS[:2]))
+    keys = pd.Series([*DATE_UUIDS, None, DATE_UUIDS[0].upper()], dtype=dtype)
+    assert key_set.orphans(keys).tolist() == [False, False, True, False, True]
+    key_set.add(pd.Series([DATE_UUIDS[2]], dtype=object))
+    assert key_set.orphans(keys).tolist() == [False, False, False, False, True]
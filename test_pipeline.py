@@ -0,0 +1,306 @@
+from dataclasses import replace
+from typing import Iterator
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+from cache import LocalCache
+import data_cleaning
+from config import date_times, order
+from data_extraction import DataExtractor
+from database_utils import DatabaseConnector
+from integrity import ReferentialIntegrity, STUB
+from quarantine import Quarantine
+import pipeline
+from pipeline import (CLEAN, EXTRACT, LOAD, READERS, RdsTableReader, RunContext, SourceReader,
+                      register_reader, run_pipeline)
+from staging import Staging, CLEANED, RAW
+from surrogate_keys import SurrogateKeys
+
+NUMBER_DATES = 300
+
+
+def make_date_details(number_rows: int) -> pd.DataFrame:
+    """Returns raw date details as they are read from s3"""
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'timestamp': [f"{hour:02d}:00:00" for hour in rng.integers(0, 24, number_rows)],
+        'month': rng.integers(1, 13, number_rows).astype(str),
+        'year': rng.integers(1990, 2023, number_rows).astype(str),
+        'day': rng.integers(1, 29, number_rows).astype(str),
+        'time_period': 'Evening',
+        'date_uuid': [f"{n:08x}-5d6a-4117-874d-9cdb38ca1fa6" for n in range(number_rows)],
+    })
+
+
+@pytest.fixture
+def frames_reader(monkeypatch):
+    """Registers a reader of in memory dataframes, returns the dataframes it will read"""
+    frames = {}
+    monkeypatch.setitem(READERS, 'frames', None)
+
+    @register_reader('frames')
+    class FramesReader(SourceReader):
+
+        def extract(self) -> Iterator[pd.DataFrame]:
+            yield from frames[self.source.location]
+
+    return frames
+
+
+@pytest.fixture
+def s3_dates(context, monkeypatch):
+    """Returns the raw date details the s3 date_times source will read"""
+    raw = make_date_details(NUMBER_DATES)
+    monkeypatch.setattr(context.data_extractor, 'get_s3_etag', lambda s3_address: '"etag"')
+    monkeypatch.setattr(context.data_extractor, 'extract_from_s3', lambda s3_address: raw)
+    return raw
+
+
+@pytest.fixture
+def context(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+    return RunContext(source_engine=None,
+                      target_engine=engine,
+                      data_extractor=DataExtractor(cache=LocalCache(tmp_path / 'cache', 2**20)))
+
+
+def test_registered_reader_is_extracted_cleaned_and_loaded(context, frames_reader):
+    """A new source only needs a reader and a DataType"""
+    frames_reader['dates'] = [make_date_details(NUMBER_DATES)]
+    data_type = replace(date_times, source=replace(date_times.source, kind='frames', location='dates'))
+    run_pipeline(data_type, context)
+
+    df = pd.read_sql_table('dim_date_times', context.target_engine)
+    assert len(df.index) == NUMBER_DATES
+    assert df['date_uuid'].tolist() == frames_reader['dates'][0]['date_uuid'].tolist()
+
+
+def test_reader_without_extract_cannot_be_made(context):
+    """A reader must extract its source before it can be used"""
+
+    class Incomplete(SourceReader):
+        pass
+
+    with pytest.raises(TypeError, match='abstract method extract'):
+        Incomplete(date_times, context)
+
+
+def test_keys_repeated_across_chunks_are_rejected(context, frames_reader, monkeypatch):
+    """Rows repeating a unique key of an earlier chunk are quarantined rather than loaded"""
+    rejected = Quarantine()
+    monkeypatch.setattr(data_cleaning, 'quarantine', rejected)
+    dates = make_date_details(NUMBER_DATES)
+    frames_reader['dates'] = [dates.iloc[:200], dates.iloc[100:]]
+    data_type = replace(date_times,
+                        source=replace(date_times.source, kind='frames', location='dates'),
+                        max_rejected_fraction=0.5)
+    run_pipeline(data_type, context)
+
+    df = pd.read_sql_table('dim_date_times', context.target_engine)
+    assert sorted(df['date_uuid']) == sorted(dates['date_uuid'])
+    quarantined = rejected.frames()['dim_date_times']
+    assert len(quarantined.index) == 100
+    assert set(quarantined['rule']) == {'unique date_uuid across chunks'}
+
+
+def test_rejected_fraction_is_checked_on_the_whole_stream(context, frames_reader, monkeypatch):
+    """A bad row in a short last chunk is within the tolerance of the whole table, too many bad rows are not"""
+    monkeypatch.setattr(data_cleaning, 'quarantine', Quarantine())
+    dates = make_date_details(NUMBER_DATES)
+    dates.loc[NUMBER_DATES - 1, 'month'] = '13'
+    frames_reader['dates'] = [dates.iloc[:250], dates.iloc[250:]]
+    data_type = replace(date_times,
+                        source=replace(date_times.source, kind='frames', location='dates'),
+                        max_rejected_fraction=0.01)
+    run_pipeline(data_type, context)
+    assert len(pd.read_sql_table('dim_date_times', context.target_engine).index) == NUMBER_DATES - 1
+
+    dates.loc[:9, 'month'] = '13'
+    frames_reader['dates'] = [dates.iloc[:250], dates.iloc[250:]]
+    with pytest.raises(ValueError, match='11 of 300 rows of dim_date_times rejected'):
+        run_pipeline(data_type, context)
+
+
+def test_incremental_s3_source_records_etag_and_row_hashes(context, s3_dates):
+    """Loading an incremental s3 source records its ETag and the hashes of the raw rows"""
+    row_hashes = DataExtractor.hash_rows(s3_dates)
+    run_pipeline(date_times, context)
+
+    location = date_times.source.location
+    assert DatabaseConnector.read_watermark(context.target_engine, location) == '"etag"'
+    assert sorted(DatabaseConnector.read_row_hashes(context.target_engine, location)) == sorted(row_hashes)
+
+
+def test_chunked_source_records_largest_index(context, monkeypatch):
+    """An incremental table is loaded chunk by chunk and records the largest index loaded"""
+    monkeypatch.setitem(READERS, 'frames_table', None)
+    orders = pd.DataFrame({
+        'level_0': np.arange(30),
+        'index': np.arange(30),
+        'date_uuid': [f"{n:08x}-5d6a-4117-874d-9cdb38ca1fa6" for n in range(30)],
+        'user_uuid': [f"{n:08x}-5d6a-4117-874d-9cdb38ca1fa6" for n in range(30)],
+        'card_number': '4971858637664481',
+        'store_code': 'WEB-1388012W',
+        'product_code': 'R7-3126933h',
+        'first_name': None,
+        'last_name': None,
+        '1': None,
+        'product_quantity': 3,
+    })
+
+    @register_reader('frames_table')
+    class FramesTableReader(RdsTableReader):
+
+        def extract(self) -> Iterator[pd.DataFrame]:
+            yield from [orders.iloc[:10], orders.iloc[10:20], orders.iloc[20:]]
+
+    data_type = replace(order, source=replace(order.source, kind='frames_table', location='orders'))
+    run_pipeline(data_type, context)
+
+    assert len(pd.read_sql_table('orders_table', context.target_engine).index) == 30
+    assert DatabaseConnector.read_watermark(context.target_engine, 'orders') == '29'
+
+
+def test_stages_run_separately_through_staging(tmp_path, context, s3_dates):
+    """Each stage reads the output of the previous one from staging"""
+    staging = Staging(tmp_path / 'staging', run_id='20231101T120000')
+    for stage in (EXTRACT, CLEAN, LOAD):
+        run_pipeline(date_times, replace(context, stages=(stage,), staging=staging))
+
+    assert len(staging.read('dim_date_times', RAW).index) == NUMBER_DATES
+    pd.testing.assert_frame_equal(
+        pd.read_sql_table('dim_date_times', context.target_engine, index_col='index',
+                          parse_dates=['date']).drop(columns='date_uuid'),
+        staging.read('dim_date_times', CLEANED).drop(columns='date_uuid'),
+        check_dtype=False, check_categorical=False, check_names=False)
+    # Loaded from staging, so the ETag is unknown and the row hashes are taken from the staged raw rows
+    location = date_times.source.location
+    assert DatabaseConnector.read_watermark(context.target_engine, location) is None
+    assert sorted(DatabaseConnector.read_row_hashes(context.target_engine, location)) == sorted(
+        DataExtractor.hash_rows(s3_dates))
+
+
+def test_cleaning_does_not_copy_the_extracted_data(context, frames_reader, monkeypatch):
+    """The raw chunk is handed to cleaning as it was extracted"""
+    raw = make_date_details(NUMBER_DATES)
+    frames_reader['dates'] = [raw]
+    cleaned = []
+    monkeypatch.setattr(pipeline, 'clean_dataframe',
+                        lambda data_type, df: cleaned.append(df) or df)
+    data_type = replace(date_times, source=replace(date_times.source, kind='frames', location='dates'))
+    run_pipeline(data_type, replace(context, stages=(EXTRACT, CLEAN)))
+    assert cleaned[0] is raw
+
+
+def test_source_read_whole_is_loaded_in_slices(context, s3_dates, monkeypatch):
+    """Sources read in one piece are loaded LOAD_CHUNK_SIZE rows at a time"""
+    monkeypatch.setattr(pipeline, 'LOAD_CHUNK_SIZE', 128)
+    loaded = []
+    upload_chunks_to_db = DatabaseConnector.upload_chunks_to_db
+
+    def upload(engine, chunks, **kwargs):
+        chunks = (loaded.append(len(chunk.index)) or chunk for chunk in chunks)
+        return upload_chunks_to_db(engine, chunks=chunks, **kwargs)
+
+    monkeypatch.setattr(context.target_db, 'upload_chunks_to_db', upload)
+    run_pipeline(date_times, context)
+    assert loaded == [128, 128, NUMBER_DATES - 256]
+    assert len(pd.read_sql_table('dim_date_times', context.target_engine).index) == NUMBER_DATES
+
+
+def test_streamed_s3_source_is_cleaned_in_chunks(context, s3_dates, monkeypatch):
+    """With stream_s3 each chunk parsed from s3 is cleaned and loaded as it is read"""
+    context.data_extractor.stream_s3 = True
+    monkeypatch.setattr(context.data_extractor, 'stream_from_s3',
+                        lambda s3_address: (s3_dates.iloc[start:start + 128]
+                                            for start in range(0, NUMBER_DATES, 128)))
+    cleaned = []
+    clean_dataframe = pipeline.clean_dataframe
+
+    def clean(data_type, df):
+        cleaned.append(len(df.index))
+        return clean_dataframe(data_type, df)
+
+    monkeypatch.setattr(pipeline, 'clean_dataframe', clean)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', pd.errors.SettingWithCopyWarning)
+        run_pipeline(date_times, context)
+    assert cleaned == [128, 128, NUMBER_DATES - 256]
+    assert len(pd.read_sql_table('dim_date_times', context.target_engine).index) == NUMBER_DATES
+    row_hashes = DatabaseConnector.read_row_hashes(context.target_engine, date_times.source.location)
+    assert sorted(row_hashes) == sorted(DataExtractor.hash_rows(s3_dates))
+
+
+def make_orders(date_uuids: list) -> pd.DataFrame:
+    """Returns raw orders of the dates, as they are read from the source database"""
+    number_rows = len(date_uuids)
+    return pd.DataFrame({
+        'level_0': np.arange(number_rows),
+        'index': np.arange(number_rows),
+        'date_uuid': date_uuids,
+        'user_uuid': [f"{n:08x}-5d6a-4117-874d-9cdb38ca1fa6" for n in range(number_rows)],
+        'card_number': '4971858637664481',
+        'store_code': 'WEB-1388012W',
+        'product_code': 'R7-3126933h',
+        'first_name': None,
+        'last_name': None,
+        '1': None,
+        'product_quantity': 3,
+    })
+
+
+@pytest.fixture
+def load_dates_and_orders(context, frames_reader, monkeypatch):
+    """Returns a function loading the dates then the orders through the pipeline with a run context"""
+    monkeypatch.setitem(READERS, 'frames_table', None)
+
+    @register_reader('frames_table')
+    class FramesTableReader(RdsTableReader):
+
+        def extract(self) -> Iterator[pd.DataFrame]:
+            yield from frames_reader[self.source.location]
+
+    def load(dates: pd.DataFrame, orders: pd.DataFrame, run_context: RunContext):
+        frames_reader['dates'], frames_reader['orders'] = [dates], [orders]
+        run_pipeline(replace(date_times, source=replace(date_times.source, kind='frames', location='dates')),
+                     run_context)
+        run_pipeline(replace(order, source=replace(order.source, kind='frames_table', location='orders')),
+                     run_context)
+
+    return load
+
+
+def test_orders_loaded_with_surrogate_keys(context, load_dates_and_orders):
+    """Dimension rows are numbered as they are loaded, and orders reference those numbers"""
+    dates = make_date_details(NUMBER_DATES)
+    orders = make_orders(dates['date_uuid'].iloc[::-10].tolist())
+    load_dates_and_orders(dates, orders, replace(context, surrogate_keys=SurrogateKeys([date_times])))
+
+    dim_date_times = pd.read_sql_table('dim_date_times', context.target_engine)
+    orders_table = pd.read_sql_table('orders_table', context.target_engine)
+    assert dim_date_times['date_key'].tolist() == list(range(1, NUMBER_DATES + 1))
+    assert 'date_uuid' not in orders_table.columns
+    assert dim_date_times.set_index('date_key').loc[orders_table['date_key'], 'date_uuid'].tolist() == \
+        orders['date_uuid'].tolist()
+
+
+def test_orphaned_orders_get_stub_dimension_rows(context, load_dates_and_orders):
+    """Dates missing from dim_date_times are loaded as stub rows, numbered after the loaded dates"""
+    dates = make_date_details(NUMBER_DATES)
+    missing_uuid = 'ffffffff-5d6a-4117-874d-9cdb38ca1fa6'
+    orders = make_orders([*dates['date_uuid'].iloc[:20], missing_uuid, missing_uuid])
+    load_dates_and_orders(dates, orders, replace(context,
+                                                 integrity=ReferentialIntegrity([date_times], on_orphans=STUB),
+                                                 surrogate_keys=SurrogateKeys([date_times])))
+
+    dim_date_times = pd.read_sql_table('dim_date_times', context.target_engine)
+    orders_table = pd.read_sql_table('orders_table', context.target_engine)
+    assert len(dim_date_times.index) == NUMBER_DATES + 1
+    stub = dim_date_times.iloc[-1]
+    assert (stub['date_uuid'], stub['date_key']) == (missing_uuid, NUMBER_DATES + 1)
+    assert pd.isna(stub['year'])
+    assert orders_table['date_key'].tolist() == [*range(1, 21), NUMBER_DATES + 1, NUMBER_DATES + 1]
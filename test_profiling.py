@@ -0,0 +1,118 @@
+import json
+
+import pandas as pd
+import pytest
+
+import profiling
+from profiling import RunReport, add_worker_cpu, cpu_timed, profile_methods
+
+
+@pytest.fixture
+def report(monkeypatch):
+    """Replaces the run report with an empty one"""
+    report = RunReport()
+    monkeypatch.setattr(profiling, 'run_report', report)
+    return report
+
+
+@profile_methods
+class Cleaner:
+
+    @staticmethod
+    def _drop_first_row(df: pd.DataFrame) -> pd.DataFrame:
+        return df.iloc[1:]
+
+    def clean(self, df: pd.DataFrame) -> pd.DataFrame:
+        return self._drop_first_row(df)
+
+    def chunks(self, df: pd.DataFrame):
+        yield df
+
+    @staticmethod
+    def _clean_in_pool(df: pd.DataFrame) -> pd.DataFrame:
+        add_worker_cpu(2.0)
+        return df
+
+    def clean_in_pool(self, df: pd.DataFrame) -> pd.DataFrame:
+        add_worker_cpu(1.5)
+        return self._clean_in_pool(df)
+
+
+def stats_by_stage(report: RunReport):
+    return {stats.stage: stats for stats in report.pop_stats()}
+
+
+def test_profile_methods_records_rows_and_calls(report):
+    """Each method call records its rows in and out, nested private steps are recorded too"""
+    df = pd.DataFrame({'a': range(10)})
+    Cleaner().clean(df)
+    Cleaner().clean(df=df)
+
+    stats = stats_by_stage(report)
+    assert stats['Cleaner.clean'].calls == 2
+    assert stats['Cleaner.clean'].rows_in == 20
+    assert stats['Cleaner.clean'].rows_out == 18
+    assert stats['Cleaner._drop_first_row'].calls == 2
+    assert stats['Cleaner.clean'].wall_seconds >= stats['Cleaner._drop_first_row'].wall_seconds
+
+
+def test_profile_methods_records_process_peak_rss(report, monkeypatch):
+    """The process peak RSS is recorded as it is when the stage returns, not as an increase during the stage"""
+    monkeypatch.setattr(profiling, '_peak_rss_bytes', iter([100, 300, 200, 150]).__next__)
+    df = pd.DataFrame({'a': range(10)})
+    Cleaner().clean(df)
+    Cleaner().clean(df)
+
+    stats = stats_by_stage(report)
+    # _drop_first_row returns before clean, each stage keeps the largest it saw
+    assert stats['Cleaner._drop_first_row'].process_peak_rss_bytes == 200
+    assert stats['Cleaner.clean'].process_peak_rss_bytes == 300
+
+
+def test_worker_cpu_is_added_to_the_waiting_stages(report):
+    """Cpu time of pool workers counts for the stage waiting on them and the stages enclosing it"""
+    Cleaner().clean_in_pool(pd.DataFrame({'a': range(3)}))
+
+    stats = stats_by_stage(report)
+    assert 2.0 <= stats['Cleaner._clean_in_pool'].cpu_seconds < 3.0
+    assert 3.5 <= stats['Cleaner.clean_in_pool'].cpu_seconds < 4.5
+    # Outside a stage there is nothing to add it to
+    add_worker_cpu(1.0)
+
+
+def test_cpu_timed_returns_result_and_cpu_time():
+    """The result of the function is returned with the cpu time it took"""
+    result, cpu_seconds = cpu_timed(sum, range(10**6))
+    assert result == sum(range(10**6))
+    assert cpu_seconds > 0
+
+
+def test_profile_methods_skips_generators(report):
+    """Generator methods are left unwrapped"""
+    list(Cleaner().chunks(pd.DataFrame()))
+    assert 'Cleaner.chunks' not in stats_by_stage(report)
+
+
+def test_profile_stage_dumps_cprofile(report, monkeypatch, tmp_path):
+    """The stage named in the environment variable is run under cProfile"""
+    monkeypatch.setenv(profiling.PROFILE_STAGE_ENV, 'Cleaner.clean')
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', tmp_path)
+    Cleaner().clean(pd.DataFrame({'a': range(3)}))
+
+    profiles = list(tmp_path.glob('*.prof'))
+    assert len(profiles) == 1
+    assert profiles[0].name.startswith('Cleaner.clean_')
+
+
+def test_run_report_written_as_json(report, tmp_path):
+    """The run report has the task timings and a stats entry per stage"""
+    Cleaner().clean(pd.DataFrame({'a': range(3)}))
+    report.write(tmp_path / 'run_report.json', task_timings={'user': 1.5})
+
+    with open(tmp_path / 'run_report.json') as f:
+        run_report = json.load(f)
+    assert run_report['tasks'] == {'user': 1.5}
+    assert 'process-wide' in run_report['metrics']['process_peak_rss_bytes']
+    assert {stats['stage'] for stats in run_report['stages']} == {
+        'Cleaner.clean', 'Cleaner._drop_first_row'
+    }
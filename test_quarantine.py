@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from config import valid_country_codes, user_schema
+import data_cleaning
+from data_cleaning import DataCleaning
+from profiling import RunReport
+import quarantine
+from quarantine import Quarantine
+from staging import Staging, REJECTED
+
+
+@pytest.fixture
+def rejected(monkeypatch):
+    """Replaces the quarantine with an empty one"""
+    quarantine = Quarantine()
+    monkeypatch.setattr(data_cleaning, 'quarantine', quarantine)
+    return quarantine
+
+
+@pytest.fixture
+def users():
+    return pd.DataFrame({
+        'index': ['1', '2', '3'],
+        'country': ['United Kingdom', 'XSHGSJH', 'NULL'],
+        'country_code': ['GB', 'XSHGSJH', 'NULL'],
+        'date_of_birth': ['1999-01-01', 'XSHGSJH', 'NULL'],
+        'join_date': ['2021-01-01', 'XSHGSJH', 'NULL'],
+        'address': ['4 High Street\nLondon', 'XSHGSJH', 'NULL'],
+        'user_uuid': ['93caf182-e4e9-4c6e-bebb-60a1a9dcf9b8', 'XSHGSJH', 'NULL'],
+    })
+
+
+def test_cleaning_quarantines_rejected_rows(rejected, users):
+    """Rejected rows are kept with the rule and stage which rejected them"""
+    DataCleaning(column_entries=valid_country_codes, schema=user_schema).clean_user_data(df=users)
+    df = rejected.frames()['dim_users']
+    assert df.index.tolist() == [2, 3]
+    assert df['country_code'].tolist() == ['XSHGSJH', 'NULL']
+    assert df['rule'].tolist() == ['allowed_values country_code'] * 2
+    assert df['stage'].tolist() == ['clean_user_data'] * 2
+
+
+def test_cleaning_quarantines_rows_before_failing(rejected, users):
+    """Rows are quarantined even when rejecting them fails cleaning"""
+    cleaner = DataCleaning(column_entries=valid_country_codes,
+                           schema=user_schema,
+                           max_rejected_fraction=0.5)
+    with pytest.raises(ValueError):
+        cleaner.clean_user_data(df=users)
+    assert len(rejected.frames()['dim_users'].index) == 2
+
+
+def test_write_to_db_appends_each_run(tmp_path, rejected, users):
+    """Each run's rejected rows are appended to <table>_rejected in one batch"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+    cleaner = DataCleaning(column_entries=valid_country_codes, schema=user_schema)
+    for chunk in [users.iloc[:2], users.iloc[2:]]:
+        cleaner.clean_user_data(df=chunk.copy())
+    rejected.write_to_db(engine)
+    rejected.write_to_db(engine)
+
+    df = pd.read_sql_table('dim_users_rejected', engine)
+    assert df['index'].tolist() == [2, 3, 2, 3]
+    assert set(df.columns) >= {'rule', 'stage', 'run_started'}
+
+
+def test_write_to_db_keeps_text_columns_across_runs(tmp_path, rejected, monkeypatch):
+    """Rejected rows are written as text, so a batch of all null rows doesn't fix the column types for later runs"""
+    report = RunReport()
+    monkeypatch.setattr(quarantine, 'run_report', report)
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+    rejected.add('dim_products', pd.DataFrame({'weight': [np.nan, np.nan], 'rule': 'not_null product_code'}))
+    rejected.write_to_db(engine)
+    rejected.pop()
+    rejected.add('dim_products', pd.DataFrame({'weight': ['77g .', ''], 'rule': 'not_null product_code'}))
+    rejected.write_to_db(engine)
+
+    df = pd.read_sql_table('dim_products_rejected', engine)
+    assert df['weight'].tolist() == [None, None, '77g .', '']
+    assert {column['name']: str(column['type']) for column in inspect(engine).get_columns('dim_products_rejected')
+            }['weight'] == 'TEXT'
+    assert [(stats.stage, stats.rows_in, stats.rows_out) for stats in report.stats()] == [
+        ('quarantine dim_products', 4, 4)]
+
+
+def test_failed_write_to_db_is_recorded(rejected, monkeypatch):
+    """A failed write is raised, and recorded in the run report as no rows written"""
+    report = RunReport()
+    monkeypatch.setattr(quarantine, 'run_report', report)
+    engine = create_engine('sqlite:////nonexistent/target.db')
+    rejected.add('dim_users', pd.DataFrame({'country_code': ['XX']}))
+    with pytest.raises(Exception):
+        rejected.write_to_db(engine)
+    assert [(stats.stage, stats.rows_in, stats.rows_out) for stats in report.stats()] == [('quarantine dim_users', 1, 0)]
+
+
+def test_write_to_staging(tmp_path, rejected, users):
+    """Rejected rows are staged as parquet next to the raw and cleaned data"""
+    DataCleaning(column_entries=valid_country_codes, schema=user_schema).clean_user_data(df=users)
+    staging = Staging(tmp_path / 'staging', run_id='20231101T120000')
+    rejected.write_to_staging(staging)
+    pd.testing.assert_frame_equal(staging.read('dim_users', REJECTED), rejected.frames()['dim_users'])
+
+
+def test_merge_rows_rejected_in_another_process(rejected):
+    """Rows popped from a worker's quarantine are merged into the run's"""
+    worker = Quarantine()
+    worker.add('dim_products', pd.DataFrame({'category': ['XXX']}))
+    rejected.merge(worker.pop())
+    assert worker.frames() == {}
+    assert rejected.frames()['dim_products']['category'].tolist() == ['XXX']
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+from scheduler import Task, run_tasks
+
+
+def test_run_tasks_runs_dependencies_first():
+    """A task only starts once the tasks it depends on have finished"""
+    finished = []
+    tasks = [
+        Task('load_sql', lambda: finished.append('load_sql'), depends_on=['user', 'card']),
+        Task('user', lambda: finished.append('user')),
+        Task('card', lambda: finished.append('card')),
+    ]
+    timings = run_tasks(tasks, max_workers=2)
+    assert finished[-1] == 'load_sql'
+    assert set(timings) == {'user', 'card', 'load_sql'}
+
+
+def test_run_tasks_runs_independent_tasks_concurrently():
+    """Independent tasks run at the same time, each waits for the other to start"""
+    barrier = threading.Barrier(2, timeout=5)
+    tasks = [Task('user', barrier.wait), Task('card', barrier.wait)]
+    run_tasks(tasks, max_workers=2)
+
+
+def test_run_tasks_raises_task_error_and_skips_dependants():
+    """A failing task raises its error and tasks depending on it are not run"""
+    finished = []
+
+    def fail():
+        raise AssertionError('row count mismatch')
+
+    tasks = [
+        Task('user', fail),
+        Task('load_sql', lambda: finished.append('load_sql'), depends_on=['user']),
+    ]
+    with pytest.raises(AssertionError, match='row count mismatch'):
+        run_tasks(tasks, max_workers=2)
+    assert finished == []
+
+
+def test_run_tasks_circular_dependencies():
+    """Tasks which can never start raise a ValueError"""
+    tasks = [
+        Task('user', lambda: None, depends_on=['card']),
+        Task('card', lambda: None, depends_on=['user']),
+    ]
+    with pytest.raises(ValueError):
+        run_tasks(tasks, max_workers=2)
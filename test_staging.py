@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_cleaning import DataCleaning
+from staging import Staging, RAW, CLEANED
+
+
+@pytest.fixture
+def staging(tmp_path):
+    return Staging(tmp_path / 'staging', run_id='20231101T120000')
+
+
+@pytest.fixture
+def orders():
+    """Returns orders as read from the RDS database, with the all-null columns dropped by cleaning"""
+    return pd.DataFrame({
+        'level_0': [0, 1, 2],
+        'index': [0, 1, 2],
+        'date_uuid': [
+            '9476f17e-5d6a-4117-874d-9cdb38ca1fa6', '2a2c1e43-4d0e-4cb3-b9c4-1c2b6f8e8a0d',
+            'a0b4e0b4-3a6a-4b3a-9a5f-1b5c0f4c1d2e'
+        ],
+        'first_name': None,
+        'last_name': None,
+        'card_number': [30060773296197, 349624180933183, 3529023891650490],
+        'product_quantity': [3, 4, 12],
+        '1': None,
+    })
+
+
+def test_write_read_preserves_dtypes(staging):
+    """Staged dataframes are read back with the same dtypes, index and missing values"""
+    df = pd.DataFrame(
+        {
+            'month': pd.Categorical(['1', '12', '3']),
+            'date': pd.to_datetime(['2012-02-17', None, '1995-04-03']),
+            'weight': [0.5, np.nan, 1.25],
+            'product_name': ['Dog food', np.nan, 'Cat food'],
+        },
+        index=pd.Index([3, 7, 9], name='index'))
+    staging.write('dim_products', CLEANED, df)
+    pd.testing.assert_frame_equal(staging.read('dim_products', CLEANED), df)
+
+
+def test_write_chunks_passes_chunks_through(staging):
+    """Chunks are staged as they pass and read back in the same order"""
+    chunks = [pd.DataFrame({'index': range(n * 10, n * 10 + 10)}) for n in range(3)]
+    passed = list(staging.write_chunks('orders_table', RAW, iter(chunks)))
+    assert passed == chunks
+
+    staged = list(staging.read_chunks('orders_table', RAW))
+    for chunk, staged_chunk in zip(chunks, staged, strict=True):
+        pd.testing.assert_frame_equal(chunk, staged_chunk)
+
+
+def test_write_replaces_earlier_parts(staging):
+    """Staging a source again in the same run replaces what was staged before"""
+    list(staging.write_chunks('orders_table', RAW,
+                              [pd.DataFrame({'index': [n]}) for n in range(3)]))
+    staging.write('orders_table', RAW, pd.DataFrame({'index': [7]}))
+    assert list(staging.read('orders_table', RAW)['index']) == [7]
+
+
+def test_mixed_type_columns_are_staged_as_strings(staging):
+    """Object columns mixing types, which parquet can't store, are staged as strings"""
+    df = pd.DataFrame({'card_number': [30060773296197, 'NULL', np.nan]})
+    staging.write('dim_card_details', RAW, df)
+    assert staging.read('dim_card_details', RAW)['card_number'].tolist()[:2] == [
+        '30060773296197', 'NULL'
+    ]
+    assert pd.isna(staging.read('dim_card_details', RAW)['card_number'][2])
+
+
+def test_read_missing_stage(staging):
+    """Reading a stage which hasn't been run raises an error naming the source"""
+    with pytest.raises(FileNotFoundError, match='dim_users'):
+        staging.read('dim_users', RAW)
+
+
+def test_latest_run_id(tmp_path):
+    """The latest run id is the most recently created run in any source"""
+    assert Staging.latest_run_id(tmp_path) is None
+    Staging(tmp_path, '20231101T120000').write('dim_users', RAW, pd.DataFrame({'a': [1]}))
+    Staging(tmp_path, '20231102T090000').write('dim_products', RAW, pd.DataFrame({'a': [1]}))
+    assert Staging.latest_run_id(tmp_path) == '20231102T090000'
+
+
+def test_clean_from_staging_matches_clean_after_extract(staging, orders):
+    """Cleaning the staged raw extract gives the same result as cleaning the extract directly"""
+    staging.write('orders_table', RAW, orders)
+    df_direct = DataCleaning().clean_order_data(df=orders.copy())
+    df_staged = DataCleaning().clean_order_data(df=staging.read('orders_table', RAW))
+    pd.testing.assert_frame_equal(df_direct, df_staged)
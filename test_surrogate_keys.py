@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+from config import order, product, store
+from database_utils import DatabaseConnector
+from surrogate_keys import SurrogateKeys, join_keys, key_positions
+
+
+@pytest.fixture
+def surrogate_keys():
+    """Returns surrogate keys for the products and stores, with both dimensions loaded in chunks"""
+    surrogate_keys = SurrogateKeys([product, store])
+    products = pd.DataFrame({'product_code': [f"A{n}-{n:07d}S" for n in range(5)]})
+    stores = pd.DataFrame({'store_code': ['WEB-1388012W', 'HI-9B97EE4E']})
+    list(surrogate_keys.map_chunks(product, [products.iloc[:3], products.iloc[3:]]))
+    list(surrogate_keys.map_chunks(store, [stores]))
+    return surrogate_keys
+
+
+def test_dimension_rows_are_numbered_across_chunks():
+    """Each chunk of a dimension is numbered on from the last, the key is the first column"""
+    surrogate_keys = SurrogateKeys([product])
+    products = pd.DataFrame({'product_code': ['a', 'b', 'c', 'd'], 'product_price': [1.0, 2.0, 3.0, 4.0]})
+    chunks = list(surrogate_keys.map_chunks(product, [products.iloc[:2], products.iloc[2:]]))
+
+    assert [chunk.columns.tolist() for chunk in chunks] == [['product_key', 'product_code', 'product_price']] * 2
+    assert pd.concat(chunks)['product_key'].tolist() == [1, 2, 3, 4]
+    assert chunks[0]['product_key'].dtype == np.int32
+    assert products.columns.tolist() == ['product_code', 'product_price']
+
+
+def test_orders_reference_the_surrogate_keys(surrogate_keys):
+    """Natural foreign keys are replaced, in place, by the surrogate keys of the dimension rows"""
+    orders = pd.DataFrame({
+        'store_code': pd.Categorical(['HI-9B97EE4E', 'WEB-1388012W', 'HI-9B97EE4E']),
+        'product_code': ['A4-0000004S', 'A0-0000000S', 'A3-0000003S'],
+        'product_quantity': [1, 2, 3],
+    })
+    df = surrogate_keys.map_foreign_keys(orders)
+
+    assert df.columns.tolist() == ['store_key', 'product_key', 'product_quantity']
+    assert df['store_key'].tolist() == [2, 1, 2]
+    assert df['product_key'].tolist() == [5, 1, 4]
+    assert df['product_key'].dtype == 'Int32'
+
+
+def test_orders_missing_a_dimension_row_have_null_keys(surrogate_keys):
+    orders = pd.DataFrame({'product_code': ['A1-0000001S', 'unknown', None]})
+    df = surrogate_keys.map_foreign_keys(orders)
+    assert df['product_key'].isna().tolist() == [False, True, True]
+
+
+def test_orders_wait_for_every_dimension():
+    """Orders can't be mapped until every dimension has been loaded"""
+    surrogate_keys = SurrogateKeys([product, store])
+    list(surrogate_keys.map_chunks(product, [pd.DataFrame({'product_code': ['a']})]))
+    with pytest.raises(ValueError, match='dim_store_details'):
+        list(surrogate_keys.map_chunks(order, [pd.DataFrame({'product_code': ['a']})]))
+
+
+def test_sql_dtypes_replace_natural_foreign_keys(surrogate_keys):
+    sql_dtypes = surrogate_keys.sql_dtypes(order)
+    assert {'store_key', 'product_key', 'date_uuid'} <= set(sql_dtypes)
+    assert not {'store_code', 'product_code'} & set(sql_dtypes)
+    assert 'product_key' in surrogate_keys.sql_dtypes(product)
+
+
+def test_join_keys_follow_the_loaded_orders(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+    DatabaseConnector.upload_to_db(engine,
+                                   df=pd.DataFrame({'product_key': [1], 'store_code': ['a']}),
+                                   table_name='orders_table')
+    keys = join_keys(engine, [product, store])
+    assert keys == {'dim_products': 'product_key', 'dim_store_details': 'store_code'}
+
+
+def test_key_positions_of_categorical_keys():
+    keys = pd.Series(pd.Categorical(['b', None, 'c', 'x'], categories=['x', 'b', 'c']))
+    assert key_positions(keys, pd.Series(['a', 'b', 'c'])).tolist() == [1, -1, 2, -1]
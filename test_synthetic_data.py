@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from config import card, data_types, order, product, store, user
+import data_cleaning
+from pipeline import clean_dataframe
+from profiling import RunReport
+from quarantine import Quarantine
+from synthetic_data import make_sources, source_rows
+
+SCALE = 0.25
+
+
+@pytest.fixture(scope='module')
+def sources():
+    return make_sources(SCALE)
+
+
+@pytest.fixture
+def cleaned(sources, monkeypatch):
+    """Returns every source cleaned, with an empty quarantine and run report"""
+    monkeypatch.setattr(data_cleaning, 'quarantine', Quarantine())
+    monkeypatch.setattr(data_cleaning, 'run_report', RunReport())
+    return {
+        data_type.table_name: clean_dataframe(data_type, sources[data_type.table_name].copy())
+        for data_type in data_types
+    }
+
+
+def test_sources_are_scaled(sources):
+    assert {table_name: len(df.index) for table_name, df in sources.items()} == {
+        data_type.table_name: round(data_type.source_rows * SCALE) for data_type in data_types
+    }
+    assert source_rows(store, 0.0001) == 1
+
+
+def test_sources_are_dirty(sources):
+    """Each source has the mistakes cleaning fixes"""
+    users = sources[user.table_name]
+    assert (users['country_code'] == 'GGB').any()
+    for pattern in [r'^\d{4}-\d{2}-\d{2}$', r'^\d{4} [A-Z][a-z]+ \d{2}$', r'^[A-Z][a-z]+ \d{4} \d{2}$',
+                    r'^\d{4}/\d{2}/\d{2}$']:
+        assert users['join_date'].str.match(pattern).any()
+    assert (users['country_code'] == 'NULL').any()
+
+    cards = sources[card.table_name]
+    assert cards['card_number'].str.startswith('?').any()
+    assert cards['card_number expiry_date'].notna().any()
+
+    stores = sources[store.table_name]
+    assert stores['continent'].str.startswith('ee').any()
+    assert (stores['store_type'] == 'Web Portal').any()
+    assert stores['staff_numbers'].str.contains('[A-Za-z]').any()
+
+    weights = sources[product.table_name]['weight']
+    assert weights.str.contains(' x ').any() and weights.str.endswith('oz').any()
+
+
+def test_sources_clean_within_their_rejected_fraction(sources, cleaned):
+    for data_type in data_types:
+        assert len(cleaned[data_type.table_name].index) >= (
+            (1 - data_type.max_rejected_fraction) * len(sources[data_type.table_name].index))
+    assert set(cleaned[user.table_name]['country_code']) == {'GB', 'DE', 'US'}
+    assert set(cleaned[store.table_name]['continent']) == {'Europe', 'America'}
+    assert not cleaned[card.table_name]['card_number'].str.contains('?', regex=False).any()
+    merged_cards = sources[card.table_name]['card_number expiry_date'].dropna().str.split().str[0]
+    assert merged_cards.size > 1 and merged_cards.isin(cleaned[card.table_name]['card_number']).all()
+    assert cleaned[product.table_name]['weight'].notna().all()
+
+
+def test_orders_reference_loaded_rows(cleaned):
+    orders = cleaned[order.table_name]
+    for data_type in data_types:
+        if data_type is not order:
+            keys = orders[data_type.primary_key].astype(object)
+            assert keys.isin(cleaned[data_type.table_name][data_type.primary_key].astype(object)).all()
+
+
+def test_sources_are_repeatable(sources):
+    again = make_sources(SCALE)
+    for table_name, df in sources.items():
+        pd.testing.assert_frame_equal(df, again[table_name])
+    other_seed = make_sources(SCALE, seed=1)
+    assert not np.array_equal(sources[user.table_name]['user_uuid'], other_seed[user.table_name]['user_uuid'])
@@ -0,0 +1,115 @@
+from dataclasses import dataclass
+from typing import ClassVar
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from config import UUID_PATTERN, date_times, date_times_schema, valid_country_codes
+from data_cleaning import DataCleaning
+from profiling import run_report
+from validation import AllowedValues, InRange, Matches, NotNull, Rule, StreamValidator, Unique, validate
+
+
+@pytest.fixture
+def date_details():
+    """Returns date details with a bad row for each rule"""
+    return pd.DataFrame({
+        'timestamp': ['22:00:06', '22:44:06', '10:00:00', 'NULL', '11:00:00', '12:00:00'],
+        'month': ['9', '2', '4', 'NULL', '13', '4'],
+        'year': ['2012', '1997', '1994', 'NULL', '1994', '1994'],
+        'day': ['19', '10', '32', 'NULL', '1', '2'],
+        'time_period': 'Evening',
+        'date_uuid': [
+            '3b7ca996-37f9-433f-b6d0-ce8391b615ad', 'adc86836-4ae3-4765-b2a6-6e5d6d46c1a9',
+            'b4a4f4a7-5b34-4cb0-a0c6-45d5e5ac4d0b', 'NULL', '0423a395-a04d-4e6c-8d72-b1fd3ef81e8a',
+            '3b7ca996-37f9-433f-b6d0-ce8391b615ad'
+        ],
+    })
+
+
+def test_rules_masks():
+    """Each rule marks the rows which break it"""
+    df = pd.DataFrame({'code': ['GB', 'GGB', None, 'GB'], 'number': ['1', '40', 'x', '3']})
+    assert AllowedValues('code', values=['GB']).invalid(df).tolist() == [False, True, True, False]
+    assert Matches('number', pattern=r'\d').invalid(df).tolist() == [False, True, True, False]
+    assert InRange('number', minimum=1, maximum=3).invalid(df).tolist() == [False, True, True, False]
+    assert NotNull('code').invalid(df).tolist() == [False, False, True, False]
+    assert Unique('code').invalid(df).tolist() == [False, False, False, True]
+
+
+def test_rule_without_invalid_cannot_be_made():
+    """A rule must say which rows break it before it can be used"""
+
+    @dataclass
+    class Incomplete(Rule):
+        kind: ClassVar[str] = 'incomplete'
+
+    with pytest.raises(TypeError, match='abstract method invalid'):
+        Incomplete('code')
+
+
+def test_validate_reports_rejections_per_rule(date_details):
+    """Rows failing any rule are rejected once, and each rule reports every row it rejected"""
+    _, rejected, report = validate(date_details, date_times.rules)
+    assert rejected.tolist() == [False, False, True, True, True, True]
+    assert report.rows_in == 6
+    assert report.rows_rejected == 4
+    assert report.rejected_by_rule == {
+        'allowed_values month': 2,
+        'in_range day': 2,
+        'matches date_uuid': 1,
+        'unique date_uuid': 1,
+    }
+
+
+def test_validate_applies_corrections():
+    """Known typos are corrected before the rules are checked"""
+    df = pd.DataFrame({'country_code': ['GGB', 'GB', 'XX']})
+    df, rejected, _ = validate(df, [valid_country_codes.rule()])
+    assert df['country_code'].tolist() == ['GB', 'GB', 'XX']
+    assert rejected.tolist() == [False, False, True]
+
+
+def test_uuid_pattern():
+    """uuids match in full, lower case only"""
+    df = pd.DataFrame({'uuid': ['93caf182-e4e9-4c6e-bebb-60a1a9dcf9b8', 'NULL', np.nan,
+                                '93CAF182-E4E9-4C6E-BEBB-60A1A9DCF9B8x']})
+    assert Matches('uuid', pattern=UUID_PATTERN).invalid(df).tolist() == [False, True, True, True]
+
+
+def test_clean_drops_rejected_rows_and_records_them(date_details):
+    """Cleaning drops every rejected row and records the rows each rule rejected in the run report"""
+    run_report.reset()
+    cleaner = DataCleaning(schema=date_times_schema, rules=date_times.rules, max_rejected_fraction=1)
+    df = cleaner.clean_date_times_data(df=date_details)
+    assert df['date_uuid'].tolist() == [
+        '3b7ca996-37f9-433f-b6d0-ce8391b615ad', 'adc86836-4ae3-4765-b2a6-6e5d6d46c1a9'
+    ]
+    rejected = {
+        stats.stage: stats.rows_in - stats.rows_out
+        for stats in run_report.stats() if stats.stage.startswith('rejected ')
+    }
+    assert rejected['rejected dim_date_times in_range day'] == 2
+
+
+def test_clean_fails_above_max_rejected_fraction(date_details):
+    """Rejecting more rows than the tolerance fails cleaning"""
+    cleaner = DataCleaning(schema=date_times_schema, rules=date_times.rules, max_rejected_fraction=0.5)
+    with pytest.raises(ValueError, match='4 of 6 rows of dim_date_times rejected'):
+        cleaner.clean_date_times_data(df=date_details)
+
+
+def test_stream_validator_rejects_keys_of_earlier_chunks():
+    """Keys repeating an earlier chunk are rejected, null keys are not, and the tolerance uses the totals"""
+    validator = StreamValidator('dim_users', [NotNull('user_uuid'), Unique('user_uuid')], max_rejected_fraction=0.3)
+    chunks = [pd.DataFrame({'user_uuid': ['a', 'b', None]}), pd.DataFrame({'user_uuid': ['c', 'a', None, 'b']})]
+    for chunk in validator.count_in(chunks):
+        repeated, report = validator.repeated(chunk)
+        validator.count_out(int((~repeated).sum()))
+    assert repeated.tolist() == [False, True, False, True]
+    assert report.rejected_by_rule == {'unique user_uuid across chunks': 2}
+    validator.check()
+    validator.count_out(-1)
+    with pytest.raises(ValueError, match='3 of 7 rows of dim_users rejected'):
+        validator.check()
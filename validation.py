@@ -0,0 +1,190 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+import logging
+from typing import ClassVar, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Rule(ABC):
+    """A constraint on a column. Rows for which invalid() is True are rejected"""
+    column: str
+    kind: ClassVar[str] = 'rule'
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind} {self.column}"
+
+    def correct(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Fix known errors in the column before it is checked, by default nothing is changed"""
+        return df
+
+    @abstractmethod
+    def invalid(self, df: pd.DataFrame) -> pd.Series:
+        """Returns a boolean mask of the rows of df breaking the rule"""
+
+
+@dataclass
+class AllowedValues(Rule):
+    """Entries must be one of values. corrections maps known typos to the value they should be"""
+    values: List = field(default_factory=list)
+    corrections: Dict = None
+    kind: ClassVar[str] = 'allowed_values'
+
+    def correct(self, df: pd.DataFrame) -> pd.DataFrame:
+        if self.corrections:
+            df[self.column] = df[self.column].replace(self.corrections)
+        return df
+
+    def invalid(self, df: pd.DataFrame) -> pd.Series:
+        return ~df[self.column].isin(self.values)
+
+
+@dataclass
+class Matches(Rule):
+    """Entries must match the regular expression in full"""
+    pattern: str = ''
+    kind: ClassVar[str] = 'matches'
+
+    def invalid(self, df: pd.DataFrame) -> pd.Series:
+        matched = df[self.column].astype('string').str.fullmatch(self.pattern)
+        return ~matched.fillna(False).astype(bool)
+
+
+@dataclass
+class InRange(Rule):
+    """Entries must be numbers between minimum and maximum, inclusive"""
+    minimum: float = -np.inf
+    maximum: float = np.inf
+    kind: ClassVar[str] = 'in_range'
+
+    def invalid(self, df: pd.DataFrame) -> pd.Series:
+        return ~pd.to_numeric(df[self.column], errors='coerce').between(self.minimum, self.maximum)
+
+
+@dataclass
+class NotNull(Rule):
+    """Entries must not be missing"""
+    kind: ClassVar[str] = 'not_null'
+
+    def invalid(self, df: pd.DataFrame) -> pd.Series:
+        return df[self.column].isna()
+
+
+@dataclass
+class Unique(Rule):
+    """
+    Entries must not repeat an earlier row, e.g. the primary key. validate only checks within the dataframe
+    validated, a StreamValidator checks against earlier chunks
+    """
+    kind: ClassVar[str] = 'unique'
+
+    def invalid(self, df: pd.DataFrame) -> pd.Series:
+        return df[self.column].duplicated(keep='first')
+
+
+@dataclass
+class ValidationReport:
+    """
+    Rows checked, and the number failing each rule. A row failing several rules counts against each.
+    rejected_rules holds the first rule each rejected row failed, in the order of the rejected rows.
+    """
+    rows_in: int
+    rows_rejected: int
+    rejected_by_rule: Dict[str, int]
+    rejected_rules: np.ndarray = field(default=None, repr=False)
+
+    @property
+    def rejected_fraction(self) -> float:
+        return self.rows_rejected / self.rows_in if self.rows_in else 0.0
+
+
+def _combine(number_rows: int, invalid_masks: Dict[str, np.ndarray]) -> Tuple[np.ndarray, ValidationReport]:
+    """Returns a mask of the rows failing any of the named masks and a report of the rows each rejected"""
+    if not invalid_masks:
+        return np.zeros(number_rows, dtype=bool), ValidationReport(
+            rows_in=number_rows, rows_rejected=0, rejected_by_rule={}, rejected_rules=np.array([], dtype=object))
+    rejected = np.logical_or.reduce(list(invalid_masks.values()))
+    report = ValidationReport(rows_in=number_rows,
+                              rows_rejected=int(rejected.sum()),
+                              rejected_by_rule={name: int(mask.sum()) for name, mask in invalid_masks.items()},
+                              rejected_rules=np.select([mask[rejected] for mask in invalid_masks.values()],
+                                                       list(invalid_masks),
+                                                       default=None))
+    logger.debug(f"Rejected {report.rows_rejected} of {report.rows_in} rows: {report.rejected_by_rule}")
+    return rejected, report
+
+
+def validate(df: pd.DataFrame, rules: List[Rule]) -> Tuple[pd.DataFrame, np.ndarray, ValidationReport]:
+    """
+    Apply the corrections of the rules, then evaluate every rule as a boolean mask over df.
+    Returns the corrected df, a mask of the rows failing any rule and a report of the rows each rule rejected.
+    """
+    for rule in rules:
+        df = rule.correct(df)
+    invalid_masks = {rule.name: rule.invalid(df).to_numpy(dtype=bool) for rule in rules}
+    rejected, report = _combine(len(df.index), invalid_masks)
+    return df, rejected, report
+
+
+class StreamValidator:
+    """
+    Validation state of a table cleaned one chunk at a time. Cleaning validates each chunk on its own, so the
+    keys of the Unique rules are kept to reject rows repeating a key of an earlier chunk, and the rows going
+    in and out of cleaning are totalled to check max_rejected_fraction once the stream ends. Null keys are
+    left to NotNull rules.
+    """
+
+    def __init__(self, table_name: str, rules: List[Rule] = None, max_rejected_fraction: float = None):
+        self.table_name = table_name
+        self.unique_rules = [rule for rule in rules or [] if isinstance(rule, Unique)]
+        self.max_rejected_fraction = max_rejected_fraction
+        self.rows_in = 0
+        self.rows_out = 0
+        self._seen: Dict[str, set] = {rule.column: set() for rule in self.unique_rules}
+
+    @property
+    def rejected_fraction(self) -> float:
+        return (self.rows_in - self.rows_out) / self.rows_in if self.rows_in else 0.0
+
+    def count_in(self, chunks: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Pass through the chunks about to be cleaned, counting their rows"""
+        for chunk in chunks:
+            self.rows_in += len(chunk.index)
+            yield chunk
+
+    def repeated(self, df: pd.DataFrame) -> Tuple[np.ndarray, ValidationReport]:
+        """
+        Returns a mask of the rows of a cleaned chunk whose unique keys were in an earlier chunk, and a report
+        of the rows each Unique rule rejected. The keys of the chunk are then kept for the next chunks.
+        """
+        invalid_masks = {}
+        for rule in self.unique_rules:
+            seen = self._seen[rule.column]
+            keys = df[rule.column].to_numpy(dtype=object)
+            present = df[rule.column].notna().to_numpy()
+            if seen.isdisjoint(keys[present]):
+                mask = np.zeros(len(keys), dtype=bool)
+            else:
+                mask = np.fromiter((key in seen for key in keys), dtype=bool, count=len(keys)) & present
+            seen.update(keys[present])
+            invalid_masks[f"{rule.name} across chunks"] = mask
+        return _combine(len(df.index), invalid_masks)
+
+    def count_out(self, number_rows: int):
+        """Count rows which passed cleaning and the checks across chunks"""
+        self.rows_out += number_rows
+
+    def check(self):
+        """
+        Raises a ValueError if more than max_rejected_fraction of the rows of the stream were rejected, which
+        points to a change in the source rather than the usual bad rows
+        """
+        if self.max_rejected_fraction is not None and self.rejected_fraction > self.max_rejected_fraction:
+            raise ValueError(
+                f"{self.rows_in - self.rows_out} of {self.rows_in} rows of {self.table_name} rejected, more than "
+                f"{self.max_rejected_fraction:.1%}")